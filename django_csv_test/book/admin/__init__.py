@@ -1,17 +1,33 @@
 from django.contrib import admin
 
+from book.admin.mixins import CsvAdminMixin
 from book.mcsv import PublisherCsv, BookWithPublisherCsv
-from book.models import Book, Publisher
-from django_csv.model_csv.csv.django.admin import DjangoCsvAdminMixin
+from book.models import Book, ImportCheckpoint, ImportJob, Publisher
 
 
 @admin.register(Book)
-class BookAdmin(DjangoCsvAdminMixin, admin.ModelAdmin):
+class BookAdmin(CsvAdminMixin, admin.ModelAdmin):
     csv_class = BookWithPublisherCsv
     file_name = 'book'
+    update_existing = True
 
 
 @admin.register(Publisher)
-class PublisherAdmin(DjangoCsvAdminMixin, admin.ModelAdmin):
+class PublisherAdmin(CsvAdminMixin, admin.ModelAdmin):
     csv_class = PublisherCsv
     file_name = 'publisher'
+    update_existing = True
+
+
+@admin.register(ImportJob)
+class ImportJobAdmin(admin.ModelAdmin):
+    list_display = ['pk', 'file', 'csv_class', 'status', 'processed_rows',
+                    'created_by', 'created_at']
+    list_filter = ['status']
+    readonly_fields = ['processed_rows', 'errors', 'message', 'created_by']
+
+
+@admin.register(ImportCheckpoint)
+class ImportCheckpointAdmin(admin.ModelAdmin):
+    list_display = ['pk', 'csv_class', 'file_hash', 'row_number', 'job', 'updated_at']
+    readonly_fields = ['csv_class', 'file_hash', 'row_number', 'offset', 'job']
@@ -0,0 +1,40 @@
+from django import forms
+
+from book import compression
+from django_csv.model_csv.admin import forms as admin_forms
+
+
+class UploadForm(admin_forms.UploadForm):
+    """
+    UploadForm which accepts compressed files, e.g. `book.csv.gz`. The reader
+    is chosen by the extension before the one of the compression. Files are
+    decompressed by `book.jobs` whatever their names are.
+    """
+    file = forms.FileField(
+        required=True,
+        help_text=(
+            f"{' '.join([extension.upper() for extension in admin_forms.READER.keys()])}"
+            " are available. They can be compressed with"
+            f" {', '.join(compression.get_methods())}."
+        )
+    )
+
+    resumable = forms.BooleanField(
+        required=False, initial=False,
+        help_text='save rows chunk by chunk and resume when the same file is uploaded again'
+    )
+
+    def clean(self):
+        # skip UploadForm.clean() which rejects `.gz` etc.
+        cleaned_data = forms.Form.clean(self)
+        file = cleaned_data.get('file')
+        if file is None:
+            return cleaned_data
+
+        extension = compression.strip_extension(file.name).split('.')[-1]
+        try:
+            cleaned_data['reader'] = admin_forms.READER[extension.lower()]
+        except KeyError:
+            raise forms.ValidationError(f'`{extension}` is not supported')
+
+        return cleaned_data
@@ -0,0 +1,139 @@
+from django.contrib import admin
+from django.core.exceptions import PermissionDenied
+from django.shortcuts import get_object_or_404, redirect
+from django.template.response import TemplateResponse
+from django.urls import path, reverse
+
+from book import compression
+from book.admin.forms import UploadForm
+from book.excel import ReadOnlyXlsxReader, StreamingXlsxWriter
+from book.jobs import get_executor, get_progress
+from book.models import ImportJob
+from book.readers import StreamingCsvReader, StreamingTsvReader
+from django_csv.model_csv.csv.django.admin import DjangoCsvAdminMixin
+from django_csv.model_csv.readers import CsvReader, TsvReader, XlsxReader
+from django_csv.model_csv.writers import CsvWriter, TsvWriter
+
+
+class CsvAdminMixin(DjangoCsvAdminMixin):
+    """
+    DjangoCsvAdminMixin whose csv and tsv downloads are streamed and whose
+    uploads are imported by `book.jobs` outside of the request. CSV, TSV and
+    XLSX uploads are read row by row, and XLSX files are written row by row.
+    `csv_class` must inherit `book.mixins.StreamingMixin`,
+    `book.mixins.ChunkedReadMixin` and `book.mixins.BulkSaveMixin`.
+    Set `export_version_field` and `export_related_version_fields` to cache
+    downloads with `book.mixins.ExportCacheMixin`.
+    Uploads compressed with gzip, bz2, xz or zstd are decompressed as they are
+    read. `download_csv_gz` compresses the csv as it is streamed.
+    Resumable uploads are saved chunk by chunk, see `book.jobs`.
+    Set `update_existing` to update instances of the same `lookup_columns`
+    of `csv_class` instead of creating new ones.
+    """
+    actions = ['download_csv', 'download_csv_gz', 'download_tsv',
+               'download_xlsx', 'download_xls']
+    export_version_field = None
+    export_related_version_fields = ()
+    update_existing = False
+    csv_upload_form = UploadForm
+
+    # readers used instead of the ones chosen by the upload form.
+    reader_classes = {
+        CsvReader: StreamingCsvReader,
+        TsvReader: StreamingTsvReader,
+        XlsxReader: ReadOnlyXlsxReader,
+    }
+
+    def get_export_csv(self, queryset):
+        mcsv = self.csv_class.for_write(instances=queryset)
+        if self.export_version_field:
+            mcsv.export_version_field = self.export_version_field
+            mcsv.export_related_version_fields = self.export_related_version_fields
+        return mcsv
+
+    @admin.action(description='download (.csv)')
+    def download_csv(self, request, queryset):
+        mcsv = self.get_export_csv(queryset)
+        return mcsv.get_streaming_response(
+            CsvWriter(filename=f'{self.file_name}.csv'))
+
+    @admin.action(description='download (.csv.gz)')
+    def download_csv_gz(self, request, queryset):
+        mcsv = self.get_export_csv(queryset)
+        return mcsv.get_streaming_response(
+            CsvWriter(filename=f'{self.file_name}.csv'),
+            compression=compression.GZIP)
+
+    @admin.action(description='download (.tsv)')
+    def download_tsv(self, request, queryset):
+        mcsv = self.get_export_csv(queryset)
+        return mcsv.get_streaming_response(
+            TsvWriter(filename=f'{self.file_name}.tsv'))
+
+    @admin.action(description='download (.xlsx)')
+    def download_xlsx(self, request, queryset):
+        mcsv = self.get_export_csv(queryset)
+        writer = StreamingXlsxWriter(filename=f'{self.file_name}.xlsx')
+        writer.write_down(table=mcsv.iter_table())
+        return writer.make_response()
+
+    def get_urls(self):
+        urls = super().get_urls()
+        return [
+            path('upload/<int:job_id>/',
+                 self.admin_site.admin_view(self.import_job),
+                 name=self.get_urlname('import_job')),
+        ] + urls
+
+    def upload_csv(self, request):
+        """
+        Store the upload as ImportJob and return without importing it.
+        """
+        if not self.has_add_permission(request) or (
+                self.update_existing and not self.has_change_permission(request)):
+            raise PermissionDenied
+
+        if request.method == 'GET':
+            return self.get_response(request, form=self.csv_upload_form())
+
+        form = self.csv_upload_form(request.POST, request.FILES)
+        if not form.is_valid():
+            return self.get_response(request, form=form)
+
+        READER = self.reader_classes.get(
+            form.cleaned_data['reader'], form.cleaned_data['reader'])
+        job = ImportJob.objects.create(
+            file=form.cleaned_data['file'],
+            csv_class=self.get_csv_class_path(),
+            reader_class=f'{READER.__module__}.{READER.__qualname__}',
+            static={'only_exists': form.cleaned_data['only_exists']},
+            resumable=form.cleaned_data['resumable'],
+            update_existing=self.update_existing,
+            created_by=request.user,
+        )
+        get_executor().submit(job)
+        return redirect(reverse(
+            f'admin:{self.get_urlname("import_job")}', args=[job.pk]))
+
+    def get_csv_class_path(self) -> str:
+        return f'{self.csv_class.__module__}.{self.csv_class.__qualname__}'
+
+    def import_job(self, request, job_id: int):
+        """
+        Progress and errors of a job of this admin's `csv_class`.
+        """
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+
+        job = get_object_or_404(ImportJob, pk=job_id, csv_class=self.get_csv_class_path())
+        return TemplateResponse(
+            request, 'admin/django_csv/import_job.html', {
+                **self.admin_site.each_context(request),
+                'job': job,
+                'progress': get_progress(job),
+                'changelist_url': reverse(
+                    f'admin:{self.get_urlname("changelist")}'),
+                'upload_url': reverse(
+                    f'admin:{self.get_urlname("upload_csv")}'),
+            }
+        )
@@ -0,0 +1,180 @@
+import functools
+import operator
+from typing import Any, Callable
+
+from django.db import models
+from django.db.models import Q
+
+from django_csv.model_csv import ValidationError
+
+# key of `static` which holds BatchResolver while reading a table.
+BATCH = '_batch'
+
+# `resolve(values_list: list[dict], static: dict) -> list`
+# return instances, or exceptions for values which cannot be resolved,
+# in the same order as `values_list`.
+Resolve = Callable[[list[dict], dict], list]
+
+
+class Pending:
+    """
+    Placeholder of a value which is resolved in bulk after all rows are read.
+    """
+    __slots__ = ('resolve', 'key')
+
+    def __init__(self, resolve: Resolve, key: tuple):
+        self.resolve = resolve
+        self.key = key
+
+    def __repr__(self) -> str:
+        return f'Pending({self.resolve.__qualname__}, {dict(self.key)})'
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Pending) and \
+            (self.resolve, self.key) == (other.resolve, other.key)
+
+    def __hash__(self) -> int:
+        return hash((self.resolve, self.key))
+
+
+class BatchResolver:
+    """
+    Collect values passed to `defer()` and call each `resolve` function only
+    once with all distinct values.
+    e.g.
+    def get_publisher(self, values: dict, static: dict, **kwargs):
+        if batch := static.get(BATCH):
+            return batch.defer(resolve_publishers, **values)
+        ...
+    """
+
+    def __init__(self):
+        # {resolve: {key: None}} dict is used as an ordered set.
+        self.pending: dict[Resolve, dict[tuple, None]] = {}
+        self.resolved: dict[Pending, Any] = {}
+
+    def defer(self, resolve: Resolve, **values) -> Pending:
+        key = tuple(sorted(values.items()))
+        self.pending.setdefault(resolve, {})[key] = None
+        return Pending(resolve, key)
+
+    def merge(self, other: 'BatchResolver') -> None:
+        """
+        Add values deferred in another BatchResolver, e.g. in a worker process.
+        """
+        for resolve, keys in other.pending.items():
+            self.pending.setdefault(resolve, {}).update(keys)
+
+    def resolve(self, static: dict, profile=None) -> None:
+        """
+        Resolve functions are called in the order of the first `defer()`, so
+        a value deferred by a `field_*` method is resolved before the part
+        callback which receives it.
+        profile: `book.profiling.Profile` which records each resolve function.
+        """
+        for resolve, keys in self.pending.items():
+            keys = [key for key in keys if Pending(resolve, key) not in self.resolved]
+            if not keys:
+                continue
+
+            values_list, errors = [], {}
+            for key in keys:
+                try:
+                    values_list.append(
+                        {name: self.get(value) for name, value in key})
+                except ValidationError as e:
+                    errors[key] = e
+
+            call = profile.wrap('resolve', resolve.__qualname__, resolve) \
+                if profile else resolve
+            results = iter(call(values_list, static.copy()))
+            for key in keys:
+                self.resolved[Pending(resolve, key)] = \
+                    errors[key] if key in errors else next(results)
+
+    def get(self, value: Any) -> Any:
+        """
+        Return a resolved value. Raise ValidationError if it is not resolved.
+        """
+        if not isinstance(value, Pending):
+            return value
+
+        resolved = self.resolved[value]
+        if isinstance(resolved, Exception):
+            if isinstance(resolved, ValidationError):
+                raise resolved
+            raise ValidationError(str(resolved))
+        return resolved
+
+
+def _normalize(model: type[models.Model], values: dict) -> tuple:
+    """
+    Make a comparable key. Relations are compared by primary keys.
+    """
+    key = []
+    for name, value in sorted(values.items()):
+        field = model._meta.get_field(name)
+        if isinstance(value, models.Model):
+            value = value.pk
+        elif not field.is_relation:
+            value = field.to_python(value)
+        key.append((field.attname, value))
+    return tuple(key)
+
+
+def bulk_get_or_create(model: type[models.Model], values_list: list[dict],
+                       create: bool = True, batch_size: int = 500) -> list:
+    """
+    Bulk version of `get_or_create()`. Existing instances are fetched by one
+    query per `batch_size` values and missing ones are created by a single
+    `bulk_create`. Every dict in `values_list` must have the same keys.
+    Return instances in the order of `values_list`. `DoesNotExist` (if not
+    `create`) or `MultipleObjectsReturned` is returned instead of an instance.
+    """
+    if not values_list:
+        return []
+
+    keys = [_normalize(model, values) for values in values_list]
+    found = _fetch(model, values_list, keys, batch_size)
+
+    missing = {
+        key: values for key, values in zip(keys, values_list)
+        if key not in found
+    }
+    if create and missing:
+        created = model.objects.bulk_create(
+            [model(**values) for values in missing.values()])
+        if all(obj.pk is not None for obj in created):
+            found.update({key: [obj] for key, obj in zip(missing, created)})
+        else:
+            # the database backend doesn't return primary keys.
+            found.update(_fetch(
+                model, list(missing.values()), list(missing), batch_size))
+
+    results = []
+    for key in keys:
+        instances = found.get(key, [])
+        if not instances:
+            results.append(model.DoesNotExist(
+                f'{model._meta.object_name} matching query does not exist.'))
+        elif len(instances) > 1:
+            results.append(model.MultipleObjectsReturned(
+                f'get() returned more than one {model._meta.object_name} '
+                f'-- it returned {len(instances)}!'))
+        else:
+            results.append(instances[0])
+    return results
+
+
+def _fetch(model: type[models.Model], values_list: list[dict],
+           keys: list[tuple], batch_size: int) -> dict[tuple, list]:
+    attnames = [name for name, _ in keys[0]]
+
+    found = {}
+    for i in range(0, len(values_list), batch_size):
+        query = functools.reduce(
+            operator.or_, (Q(**values) for values in values_list[i:i + batch_size]))
+        for obj in model.objects.filter(query):
+            key = tuple((name, getattr(obj, name)) for name in attnames)
+            found.setdefault(key, []).append(obj)
+    return found
@@ -0,0 +1,206 @@
+"""
+Scenarios and helpers of `manage.py benchmark_suite`.
+
+Peak RSS of a process never decreases, so each measurement runs in its own
+process by `run_in_process()`. A scenario compares modes, e.g. the library
+and this project, and its function returns the number of rows and the
+seconds of one mode.
+"""
+import io
+import itertools
+import json
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Callable, Iterator
+
+from book.excel import ReadOnlyXlsxReader, StreamingXlsxWriter
+from book.management.commands.init_data import seed_data
+from book.mcsv import BookCsv, BookWithPublisherCsv
+from book.models import Author, Book, Publisher
+from book.readers import StreamingTsvReader
+from django_csv.model_csv.readers import TsvReader, XlsxReader
+from django_csv.model_csv.writers import TsvWriter, XlsxWriter
+
+TEST_DATA_DIR = Path(__file__).resolve().parent / 'tests' / 'test_data'
+
+
+def get_peak_rss() -> int:
+    """peak RSS of the current process in KiB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_in_process(command: str, *args: str) -> dict:
+    """
+    Run `manage.py <command> <args>` in a new process and return the JSON
+    written on the last line of its output.
+    """
+    proc = subprocess.run(
+        [sys.executable, sys.argv[0], command, *args],
+        capture_output=True, text=True, check=True,
+    )
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def seed(books: int, publishers: int, authors: int, stdout=None) -> None:
+    """
+    Create publishers, authors and books until their numbers reach the given
+    numbers.
+    """
+    seed_data(
+        books=max(books - Book.objects.count(), 0),
+        publishers=max(publishers - Publisher.objects.count(), 0),
+        authors=max(authors - Author.objects.count(), 0),
+        stdout=stdout,
+    )
+
+
+def write_files(books: int, data_dir: str) -> None:
+    """
+    Write `books` books to `book.tsv` and `book.xlsx` in `data_dir`, read by
+    `tsv_upload` and `xlsx` scenarios.
+    """
+    instances = Book.objects.order_by('id')[:books]
+    with open(f'{data_dir}/book.tsv', 'wb') as f:
+        BookWithPublisherCsv.for_write(instances=instances).write_file(
+            f, TsvWriter(filename='book.tsv'))
+
+    writer = StreamingXlsxWriter(filename='book.xlsx')
+    writer.write_down(table=BookWithPublisherCsv.for_write(instances=instances).iter_table())
+    writer.wb.save(f'{data_dir}/book.xlsx')
+
+
+def scale_table(rows: int) -> Iterator[list]:
+    """
+    Yield the header and `rows` rows repeating `test_data/book.xlsx`.
+    """
+    with open(TEST_DATA_DIR / 'book.xlsx', 'rb') as f:
+        header, *table = XlsxReader(file=f).get_table()
+    yield header
+    yield from itertools.islice(itertools.cycle(table), rows)
+
+
+def measure(func: Callable[[], int]) -> dict:
+    """
+    Call `func` returning the number of rows and return the rows and the
+    seconds.
+    """
+    start = time.perf_counter()
+    rows = func()
+    return {'rows': rows, 'seconds': time.perf_counter() - start}
+
+
+def run_export_memory(mode: str, books: int, data_dir: str) -> dict:
+    """
+    BookCsv exports of `get_table()` and of `iter_table()`.
+    """
+    for_write = BookCsv.for_write(instances=Book.objects.order_by('id')[:books])
+    if mode == 'get_table':
+        return measure(lambda: len(for_write.get_table(header=False)))
+    return measure(lambda: sum(1 for _ in for_write.iter_table(header=False)))
+
+
+def run_write_rows(mode: str, books: int, data_dir: str) -> dict:
+    """
+    BookWithPublisherCsv exports of loaded instances by the row conversion
+    of the library and by the compiled one.
+    """
+    instances = list(Book.objects.select_related(
+        'publisher__registered_by').order_by('id')[:books])
+    for_write = BookWithPublisherCsv.for_write(instances=instances)
+    for_write.compile_rows = mode == 'compiled'
+    return measure(lambda: len(for_write.get_table(header=False)))
+
+
+def run_read_rows(mode: str, books: int, data_dir: str) -> dict:
+    """
+    `is_valid()` of BookWithPublisherCsv by the row conversion of the
+    library and by the compiled one.
+    """
+    table = BookWithPublisherCsv.for_write(
+        instances=Book.objects.order_by('id')[:books]).get_table(header=False)
+    for_read = BookWithPublisherCsv.for_read(table=table)
+    for_read.compile_rows = mode == 'compiled'
+    for_read.set_static('only_exists', True)
+
+    def read() -> int:
+        for_read.is_valid()
+        return len(for_read.cleaned_rows)
+
+    return measure(read)
+
+
+def run_export_values(mode: str, books: int, data_dir: str) -> dict:
+    """
+    BookCsv exports of instances, and of `values_list()` formatted by rows
+    and by columns. `peak_traced_kib` is the peak of Python allocations.
+    """
+    # a throwaway subclass leaves BookCsv as it is. It reuses `_meta` as
+    # for_write() does.
+    csv_class = type('BookCsvBench', (BookCsv,), {
+        '_meta': BookCsv._meta,
+        'use_values_list': mode != 'instances',
+        'format_by_column': mode == 'columns',
+    })
+    for_write = csv_class.for_write(instances=Book.objects.order_by('id')[:books])
+
+    tracemalloc.start()
+    result = measure(lambda: len(for_write.get_table(header=False)))
+    result['peak_traced_kib'] = tracemalloc.get_traced_memory()[1] // 1024
+    tracemalloc.stop()
+    return result
+
+
+def run_tsv_upload(mode: str, books: int, data_dir: str) -> dict:
+    """
+    Reading `book.tsv` by TsvReader of the library, which reads the whole
+    file, and by StreamingTsvReader.
+    """
+    def read() -> int:
+        with open(f'{data_dir}/book.tsv', 'rb') as f:
+            if mode == 'library':
+                return len(TsvReader(file=io.BytesIO(f.read())).get_table())
+            return sum(1 for _ in StreamingTsvReader(file=f).iter_table())
+
+    return measure(read)
+
+
+def run_xlsx(mode: str, books: int, data_dir: str) -> dict:
+    """
+    Reading `book.xlsx` by XlsxReader and ReadOnlyXlsxReader, and writing
+    rows of `test_data/book.xlsx` by XlsxWriter and StreamingXlsxWriter.
+    """
+    path = f'{data_dir}/book.xlsx'
+    if mode in ('read', 'read_only'):
+        def read() -> int:
+            with open(path, 'rb') as f:
+                if mode == 'read':
+                    return len(XlsxReader(file=f).get_table())
+                return sum(1 for _ in ReadOnlyXlsxReader(file=f).iter_table())
+
+        return measure(read)
+
+    def write() -> int:
+        if mode == 'write':
+            writer, table = XlsxWriter(filename='book.xlsx'), list(scale_table(books))
+        else:
+            writer, table = StreamingXlsxWriter(filename='book.xlsx'), scale_table(books)
+        writer.write_down(table=table)
+        writer.wb.save(io.BytesIO())
+        return books + 1
+
+    return measure(write)
+
+
+# scenario name: (function, modes)
+SCENARIOS = {
+    'export_memory': (run_export_memory, ['get_table', 'iter_table']),
+    'write_rows': (run_write_rows, ['library', 'compiled']),
+    'read_rows': (run_read_rows, ['library', 'compiled']),
+    'export_values': (run_export_values, ['instances', 'values_list', 'columns']),
+    'tsv_upload': (run_tsv_upload, ['library', 'streaming']),
+    'xlsx': (run_xlsx, ['read', 'read_only', 'write', 'write_only']),
+}
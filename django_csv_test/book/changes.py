@@ -0,0 +1,47 @@
+"""
+Index of raw row hashes used by `book.mixins.ChangeDetectionMixin`.
+
+A row is hashed as it is read from the file, before any conversion or
+`field_*` method, and the hash is stored with the hash of its natural key
+when the row is saved. Rows of a later import which have the same hash as
+the stored one are skipped.
+"""
+import hashlib
+import json
+
+from book.models import RowDigest
+
+# the number of keys in a query.
+FETCH_SIZE = 500
+
+
+def hash_values(values: list) -> str:
+    return hashlib.blake2b(
+        json.dumps(values, ensure_ascii=False).encode(), digest_size=16
+    ).hexdigest()
+
+
+def fetch_digests(csv_class: str, keys: list[str]) -> dict[str, str]:
+    """
+    Return {key: digest} of the stored rows.
+    """
+    digests = {}
+    for i in range(0, len(keys), FETCH_SIZE):
+        digests.update(RowDigest.objects.filter(
+            csv_class=csv_class, key__in=keys[i:i + FETCH_SIZE],
+        ).values_list('key', 'digest'))
+    return digests
+
+
+def store_digests(csv_class: str, digests: dict[str, str]) -> None:
+    """
+    Insert or update the digests of saved rows.
+    """
+    RowDigest.objects.bulk_create(
+        [
+            RowDigest(csv_class=csv_class, key=key, digest=digest)
+            for key, digest in digests.items()
+        ],
+        update_conflicts=True, unique_fields=['csv_class', 'key'],
+        update_fields=['digest', 'updated_at'],
+    )
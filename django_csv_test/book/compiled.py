@@ -0,0 +1,702 @@
+"""
+Row conversion functions built once per csv class.
+
+The library walks `_meta.columns` and resolves `column_*` methods, attribute
+paths and formatters for every cell. The functions here resolve them when
+they are built, so converting a row is a loop over prepared callables.
+"""
+import inspect
+import operator
+import re
+import weakref
+from datetime import date, datetime, timedelta
+from typing import Any, Callable, Optional
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db import models
+from django.utils import timezone
+
+from book.parts import freeze_static
+from book.profiling import CALLBACK, CLEAN, COLUMN, HOOK, PARSE, RESOLVE, Profile, phase
+from django_csv.model_csv import ValidationError, columns
+from django_csv.model_csv.csv.base import ErrorMessage, PartForRead, Row
+
+WRITE_PREFIX = 'column_'
+READ_PREFIX = 'field_'
+
+# `get_row_value(csv, instance) -> {w_index: str}`
+RowWriter = Callable[[Any, Any], dict[int, str]]
+# `get_row_value(row) -> {w_index: str}` for a tuple of `values_list()`.
+ValuesWriter = Callable[[tuple], dict[int, str]]
+# `get_rows(chunk) -> [[str]]` for a list of tuples of `values_list()`.
+ColumnsWriter = Callable[[list[tuple]], list[list[str]]]
+# `format_column(values) -> [str]`
+ColumnFormatter = Callable[[list], list[str]]
+# `read_from_row(csv, row, number, parsed=None) -> Row`
+RowReader = Callable[..., Row]
+# `parse_column(values) -> (values, {index: ValueError})`
+ColumnParser = Callable[[list], tuple[list, dict[int, ValueError]]]
+# `parse_chunk(rows) -> [(values, [(column, ValueError)])]`
+ChunkParser = Callable[[list[list]], list[tuple[dict, list]]]
+
+# the number of texts of a column remembered while parsing a chunk.
+COLUMN_MEMO_SIZE = 1024
+
+# the patterns `datetime.strptime()` uses for numeric directives.
+_DATETIME_PATTERNS = {
+    'Y': r'(?P<Y>\d\d\d\d)',
+    'm': r'(?P<m>1[0-2]|0[1-9]|[1-9])',
+    'd': r'(?P<d>3[0-1]|[1-2]\d|0[1-9]|[1-9]| [1-9])',
+    'H': r'(?P<H>2[0-3]|[0-1]\d|\d)',
+    'M': r'(?P<M>[0-5]\d|\d)',
+    'S': r'(?P<S>6[0-1]|[0-5]\d|\d)',
+}
+
+# {_meta: {(kind, is_relation): (layout, function)}}
+_cache = weakref.WeakKeyDictionary()
+
+
+def get_layout(meta) -> tuple:
+    """
+    Indexes of the columns. Functions are rebuilt if the layout changes.
+    """
+    return tuple(
+        (col.name, col.get_r_index(), col.get_w_index()) for col in meta.columns)
+
+
+def _get_cached(owner, kind: str, is_relation: bool, build: Callable):
+    cache = _cache.setdefault(owner._meta, {})
+    layout = get_layout(owner._meta)
+    cached = cache.get((kind, is_relation))
+    if cached is None or cached[0] != layout:
+        cached = cache[(kind, is_relation)] = (layout, build(owner, is_relation))
+    return cached[1]
+
+
+def get_row_writer(owner, is_relation: bool = False,
+                   profile: Optional[Profile] = None) -> RowWriter:
+    """
+    owner: a csv or a part.
+    profile: functions recording to `profile` are built every time.
+    """
+    if profile:
+        return compile_row_writer(owner, is_relation, profile)
+    return _get_cached(owner, 'write', is_relation, compile_row_writer)
+
+
+def get_row_reader(owner, is_relation: bool = False,
+                   profile: Optional[Profile] = None) -> RowReader:
+    """
+    owner: a csv or a part.
+    profile: functions recording to `profile` are built every time.
+    """
+    if profile:
+        return compile_row_reader(owner, is_relation, profile)
+    return _get_cached(owner, 'read', is_relation, compile_row_reader)
+
+
+def _get_method(owner, name: str) -> Callable | None:
+    """
+    Return a function which takes the csv as the first argument.
+    """
+    if not hasattr(owner, name):
+        return None
+
+    method = getattr(owner, name)
+    if inspect.ismethod(method) and not isinstance(method.__self__, type):
+        return method.__func__
+    return lambda csv, **kwargs: getattr(csv, name)(**kwargs)
+
+
+def _compile_getter(owner, column) -> Callable[[Any, Any], Any]:
+    if column.has_callback:
+        callback = column.callback
+        return lambda csv, instance: callback(
+            csv, instance=instance, static=csv._static.copy())
+
+    method = None if column.is_static else \
+        _get_method(owner, WRITE_PREFIX + column.method_suffix)
+    if method is not None:
+        return lambda csv, instance: method(
+            csv, instance=instance, static=csv._static.copy())
+
+    if isinstance(column, columns.AttributeColumn) and '__' not in column.attr_name:
+        getter = operator.attrgetter(column.attr_name)
+        return lambda csv, instance: getter(instance)
+
+    get_value = column.get_value_for_write
+    return lambda csv, instance: get_value(instance=instance)
+
+
+def _compile_formatter(meta, to: Any) -> Callable[[Any], str]:
+    """
+    Specialized `meta.convert_to_str(value, to=to)`.
+    """
+    if not meta.auto_convert or to == str:
+        return str
+
+    default_if_none = meta.default_if_none
+    if to == bool:
+        show_true, show_false = meta.show_true, meta.show_false
+
+        def convert(value: Any) -> str:
+            return show_true if value else show_false
+
+    elif to == datetime:
+        tzinfo, datetime_format = meta.tzinfo, meta.datetime_format
+
+        def convert(value: Any) -> str:
+            if not isinstance(value, datetime):
+                raise ValueError(f'`{value}` is not a datetime instance')
+            if tzinfo:
+                value = value.astimezone(tzinfo)
+            return value.strftime(datetime_format)
+
+    elif to == date:
+        date_format = meta.date_format
+
+        def convert(value: Any) -> str:
+            if not isinstance(value, date):
+                raise ValueError(f'`{value}` is not a date instance')
+            return value.strftime(date_format)
+
+    else:
+        convert = str
+
+    def format_value(value: Any) -> str:
+        if isinstance(value, str):
+            return str(value)
+        if value is None:
+            return default_if_none
+        return convert(value)
+
+    return format_value
+
+
+def _compile_cell_writer(owner, column, profile: Optional[Profile] = None
+                         ) -> Callable[[Any, Any], str]:
+    get_value = _compile_getter(owner, column)
+    format_value = _compile_formatter(owner._meta, column.to)
+    if not profile:
+        return lambda csv, instance: format_value(get_value(csv, instance))
+
+    if column.has_callback:
+        get_value = profile.wrap(HOOK, column.callback.__qualname__, get_value)
+    elif not column.is_static and hasattr(owner, WRITE_PREFIX + column.method_suffix):
+        method = getattr(type(owner), WRITE_PREFIX + column.method_suffix)
+        get_value = profile.wrap(HOOK, method.__qualname__, get_value)
+    return profile.wrap(
+        COLUMN, column.name,
+        lambda csv, instance: format_value(get_value(csv, instance)))
+
+
+def compile_row_writer(owner, is_relation: bool = False,
+                       profile: Optional[Profile] = None) -> RowWriter:
+    """
+    Build `RowForWrite.get_row_value()` for the class of `owner`.
+    """
+    meta = owner._meta
+    cells = [
+        (col.get_w_index(), _compile_cell_writer(owner, col, profile))
+        for col in meta.get_columns(for_write=True, is_relation=is_relation)
+    ]
+    parts = [
+        (part, part.related_name, part.model,
+         get_row_writer(part, is_relation=True, profile=profile))
+        for part in meta.parts
+    ]
+
+    def get_row_value(csv, instance) -> dict[int, str]:
+        row = {index: write_cell(csv, instance) for index, write_cell in cells}
+        for part, related_name, model, get_part_value in parts:
+            related = getattr(instance, related_name)
+            if not isinstance(related, model):
+                raise ValueError(f'Wrong field name. `{related_name}` is not '
+                                 f'{model.__class__.__name__}.')
+            row |= get_part_value(part, related)
+        return row
+
+    return get_row_value
+
+
+def get_values_writer(owner) -> Optional[tuple[list[str], ValuesWriter]]:
+    """
+    owner: a csv class or a csv.
+    """
+    return _get_cached(owner, 'values', False, compile_values_writer)
+
+
+def _get_field_path(model: type[models.Model], path: str) -> Optional[str]:
+    """
+    Return `path` if it ends with a concrete field reached by non null
+    forward relations. The value of `values_list()` is the same as the
+    attribute of an instance then.
+    """
+    *relations, name = path.split('__')
+    try:
+        for relation in relations:
+            field = model._meta.get_field(relation)
+            if not (field.many_to_one or field.one_to_one) or \
+                    not field.concrete or field.null:
+                return None
+            model = field.related_model
+
+        field = model._meta.get_field(name)
+    except FieldDoesNotExist:
+        return None
+
+    if not field.concrete or field.is_relation:
+        return None
+    return path
+
+
+def _get_values_path(owner, column, prefix: str) -> Optional[str]:
+    if not isinstance(column, columns.AttributeColumn) or column.has_callback \
+            or hasattr(owner, WRITE_PREFIX + column.method_suffix):
+        return None
+    return _get_field_path(owner._meta.model, column.attr_name) and \
+        prefix + column.attr_name
+
+
+def _get_values_cells(owner) -> Optional[tuple[list[str], list[tuple]]]:
+    """
+    Return fields for `values_list()` and (w_index, meta, to) of each field,
+    or None if any column needs an instance.
+    """
+    meta = owner._meta
+    targets = [
+        (owner, col, '') for col in meta.get_columns(for_write=True, is_relation=False)]
+    for part in meta.parts:
+        if part._meta.parts or \
+                not _get_field_path(
+                    meta.model, f'{part.related_name}__{part.model._meta.pk.name}'):
+            return None
+        targets += [
+            (part, col, part.related_name + '__')
+            for col in part._meta.get_columns(for_write=True, is_relation=True)
+        ]
+
+    paths, cells = [], []
+    for target, col, prefix in targets:
+        if (path := _get_values_path(target, col, prefix)) is None:
+            return None
+        paths.append(path)
+        cells.append((col.get_w_index(), target._meta, col.to))
+    return paths, cells
+
+
+def compile_values_writer(owner, is_relation: bool = False
+                          ) -> Optional[tuple[list[str], ValuesWriter]]:
+    """
+    Return fields for `values_list()` and a function converting its tuples
+    to rows. Return None if any column needs an instance, e.g. MethodColumn,
+    `column_*` methods, properties or nullable relations.
+    """
+    if (values := _get_values_cells(owner)) is None:
+        return None
+
+    paths, cells = values
+    cells = [(index, _compile_formatter(meta, to)) for index, meta, to in cells]
+
+    def get_row_value(row: tuple) -> dict[int, str]:
+        return {
+            index: format_value(value)
+            for (index, format_value), value in zip(cells, row)
+        }
+
+    return paths, get_row_value
+
+
+def get_columns_writer(owner) -> Optional[tuple[list[str], ColumnsWriter]]:
+    """
+    owner: a csv class or a csv.
+    """
+    return _get_cached(owner, 'columns', False, compile_columns_writer)
+
+
+def _compile_datetime_column(meta, format_value: Callable[[Any], str]
+                             ) -> ColumnFormatter:
+    """
+    Aware datetimes in the same second have the same text unless the format
+    shows microseconds, so a run of them, e.g. `created_at` of books created
+    by `bulk_create()`, is formatted once.
+    """
+    if not meta.tzinfo or '%f' in meta.datetime_format:
+        return lambda values: [format_value(value) for value in values]
+
+    one_second = timedelta(seconds=1)
+
+    def format_column(values: list) -> list[str]:
+        texts = []
+        start = end = text = None
+        for value in values:
+            if start is not None and isinstance(value, datetime) \
+                    and value.tzinfo is not None and start <= value < end:
+                texts.append(text)
+                continue
+
+            text = format_value(value)
+            texts.append(text)
+            if isinstance(value, datetime) and value.tzinfo is not None:
+                start = value.replace(microsecond=0)
+                end = start + one_second
+            else:
+                start = None
+        return texts
+
+    return format_column
+
+
+def _compile_column_formatter(meta, to: Any) -> ColumnFormatter:
+    """
+    Column version of `_compile_formatter()`.
+    """
+    format_value = _compile_formatter(meta, to)
+    if format_value is str:
+        return lambda values: list(map(str, values))
+
+    default_if_none = meta.default_if_none
+    if to == bool:
+        texts = {True: meta.show_true, False: meta.show_false, None: default_if_none}
+        return lambda values: [
+            texts[value] if value in texts else format_value(value) for value in values]
+
+    if to == datetime:
+        return _compile_datetime_column(meta, format_value)
+
+    if to == date:
+        def format_column(values: list) -> list[str]:
+            texts = {}
+            return [
+                texts[value] if value in texts else
+                texts.setdefault(value, format_value(value))
+                for value in values
+            ]
+
+        return format_column
+
+    return lambda values: [
+        default_if_none if value is None else str(value) for value in values]
+
+
+def compile_columns_writer(owner, is_relation: bool = False
+                           ) -> Optional[tuple[list[str], ColumnsWriter]]:
+    """
+    Column version of `compile_values_writer()`. A chunk of tuples is
+    transposed to columns, each column is formatted by one call and the
+    columns are transposed back to rows. Rows are the same as
+    `render_row()` of `compile_values_writer()` rows.
+    """
+    if (values := _get_values_cells(owner)) is None:
+        return None
+
+    paths, cells = values
+    formatters = {index: _compile_column_formatter(meta, to) for index, meta, to in cells}
+    indexes = [index for index, _, _ in cells]
+    if owner._meta.insert_blank_column:
+        positions = list(range(max(indexes) + 1))
+    else:
+        positions = sorted(indexes)
+
+    def get_rows(chunk: list[tuple]) -> list[list[str]]:
+        if not chunk:
+            return []
+
+        texts = {
+            index: formatters[index](list(column))
+            for index, column in zip(indexes, zip(*chunk))
+        }
+        blank = [''] * len(chunk)
+        return [list(row) for row in zip(*[texts.get(i, blank) for i in positions])]
+
+    return paths, get_rows
+
+
+def _compile_datetime_pattern(datetime_format: str) -> Optional[re.Pattern]:
+    """
+    The regex `datetime.strptime()` matches with `datetime_format`, or None
+    if the format has other directives than %Y, %m, %d, %H, %M and %S or
+    lacks any of %Y, %m and %d.
+    """
+    texts = re.split(r'%(.)', datetime_format)
+    directives = texts[1::2]
+    if not set(directives) <= _DATETIME_PATTERNS.keys() \
+            or len(set(directives)) != len(directives) \
+            or not {'Y', 'm', 'd'} <= set(directives) \
+            or any('%' in text for text in texts[::2]):
+        return None
+
+    pattern = ''
+    for i, text in enumerate(texts):
+        if i % 2:
+            pattern += _DATETIME_PATTERNS[text]
+        else:
+            pattern += r'\s+'.join(re.escape(word) for word in re.split(r'\s+', text))
+    return re.compile(pattern, re.IGNORECASE)
+
+
+def _compile_parser(meta, to: Any, column_index: int) -> Callable[[Any], Any]:
+    """
+    Specialized `meta.convert_from_str(value, to=to, column_index=...)`.
+    """
+    if not meta.auto_convert or to == str:
+        return lambda value: value
+
+    empty = (meta.default_if_none, '')
+    return_none = meta.return_none_if_convert_fail
+    if to in (int, float):
+        def convert(value: str) -> Any:
+            if value in empty:
+                return None
+            try:
+                return to(value)
+            except ValueError:
+                if return_none:
+                    return None
+                raise
+
+    elif to == bool:
+        as_true, as_false = meta.as_true, meta.as_false
+
+        def convert(value: str) -> Any:
+            if value in as_true:
+                return True
+            if value in as_false:
+                return False
+            if return_none:
+                return None
+            raise ValueError(f'`{value}` is not in both `as_true` and `as_false`')
+
+    elif to in (date, datetime) and \
+            (pattern := _compile_datetime_pattern(meta.datetime_format)):
+        tzinfo = meta.tzinfo
+
+        def convert(value: str) -> Any:
+            # texts the pattern doesn't match and invalid dates take the way
+            # of the library, which also raises its errors.
+            if (found := pattern.match(value)) and found.end() == len(value):
+                fields = found.groupdict()
+                try:
+                    parsed = datetime(
+                        int(fields['Y']), int(fields['m']), int(fields['d']),
+                        int(fields.get('H') or 0), int(fields.get('M') or 0),
+                        int(fields.get('S') or 0))
+                except ValueError:
+                    pass
+                else:
+                    return timezone.make_aware(parsed, tzinfo) if tzinfo else parsed
+            return meta.convert_from_str(value, to=to, column_index=column_index)
+
+    else:
+        def convert(value: str) -> Any:
+            return meta.convert_from_str(value, to=to, column_index=column_index)
+
+    def parse(value: Any) -> Any:
+        return convert(value) if isinstance(value, str) else value
+
+    return parse
+
+
+def _compile_column_parser(meta, to: Any, column_index: int) -> ColumnParser:
+    """
+    Column version of `_compile_parser()`. Values which fail are kept as they
+    are and returned with their ValueErrors. Up to COLUMN_MEMO_SIZE texts
+    are parsed once per call.
+    """
+    parse = _compile_parser(meta, to, column_index)
+    if not meta.auto_convert or to == str:
+        return lambda values: (list(values), {})
+
+    def parse_column(values: list) -> tuple[list, dict[int, ValueError]]:
+        parsed, errors, memo = [], {}, {}
+        for i, value in enumerate(values):
+            if type(value) is str and value in memo:
+                parsed.append(memo[value])
+                continue
+
+            try:
+                result = parse(value)
+            except ValueError as e:
+                errors[i] = e
+                parsed.append(value)
+                continue
+
+            if type(value) is str and len(memo) < COLUMN_MEMO_SIZE:
+                memo[value] = result
+            parsed.append(result)
+        return parsed, errors
+
+    return parse_column
+
+
+def _compile_cell_reader(column) -> Callable[[list], Any]:
+    if type(column).get_value_for_read is columns.BaseColumn.get_value_for_read:
+        return operator.itemgetter(column.r_index)
+
+    get_value = column.get_value_for_read
+    return lambda row: get_value(row=row)
+
+
+def get_chunk_parser(owner) -> ChunkParser:
+    """
+    owner: a csv class or a csv.
+    """
+    return _get_cached(owner, 'chunk', False, compile_chunk_parser)
+
+
+def compile_chunk_parser(owner, is_relation: bool = False) -> ChunkParser:
+    """
+    Parse the cells of a chunk of rows column by column. Each row gets the
+    `parsed` argument of `read_from_row()`: its values and
+    [(column, ValueError)] of the cells which failed. `read_from_row()`
+    raises the first of them when it reads the row.
+    """
+    meta = owner._meta
+    cells = [
+        (col, _compile_cell_reader(col), _compile_column_parser(meta, col.to, col.r_index))
+        for col in meta.get_columns(for_read=True, is_relation=is_relation)
+    ]
+
+    def parse_chunk(rows: list[list]) -> list[tuple[dict, list]]:
+        parsed = [({}, []) for _ in rows]
+        for col, get_value, parse_column in cells:
+            values, errors = parse_column([get_value(row) for row in rows])
+            for (row_values, _), value in zip(parsed, values):
+                row_values[col.value_name] = value
+            for i, error in errors.items():
+                parsed[i][1].append((col, error))
+        return parsed
+
+    return parse_chunk
+
+
+def compile_row_reader(owner, is_relation: bool = False,
+                       profile: Optional[Profile] = None) -> RowReader:
+    """
+    Build `ModelRowForRead.read_from_row()` for the class of `owner`.
+    `field_*` methods are called in the same order as the library, and
+    a cell which fails to convert raises its ValueError as the library does.
+    """
+    meta = owner._meta
+    cells = []
+    for col in meta.get_columns(for_read=True, is_relation=is_relation):
+        get_value = _compile_cell_reader(col)
+        parse = _compile_parser(meta, col.to, col.r_index)
+        if profile:
+            parse = profile.wrap(COLUMN, col.name, parse)
+        cells.append((col, get_value, parse))
+
+    methods = []
+    for name, _ in inspect.getmembers(owner, predicate=inspect.ismethod):
+        if not name.startswith(READ_PREFIX):
+            continue
+        method = _get_method(owner, name)
+        if profile:
+            method = profile.wrap(HOOK, getattr(type(owner), name).__qualname__, method)
+        methods.append((name[len(READ_PREFIX):], method))
+
+    parts = [
+        (part.related_name, _get_part_indexes(part), compile_part_reader(part, profile))
+        for part in meta.parts
+    ]
+
+    def read_from_row(csv, row: list, number: int,
+                      parsed: Optional[tuple[dict, list]] = None) -> Row:
+        """
+        parsed: values and conversion errors of `row` by `compile_chunk_parser`.
+        """
+        if parsed is None:
+            with phase(profile, PARSE):
+                values = {
+                    col.value_name: parse(get_value(row)) for col, get_value, parse in cells}
+        else:
+            values, failures = parsed
+            if failures:
+                raise failures[0][1]
+
+        updated = values.copy()
+        errors = []
+        with phase(profile, CLEAN):
+            for value_name, method in methods:
+                try:
+                    updated[value_name] = method(
+                        csv, values=values.copy(), static=csv._static.copy())
+                except ValidationError as e:
+                    errors.append(ErrorMessage(
+                        message=str(e), name=csv.error_name_prefix + value_name,
+                        row_number=number, label=e.label, column_index=e.column_index
+                    ))
+
+        row_model = Row(number=number, errors=errors, values=updated)
+        # parts of a part are cached with the part.
+        cache = None if is_relation else getattr(csv, 'part_cache', None)
+        static = freeze_static(csv._static) if cache else None
+        for related_name, indexes, get_instance in parts:
+            if cache is None:
+                row_model += get_instance(row, number, csv._static.copy())
+                continue
+
+            key = (related_name, tuple(row[i] for i in indexes), static)
+            row_model += cache.get(
+                key, number,
+                lambda: get_instance(row, number, csv._static.copy()))
+        return row_model
+
+    return read_from_row
+
+
+def _get_part_indexes(part) -> list[int]:
+    """
+    Indexes of the cells read by `part` and its parts.
+    """
+    indexes = [
+        col.get_r_index()
+        for col in part._meta.get_columns(for_read=True, is_relation=True)
+    ]
+    for child in part._meta.parts:
+        indexes += _get_part_indexes(child)
+    return indexes
+
+
+def compile_part_reader(part, profile: Optional[Profile] = None
+                        ) -> Callable[[list, int, dict], Row]:
+    """
+    Build `PartForRead.get_instance()` of `part` with its compiled
+    `read_from_row()`.
+    """
+    if type(part).get_instance is not PartForRead.get_instance:
+        return lambda row, number, static: part.get_instance(
+            row=row, number=number, static=static)
+
+    read_from_row = get_row_reader(part, is_relation=True, profile=profile)
+    callback, related_name = part._callback, part.related_name
+    if profile:
+        callback = profile.wrap(CALLBACK, related_name, callback)
+
+    def get_instance(row: list, number: int, static: dict) -> Row:
+        part._static = static.copy()  # inject static from main csv.
+        rw = read_from_row(part, row, number)
+        if rw.is_valid:
+            try:
+                rw.update(part.field(values=rw.values))
+            except ValidationError as e:
+                rw.append_error(
+                    exception=e, name=part.error_name_prefix + 'field_method',
+                    row_number=number
+                )
+
+        if rw.is_valid:
+            with phase(profile, RESOLVE):
+                try:
+                    rw[related_name] = callback(
+                        values=rw.values.copy(), static=part._static.copy())
+                except ValidationError as e:
+                    rw.append_error(
+                        exception=e, name=part.error_name_prefix + 'callback',
+                        row_number=number
+                    )
+
+        rw.clean(exclude=[related_name])
+        return rw
+
+    return get_instance
@@ -0,0 +1,149 @@
+"""
+Compressed uploads and exports.
+
+Uploads are recognized by their magic bytes, not by their names, and are
+decompressed as they are read, so the readers never see the compressed
+bytes and the decompressed file is never held in memory. Exports are
+compressed chunk by chunk as they are written. zstd needs the `zstandard`
+package.
+"""
+import bz2
+import gzip
+import io
+import lzma
+import re
+import zlib
+from typing import AsyncIterable, AsyncIterator, BinaryIO, Iterable, Iterator, Optional
+
+GZIP = 'gzip'
+BZIP2 = 'bz2'
+XZ = 'xz'
+ZSTD = 'zstd'
+
+MAGIC_BYTES = {
+    GZIP: re.compile(rb'\x1f\x8b\x08'),
+    # "BZh", the block size and the magic of a block or of the end.
+    BZIP2: re.compile(rb'BZh[1-9](\x31\x41\x59\x26\x53\x59|\x17\x72\x45\x38\x50\x90)'),
+    XZ: re.compile(rb'\xfd7zXZ\x00'),
+    ZSTD: re.compile(rb'\x28\xb5\x2f\xfd'),
+}
+# the number of bytes read to detect a compression.
+MAGIC_SIZE = 10
+
+EXTENSIONS = {GZIP: 'gz', BZIP2: 'bz2', XZ: 'xz', ZSTD: 'zst'}
+CONTENT_TYPES = {
+    GZIP: 'application/gzip',
+    BZIP2: 'application/x-bzip2',
+    XZ: 'application/x-xz',
+    ZSTD: 'application/zstd',
+}
+
+
+def _get_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError('zstd needs the `zstandard` package') from None
+    return zstandard
+
+
+def get_methods() -> list[str]:
+    """
+    Compressions available in this environment.
+    """
+    methods = [GZIP, BZIP2, XZ]
+    try:
+        _get_zstandard()
+    except ValueError:
+        return methods
+    return methods + [ZSTD]
+
+
+def detect(file: BinaryIO) -> Optional[str]:
+    """
+    The compression of `file` from its first bytes. The position of `file`
+    is restored.
+    """
+    position = file.tell()
+    head = file.read(MAGIC_SIZE)
+    file.seek(position)
+    for method, magic in MAGIC_BYTES.items():
+        if magic.match(head):
+            return method
+    return None
+
+
+def open_decompressed(file: BinaryIO) -> BinaryIO:
+    """
+    Return `file` if it is not compressed. Otherwise return a file object
+    which decompresses `file` as it is read. Closing it doesn't close
+    `file`.
+    """
+    method = detect(file)
+    if method is None:
+        return file
+    if method == GZIP:
+        return gzip.GzipFile(fileobj=file, mode='rb')
+    if method == BZIP2:
+        return bz2.BZ2File(file, mode='rb')
+    if method == XZ:
+        return lzma.LZMAFile(file, mode='rb')
+    # buffered for `readline()`.
+    return io.BufferedReader(
+        _get_zstandard().ZstdDecompressor().stream_reader(file, closefd=False))
+
+
+def strip_extension(filename: str) -> str:
+    """
+    `book.csv.gz` -> `book.csv`
+    """
+    for extension in EXTENSIONS.values():
+        if filename.lower().endswith(f'.{extension}'):
+            return filename[:-len(extension) - 1]
+    return filename
+
+
+def get_filename(filename: str, method: str) -> str:
+    """
+    `book.csv` -> `book.csv.gz`
+    """
+    return f'{filename}.{EXTENSIONS[method]}'
+
+
+def get_compressor(method: str):
+    """
+    An object with `compress(data)` and `flush()` as `zlib.compressobj()`.
+    """
+    if method == GZIP:
+        # wbits=31 writes the gzip header and trailer.
+        return zlib.compressobj(wbits=31)
+    if method == BZIP2:
+        return bz2.BZ2Compressor()
+    if method == XZ:
+        return lzma.LZMACompressor()
+    if method == ZSTD:
+        return _get_zstandard().ZstdCompressor().compressobj()
+    raise ValueError(f'`{method}` is not supported')
+
+
+def compress(chunks: Iterable[bytes], method: str) -> Iterator[bytes]:
+    """
+    Compress `chunks` one by one. Compressed bytes are yielded as soon as the
+    compressor returns them.
+    """
+    compressor = get_compressor(method)
+    for chunk in chunks:
+        if data := compressor.compress(chunk):
+            yield data
+    yield compressor.flush()
+
+
+async def acompress(chunks: AsyncIterable[bytes], method: str) -> AsyncIterator[bytes]:
+    """
+    Async version of `compress()`.
+    """
+    compressor = get_compressor(method)
+    async for chunk in chunks:
+        if data := compressor.compress(chunk):
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,108 @@
+"""
+XLSX writer and reader which never hold a whole workbook in memory.
+
+StreamingXlsxWriter uses a `write_only` workbook, so rows are written to a
+temporary file as they come, e.g. from `StreamingMixin.iter_table()`, and
+the saved workbook is streamed from a temporary file.
+ReadOnlyXlsxReader opens the workbook with `read_only=True` and yields rows
+from `iter_rows(values_only=True)`.
+"""
+import tempfile
+from datetime import datetime
+from typing import Any, Iterable, Iterator, Optional
+
+from django.http import FileResponse
+
+from django_csv.model_csv.readers import ExcelBase
+from django_csv.model_csv.writers import ExcelMixin, Writer
+
+
+class StreamingXlsxWriter(ExcelMixin, Writer):
+    extension = 'xlsx'
+
+    def __init__(self, *args, **kwargs):
+        from openpyxl import Workbook
+        self.wb = Workbook(write_only=True)
+        super().__init__(*args, **kwargs)
+
+    def get_sheet_names(self) -> list:
+        return self.wb.sheetnames
+
+    def write_down(self, table: Iterable[list], sheet_name: Optional[str] = None
+                   ) -> None:
+        """
+        write down to work sheet. `table` may be a generator.
+        """
+        if sheet_name is None:
+            sheet_name = self._get_next_sheet_name()
+
+        ws = self.wb.create_sheet(sheet_name)
+        for row in table:
+            ws.append(row)
+
+    def make_response(self, **kwargs) -> FileResponse:
+        """
+        Save the workbook to a temporary file and stream it. The file is
+        deleted when the response is closed.
+        """
+        file = tempfile.TemporaryFile()
+        self.wb.save(file)
+        file.seek(0)
+        return FileResponse(file, as_attachment=True, filename=self.filename,
+                            content_type=self.content_type)
+
+
+def get_cell_value(value: Any, date_format: str, datetime_format: str) -> str:
+    """
+    Same as the values of `XlsxReader.get_table()`.
+    """
+    if value is None:
+        return ''
+
+    if isinstance(value, str):
+        return value
+
+    if isinstance(value, (int, float)):
+        value = str(value)
+        if value.endswith('.0'):
+            value = value[:-2]
+        return value
+
+    if isinstance(value, datetime):
+        if not any([value.hour, value.minute, value.microsecond]):
+            return value.date().strftime(date_format)
+        return value.strftime(datetime_format)
+    return str(value)
+
+
+class ReadOnlyXlsxReader(ExcelBase):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        from openpyxl import load_workbook
+        self.wb = load_workbook(self.file, read_only=True, data_only=True)
+
+    def iter_table(self, sheet_index: int = 0,
+                   table_starts_from: Optional[int] = None) -> Iterator[list]:
+        """
+        Yield rows one by one. The workbook is closed at the end.
+        """
+        table_starts_from = self.table_starts_from \
+            if table_starts_from is None else table_starts_from
+        sheet = self.wb.worksheets[sheet_index]
+
+        try:
+            for row in sheet.iter_rows(min_row=table_starts_from + 1,
+                                       values_only=True):
+                yield [
+                    get_cell_value(value, self.date_format, self.datetime_format)
+                    for value in row
+                ]
+        finally:
+            self.wb.close()
+
+    def get_table(self, sheet_index: int = 0,
+                  table_starts_from: Optional[int] = None) -> list:
+        return list(self.iter_table(sheet_index, table_starts_from))
+
+    def get_sheet_names(self) -> list:
+        return self.wb.sheetnames
@@ -0,0 +1,369 @@
+"""
+Import uploads outside of the request.
+
+The admin stores an upload as ImportJob and passes it to the executor set in
+`settings.CSV_IMPORT_EXECUTOR`. The request returns immediately and the job
+page shows the progress and the row errors.
+
+The import of a job runs in one transaction, so a job never saves a part of
+a file. While the transaction is open, the progress is shared through the
+cache framework. `manage.py run_import_jobs` of DatabaseJobExecutor refuses
+a cache backend local to the process.
+
+A resumable job commits chunk by chunk instead and records the saved rows in
+ImportCheckpoint, so that a job of the same file can skip them after the
+previous job died. Its progress is saved in ImportJob with each chunk.
+
+A job beats `heartbeat_at` when it is claimed and when a resumable job
+commits a chunk. `reap_stale_jobs()` fails running jobs which have not beaten
+in CSV_IMPORT_JOB_TIMEOUT seconds, e.g. after their worker was killed.
+"""
+import dataclasses
+import hashlib
+import io
+import itertools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import BinaryIO, Iterable, Iterator, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from book import compression
+from book.models import ImportCheckpoint, ImportJob
+
+logger = logging.getLogger(__name__)
+
+# the number of errors saved in ImportJob.errors.
+MAX_ERRORS = 1000
+# the number of bytes hashed at a time.
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def get_progress_key(job_id: int) -> str:
+    return f'book:import_job:{job_id}:progress'
+
+
+def get_progress(job: ImportJob) -> int:
+    if job.is_finished or job.resumable:
+        return job.processed_rows
+    return cache.get(get_progress_key(job.pk), job.processed_rows)
+
+
+def claim_job(job_id: int) -> bool:
+    """
+    Set RUNNING to a pending job. Return False if another worker took it.
+    """
+    return bool(ImportJob.objects.filter(
+        pk=job_id, status=ImportJob.Status.PENDING,
+    ).update(status=ImportJob.Status.RUNNING, heartbeat_at=timezone.now()))
+
+
+def beat(job: ImportJob) -> None:
+    """
+    Save the heartbeat and the progress of a running job. Raise RuntimeError
+    if the job has been reaped.
+    """
+    job.heartbeat_at = timezone.now()
+    if not ImportJob.objects.filter(pk=job.pk, status=ImportJob.Status.RUNNING).update(
+            heartbeat_at=job.heartbeat_at, processed_rows=job.processed_rows):
+        raise RuntimeError('The import is stopped as its worker stopped responding.')
+
+
+def reap_stale_jobs() -> int:
+    """
+    Fail running jobs which have not beaten in CSV_IMPORT_JOB_TIMEOUT
+    seconds, and return the number of them.
+    """
+    expired_at = timezone.now() - timedelta(seconds=settings.CSV_IMPORT_JOB_TIMEOUT)
+    return ImportJob.objects.filter(
+        status=ImportJob.Status.RUNNING, heartbeat_at__lt=expired_at,
+    ).update(
+        status=ImportJob.Status.FAILED,
+        message='The worker of the import stopped responding.',
+        updated_at=timezone.now(),
+    )
+
+
+def run_job(job_id: int) -> None:
+    if not claim_job(job_id):
+        return
+
+    job = ImportJob.objects.get(pk=job_id)
+    try:
+        import_file(job)
+    except Exception as e:
+        logger.exception('import job %s failed', job.pk)
+        job.status = ImportJob.Status.FAILED
+        job.message = f'{e.__class__.__name__}: {e}'
+    finally:
+        cache.delete(get_progress_key(job.pk))
+        # e.g. SystemExit of a worker which is shut down.
+        if job.status == ImportJob.Status.RUNNING:
+            job.status = ImportJob.Status.FAILED
+            job.message = 'The import is interrupted.'
+        job.save(update_fields=[
+            'status', 'processed_rows', 'errors', 'message', 'updated_at'])
+
+
+def iter_rows(reader_class: type, file) -> Iterator[list]:
+    """
+    Readers having `iter_table()` read `file` row by row. The others read
+    the whole file at once.
+    """
+    if hasattr(reader_class, 'iter_table'):
+        return iter(reader_class(file=file).iter_table())
+    return iter(reader_class(file=io.BytesIO(file.read())).get_table())
+
+
+def hash_file(file: BinaryIO) -> str:
+    """
+    sha256 of `file` from its head. The file is read back to the head.
+    """
+    file.seek(0)
+    digest = hashlib.sha256()
+    while chunk := file.read(HASH_CHUNK_SIZE):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def iter_rows_from(reader_class: type, file, row_number: int = 0,
+                   offset: Optional[int] = None
+                   ) -> tuple[list, Iterator[tuple[Optional[int], list]]]:
+    """
+    Return the headers and (offset, row) of the rows after the first
+    `row_number` rows. Readers having `iter_table_with_offsets()` skip to
+    `offset` if it is given. The others read and drop the rows, and their
+    offsets are None.
+    """
+    if hasattr(reader_class, 'iter_table_with_offsets'):
+        rows = reader_class(file=file).iter_table_with_offsets(resume_from=offset or 0)
+        headers = next(rows, (None, []))[1]
+        if offset is not None:
+            return headers, rows
+    else:
+        rows = ((None, row) for row in iter_rows(reader_class, file))
+        headers = next(rows, (None, []))[1]
+
+    return headers, itertools.islice(rows, row_number, None)
+
+
+class RowCursor:
+    """
+    Iterate rows of (offset, row) and keep the number and the offset of the
+    rows taken so far.
+    """
+    def __init__(self, rows: Iterable[tuple[Optional[int], list]],
+                 row_number: int = 0, offset: Optional[int] = None):
+        self.rows = rows
+        self.row_number = row_number
+        self.offset = offset
+
+    def __iter__(self) -> Iterator[list]:
+        for self.offset, row in self.rows:
+            self.row_number += 1
+            yield row
+
+
+def check_headers(job: ImportJob, csv_class, headers: list) -> bool:
+    expected_headers = csv_class._meta.get_headers(for_read=True)
+    if headers != expected_headers:
+        job.status = ImportJob.Status.FAILED
+        job.message = f'Column order must be {expected_headers}. Not {headers}'
+        return False
+    return True
+
+
+def import_file(job: ImportJob) -> None:
+    """
+    Validate and save the file of `job` chunk by chunk. Rows are saved only
+    if all rows are valid. A compressed file is decompressed as it is read.
+    """
+    if job.resumable:
+        return import_file_resumable(job)
+
+    csv_class = import_string(job.csv_class)
+    reader_class = import_string(job.reader_class)
+
+    with job.file.open('rb') as raw, compression.open_decompressed(raw) as f:
+        rows = iter_rows(reader_class, f)
+        headers = next(rows, [])
+        if not check_headers(job, csv_class, headers):
+            return
+
+        errors = []
+        with transaction.atomic():
+            for mcsv in csv_class.for_read_chunks(
+                    rows=rows, chunk_size=settings.CSV_IMPORT_CHUNK_SIZE,
+                    static=job.static):
+                if mcsv.is_valid():
+                    if not errors:
+                        mcsv.bulk_save(update_conflicts=job.update_existing)
+                else:
+                    errors += mcsv.errors
+
+                job.processed_rows += len(mcsv.cleaned_rows)
+                cache.set(get_progress_key(job.pk), job.processed_rows)
+
+            if errors:
+                transaction.set_rollback(True)
+
+    job.errors = [dataclasses.asdict(error) for error in errors[:MAX_ERRORS]]
+    if errors:
+        job.status = ImportJob.Status.FAILED
+        job.message = f'{len(errors)} errors are found. No rows are saved.'
+    else:
+        job.status = ImportJob.Status.SUCCEEDED
+        job.message = f'{job.processed_rows} rows are saved.'
+
+
+def claim_checkpoint(job: ImportJob, file_hash: str) -> Optional[ImportCheckpoint]:
+    """
+    Set `job` to the checkpoint of the file and return it. Return None if
+    another running job has updated it in CSV_IMPORT_CHECKPOINT_TIMEOUT
+    seconds. A running job of an older checkpoint is regarded as dead.
+    """
+    lookup = {'csv_class': job.csv_class, 'file_hash': file_hash}
+    ImportCheckpoint.objects.get_or_create(**lookup)
+    with transaction.atomic():
+        checkpoint = ImportCheckpoint.objects.select_for_update().get(**lookup)
+        owner = checkpoint.job
+        if owner is not None and owner.pk != job.pk \
+                and owner.status == ImportJob.Status.RUNNING:
+            expires_at = checkpoint.updated_at + timedelta(
+                seconds=settings.CSV_IMPORT_CHECKPOINT_TIMEOUT)
+            if expires_at > timezone.now():
+                return None
+            owner.status = ImportJob.Status.FAILED
+            owner.message = f'The import is taken over by job {job.pk}.'
+            owner.save(update_fields=['status', 'message', 'updated_at'])
+
+        checkpoint.job = job
+        checkpoint.save(update_fields=['job', 'updated_at'])
+    return checkpoint
+
+
+def import_file_resumable(job: ImportJob) -> None:
+    """
+    Validate and save the file of `job` in a transaction per chunk, which
+    also updates the ImportCheckpoint of the file. The import stops at the
+    first invalid chunk and the rows of the committed chunks stay saved.
+    A later job of the same bytes and csv class starts after the checkpoint,
+    and the checkpoint is deleted when the last row is saved. Only one job
+    imports a file at a time, see `claim_checkpoint()`.
+    """
+    csv_class = import_string(job.csv_class)
+    reader_class = import_string(job.reader_class)
+
+    with job.file.open('rb') as raw:
+        checkpoint = claim_checkpoint(job, hash_file(raw))
+        if checkpoint is None:
+            job.status = ImportJob.Status.FAILED
+            job.message = 'The same file is being imported by another job.'
+            return
+        resumed_from = checkpoint.row_number
+
+        with compression.open_decompressed(raw) as f:
+            headers, rows = iter_rows_from(
+                reader_class, f, checkpoint.row_number, checkpoint.offset)
+            if not check_headers(job, csv_class, headers):
+                return
+
+            cursor = RowCursor(rows, checkpoint.row_number, checkpoint.offset)
+            chunks = csv_class.for_read_chunks(
+                rows=cursor, chunk_size=settings.CSV_IMPORT_CHUNK_SIZE,
+                static=job.static, start=checkpoint.row_number)
+            job.processed_rows = checkpoint.row_number
+            errors = []
+            while True:
+                with transaction.atomic():
+                    owner = ImportCheckpoint.objects.select_for_update().filter(
+                        pk=checkpoint.pk).values_list('job', flat=True).first()
+                    if owner != job.pk:
+                        raise RuntimeError(f'The import is taken over by job {owner}.')
+
+                    # lookups of the validation are rolled back with the chunk.
+                    mcsv = next(chunks, None)
+                    if mcsv is None:
+                        break
+                    if not mcsv.is_valid():
+                        errors = mcsv.errors
+                        transaction.set_rollback(True)
+                        break
+
+                    mcsv.bulk_save(update_conflicts=job.update_existing)
+                    checkpoint.row_number = cursor.row_number
+                    checkpoint.offset = cursor.offset
+                    checkpoint.save(update_fields=['row_number', 'offset', 'updated_at'])
+                    job.processed_rows = checkpoint.row_number
+                    beat(job)
+
+    job.errors = [dataclasses.asdict(error) for error in errors[:MAX_ERRORS]]
+    resumed = f' Resumed after row {resumed_from}.' if resumed_from else ''
+    if errors:
+        job.status = ImportJob.Status.FAILED
+        job.message = (f'{len(errors)} errors are found. '
+                       f'{checkpoint.row_number} rows before them are saved.{resumed}')
+    else:
+        checkpoint.delete()
+        job.status = ImportJob.Status.SUCCEEDED
+        job.message = f'{job.processed_rows} rows are saved.{resumed}'
+
+
+class JobExecutor:
+    def submit(self, job: ImportJob) -> None:
+        raise NotImplementedError
+
+
+class ImmediateJobExecutor(JobExecutor):
+    """
+    Run a job in the request. Used in tests.
+    """
+    def submit(self, job: ImportJob) -> None:
+        run_job(job.pk)
+
+
+class ThreadPoolJobExecutor(JobExecutor):
+    """
+    Run jobs in threads of the web process. A job starts after the
+    transaction creating it is committed.
+    """
+    _pool: Optional[ThreadPoolExecutor] = None
+
+    @classmethod
+    def get_pool(cls) -> ThreadPoolExecutor:
+        if cls._pool is None:
+            cls._pool = ThreadPoolExecutor(
+                max_workers=settings.CSV_IMPORT_WORKERS,
+                thread_name_prefix='csv-import',
+            )
+        return cls._pool
+
+    def submit(self, job: ImportJob) -> None:
+        transaction.on_commit(
+            lambda: self.get_pool().submit(self._run, job.pk))
+
+    @staticmethod
+    def _run(job_id: int) -> None:
+        try:
+            run_job(job_id)
+        finally:
+            connection.close()
+
+
+class DatabaseJobExecutor(JobExecutor):
+    """
+    Leave pending jobs in the database. `manage.py run_import_jobs` polls
+    and runs them.
+    """
+    def submit(self, job: ImportJob) -> None:
+        pass
+
+
+def get_executor() -> JobExecutor:
+    return import_string(settings.CSV_IMPORT_EXECUTOR)()
@@ -0,0 +1,212 @@
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+from typing import Optional
+
+import django
+from django.contrib.auth import get_user_model
+from django.core.management import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+import django_csv
+from book.benchmarks import SCENARIOS, get_peak_rss, run_in_process, seed, write_files
+from book.mcsv import BookWithPublisherCsv
+from book.models import Book, ImportJob
+from django_csv.model_csv.utils import get_reader_class, get_writer_class
+
+CASES = ['write', 'read', 'upload']
+FORMATS = ['csv', 'tsv', 'xls', 'xlsx']
+# xlwt cannot write more rows to a sheet.
+XLS_MAX_ROWS = 65536
+
+
+def get_library_version() -> Optional[str]:
+    """
+    The commit of the django_csv checkout.
+    """
+    proc = subprocess.run(
+        ['git', '-C', os.path.dirname(django_csv.__file__), 'rev-parse', 'HEAD'],
+        capture_output=True, text=True,
+    )
+    return proc.stdout.strip() or None
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure rows/sec, peak RSS and the number of queries of export, '
+        'import and the admin upload view for each file format, and the '
+        'scenarios of `book.benchmarks`, and write the results as JSON. '
+        'Each case and each mode of a scenario runs in its own process.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--books', type=int, default=10_000)
+        parser.add_argument('--publishers', type=int, default=100)
+        parser.add_argument('--authors', type=int, default=1000)
+        parser.add_argument('--formats', nargs='+', choices=FORMATS, default=FORMATS)
+        parser.add_argument('--output', default='benchmark.json',
+                            help='the JSON file the results are written to.')
+        parser.add_argument('--scenarios', nargs='*', choices=list(SCENARIOS),
+                            default=list(SCENARIOS))
+        parser.add_argument('--case', choices=CASES, default=None,
+                            help='run a single case in this process.')
+        parser.add_argument('--format', choices=FORMATS, default=None)
+        parser.add_argument('--scenario', choices=list(SCENARIOS), default=None,
+                            help='run a single mode of the scenario in this process.')
+        parser.add_argument('--mode', default=None)
+        parser.add_argument('--data-dir', default=None,
+                            help='where exported files are kept for read cases.')
+
+    def handle(self, *args, books, publishers, authors, formats, scenarios, output,
+               case, format, scenario, mode, data_dir, **options):
+        if case:
+            result = self.run_case(case, format, books, data_dir)
+            self.stdout.write(json.dumps(result))
+            return
+        if scenario:
+            result = self.run_scenario(scenario, mode, books, data_dir)
+            self.stdout.write(json.dumps(result))
+            return
+
+        seed(books, publishers, authors, stdout=self.stdout)
+        if books > XLS_MAX_ROWS and 'xls' in formats:
+            self.stderr.write(f'skip xls: more than {XLS_MAX_ROWS} rows.')
+            formats = [fmt for fmt in formats if fmt != 'xls']
+
+        results = []
+        with tempfile.TemporaryDirectory() as tmp:
+            for fmt in formats:
+                # `write` keeps the file read by `read` and `upload`.
+                for case in CASES:
+                    result = run_in_process(
+                        'benchmark_suite', '--case', case, '--format', fmt,
+                        '--books', str(books), '--data-dir', tmp)
+                    results.append(result)
+                    self.stdout.write(
+                        f'{case:>6} {fmt:>4}: {result["rows"]} rows, '
+                        f'{result["rows_per_sec"]:.0f} rows/sec, '
+                        f'peak RSS {result["peak_rss_kib"] / 1024:.1f} MiB, '
+                        f'{result["queries"]} queries'
+                    )
+
+            if scenarios:
+                write_files(books, tmp)
+            for scenario in scenarios:
+                for mode in SCENARIOS[scenario][1]:
+                    result = run_in_process(
+                        'benchmark_suite', '--scenario', scenario, '--mode', mode,
+                        '--books', str(books), '--data-dir', tmp)
+                    results.append(result)
+                    self.stdout.write(
+                        f'{scenario:>13} {mode:>11}: {result["rows"]} rows, '
+                        f'{result["rows_per_sec"]:.0f} rows/sec, '
+                        f'peak RSS {result["peak_rss_kib"] / 1024:.1f} MiB'
+                    )
+
+        report = {
+            'library_version': get_library_version(),
+            'django': django.get_version(),
+            'python': platform.python_version(),
+            'database': connection.vendor,
+            'books': books,
+            'publishers': publishers,
+            'authors': authors,
+            'results': results,
+        }
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+        self.stdout.write(f'results are written to {output}')
+
+    def run_case(self, case: str, fmt: str, books: int, data_dir: str) -> dict:
+        result = {'case': case, 'format': fmt}
+        getattr(self, f'run_{case}')(
+            result, fmt, books, Path(data_dir) / f'book.{fmt}')
+        result['rows_per_sec'] = result['rows'] / result['seconds'] \
+            if result['seconds'] else 0
+        result['peak_rss_kib'] = get_peak_rss()
+        return result
+
+    @staticmethod
+    def run_scenario(scenario: str, mode: str, books: int, data_dir: str) -> dict:
+        func, modes = SCENARIOS[scenario]
+        if mode not in modes:
+            raise CommandError(f'`{scenario}` has modes {modes}. Not `{mode}`')
+
+        result = {'scenario': scenario, 'mode': mode, **func(mode, books, data_dir)}
+        result['rows_per_sec'] = result['rows'] / result['seconds'] \
+            if result['seconds'] else 0
+        result['peak_rss_kib'] = get_peak_rss()
+        return result
+
+    @staticmethod
+    @contextlib.contextmanager
+    def measure(result: dict):
+        """
+        Set `seconds` and `queries` of the block to `result`.
+        """
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            yield
+            result['seconds'] = time.perf_counter() - start
+        result['queries'] = len(queries)
+
+    def run_write(self, result: dict, fmt: str, books: int, path: Path) -> None:
+        """
+        for_write() and get_table() of the books, written by the writer.
+        """
+        with self.measure(result):
+            mcsv = BookWithPublisherCsv.for_write(
+                instances=Book.objects.order_by('id')[:books])
+            table = mcsv.get_table()
+            writer = get_writer_class(extension=fmt)(filename=path.name)
+            writer.write_down(table=table)
+            content = writer.make_response().content
+
+        path.write_bytes(content)
+        result['rows'] = len(table) - 1
+
+    def run_read(self, result: dict, fmt: str, books: int, path: Path) -> None:
+        """
+        for_read() and is_valid() of the file written by `write`.
+        """
+        with self.measure(result):
+            reader = get_reader_class(extension=fmt)(
+                file=io.BytesIO(path.read_bytes()))
+            mcsv = BookWithPublisherCsv.for_read(table=reader.get_table()[1:])
+            mcsv.set_static('only_exists', True)
+            mcsv.is_valid()
+        result['rows'] = len(mcsv.cleaned_rows)
+
+    def run_upload(self, result: dict, fmt: str, books: int, path: Path) -> None:
+        """
+        The admin upload view importing the file written by `write` in the
+        request. Changes are rolled back.
+        """
+        User = get_user_model()
+        user = User.objects.filter(is_superuser=True).first() or \
+            User.objects.create_superuser(username='benchmark')
+        client = Client()
+        client.force_login(user)
+
+        with override_settings(
+                ALLOWED_HOSTS=['testserver'], MEDIA_ROOT=str(path.parent),
+                CSV_IMPORT_EXECUTOR='book.jobs.ImmediateJobExecutor'), \
+                transaction.atomic():
+            with open(path, 'rb') as f, self.measure(result):
+                client.post(reverse('admin:book_book_upload_csv'),
+                            {'file': f, 'only_exists': True})
+
+            job = ImportJob.objects.latest('pk')
+            if job.status != ImportJob.Status.SUCCEEDED:
+                raise RuntimeError(f'upload failed: {job.message}')
+            transaction.set_rollback(True)
+        result['rows'] = job.processed_rows
@@ -1,13 +1,86 @@
+import itertools
 import random
+
+import factory
 from django.contrib.auth import get_user_model
 from django.core.management import BaseCommand
+from django.db import connection, transaction
+from faker import Faker
 
 from book.models import Author, Book, Publisher
-from book.tests.factories import AuthorFactory, BookFactory
+from book.tests.factories import AuthorFactory, BookFactory, PublisherFactory
+
+
+def seed_data(books: int, publishers: int, authors: int, batch_size: int = 5000,
+              stdout=None) -> None:
+    """
+    Create publishers, authors and books with 1-3 authors by `bulk_create`.
+    Books are published by the new and the existing publishers, and written
+    by the new and the existing authors.
+    """
+    User = get_user_model()
+    user = User.objects.filter(is_superuser=True).first() or \
+        User.objects.get_or_create(username='admin')[0]
+
+    fake = Faker()
+    with transaction.atomic():
+        # imports look publishers up by their names.
+        numbers = itertools.count(Publisher.objects.count())
+        Publisher.objects.bulk_create(PublisherFactory.build_batch(
+            publishers, registered_by_id=user.pk,
+            name=factory.LazyFunction(lambda: f'{fake.company()} {next(numbers)}'),
+        ), batch_size=batch_size)
+        Author.objects.bulk_create(
+            AuthorFactory.build_batch(authors), batch_size=batch_size)
+
+        publisher_list = list(Publisher.objects.only('pk'))
+        author_ids = list(Author.objects.values_list('pk', flat=True))
+        if books and (not publisher_list or not author_ids):
+            raise ValueError('books need at least one publisher and one author.')
+
+        # Faker('text') takes most of the time of building books.
+        descriptions = [fake.text() for _ in range(min(books, 1000))]
+
+        Through = Book.authors.through
+        for start in range(0, books, batch_size):
+            size = min(batch_size, books - start)
+            book_list = BookFactory.build_batch(
+                size,
+                publisher=factory.LazyFunction(lambda: random.choice(publisher_list)),
+                description=factory.Iterator(descriptions),
+            )
+            if connection.features.can_return_rows_from_bulk_insert:
+                Book.objects.bulk_create(book_list, batch_size=batch_size)
+            else:
+                # new rows cannot be told from the rows other transactions insert.
+                for book in book_list:
+                    book.save(force_insert=True)
+            book_ids = [book.pk for book in book_list]
+
+            Through.objects.bulk_create(itertools.chain.from_iterable(
+                [
+                    Through(book_id=book_id, author_id=author_id)
+                    for author_id in random.sample(
+                        author_ids, min(random.randrange(1, 4), len(author_ids)))
+                ]
+                for book_id in book_ids
+            ), batch_size=batch_size)
+
+            if stdout:
+                stdout.write(f'{start + size} / {books} books')
 
 
 class Command(BaseCommand):
-    def handle(self, *args, **options):
+    help = 'Delete all books, publishers and authors and create new ones.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--books', type=int, default=50)
+        parser.add_argument('--publishers', type=int, default=50)
+        parser.add_argument('--authors', type=int, default=10)
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='the number of books created at a time.')
+
+    def handle(self, *args, books, publishers, authors, batch_size, **options):
         User = get_user_model()
         if not User.objects.filter(is_superuser=True).exists():
             User.objects.create_superuser(
@@ -17,8 +90,5 @@ class Command(BaseCommand):
         Book.objects.all().delete()
         Publisher.objects.all().delete()
 
-        AuthorFactory.create_batch(10)
-        author_list = list(Author.objects.all())
-        for _ in range(50):
-            authors = random.sample(author_list, random.randrange(1, 4))
-            BookFactory(authors=authors)
+        seed_data(books=books, publishers=publishers, authors=authors,
+                  batch_size=batch_size, stdout=self.stdout)
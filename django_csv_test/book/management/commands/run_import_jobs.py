@@ -0,0 +1,45 @@
+import time
+
+from django.core.cache import DEFAULT_CACHE_ALIAS, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management import BaseCommand, CommandError
+from django.db import close_old_connections
+
+from book.jobs import reap_stale_jobs, run_job
+from book.models import ImportJob
+
+
+class Command(BaseCommand):
+    help = 'Poll pending import jobs and run them. Use with DatabaseJobExecutor.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=5,
+                            help='seconds to wait when there is no pending job.')
+        parser.add_argument('--once', action='store_true',
+                            help='exit when there is no pending job.')
+
+    def handle(self, *args, interval, once, **options):
+        # the web process reads the progress of jobs from the cache.
+        if isinstance(caches[DEFAULT_CACHE_ALIAS], (LocMemCache, DummyCache)):
+            raise CommandError(
+                'The default cache is not shared with the web process. '
+                'Set a cache backend shared between processes to CACHES.')
+
+        while True:
+            close_old_connections()
+            if reaped := reap_stale_jobs():
+                self.stdout.write(f'{reaped} stale import jobs are failed')
+
+            job_ids = list(ImportJob.objects.filter(
+                status=ImportJob.Status.PENDING,
+            ).order_by('created_at').values_list('pk', flat=True)[:10])
+
+            for job_id in job_ids:
+                self.stdout.write(f'run import job {job_id}')
+                run_job(job_id)
+
+            if not job_ids:
+                if once:
+                    return
+                time.sleep(interval)
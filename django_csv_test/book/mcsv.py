@@ -1,3 +1,9 @@
+from book.batch import BATCH, bulk_get_or_create
+from book.mixins import (
+    BatchMixin, BulkSaveMixin, CachedLayoutMixin, ChangeDetectionMixin, ChunkedReadMixin,
+    CompiledRowMixin, ExportCacheMixin, ParallelReadMixin, ParallelWriteMixin, PartCacheMixin,
+    ProfilingMixin, QueryPlanMixin, StreamingMixin, ValuesListMixin, uses_relations
+)
 from book.models import Book, Publisher
 from django.contrib.auth import get_user_model
 from django_csv.model_csv import ValidationError, columns
@@ -6,13 +12,19 @@ from django_csv.model_csv.csv.django import DjangoCsv
 User = get_user_model()
 
 
-class PublisherCsv(DjangoCsv):
+class PublisherCsv(ProfilingMixin, ParallelReadMixin, BatchMixin, BulkSaveMixin,
+                   ChunkedReadMixin, CompiledRowMixin, CachedLayoutMixin, QueryPlanMixin,
+                   StreamingMixin, DjangoCsv):
     pk = columns.AttributeColumn(header='id', attr_name='id')
     name = columns.AttributeColumn(header='Publisher Name')
     country = columns.MethodColumn(header='Country')
     city = columns.MethodColumn(header='City')
     registered_by = columns.MethodColumn(header='Registered BY')
 
+    # with `bulk_save(update_conflicts=True)`, rows having an id update the
+    # publisher.
+    lookup_columns = ('pk',)
+
     class Meta:
         model = Publisher
         auto_assign = True
@@ -23,6 +35,7 @@ class PublisherCsv(DjangoCsv):
     def column_city(self, instance: Publisher, **kwargs) -> str:
         return instance.headquarter.split(',')[0].strip()
 
+    @uses_relations('registered_by')
     def column_registered_by(self, instance: Publisher, **kwargs) -> str:
         return instance.registered_by.username
 
@@ -34,7 +47,10 @@ class PublisherCsv(DjangoCsv):
 
         return city + ', ' + country
 
-    def field_registered_by(self, values: dict, **kwargs):
+    def field_registered_by(self, values: dict, static: dict, **kwargs):
+        if batch := static.get(BATCH):
+            return batch.defer(self.resolve_users, username=values['registered_by'])
+
         user, _ = User.objects.get_or_create(username=values['registered_by'])
         return user
 
@@ -43,6 +59,9 @@ class PublisherCsv(DjangoCsv):
         callback method when used as a part.
         """
         values = self.remove_extra_values(values)
+        if batch := static.get(BATCH):
+            return batch.defer(self.resolve_publishers, **values)
+
         if not static.get('only_exists'):
             return Publisher.objects.get_or_create(**values)[0]
 
@@ -51,15 +70,36 @@ class PublisherCsv(DjangoCsv):
         except (Publisher.DoesNotExist, Publisher.MultipleObjectsReturned) as e:
             raise ValidationError(str(e), label='Publisher', column_index=0)
 
+    @staticmethod
+    def resolve_users(values_list: list[dict], static: dict) -> list:
+        return bulk_get_or_create(User, values_list)
+
+    @staticmethod
+    def resolve_publishers(values_list: list[dict], static: dict) -> list:
+        """
+        batch version of `get_publisher`.
+        """
+        return [
+            ValidationError(str(result), label='Publisher', column_index=0)
+            if isinstance(result, Exception) else result
+            for result in bulk_get_or_create(
+                Publisher, values_list, create=not static.get('only_exists'))
+        ]
 
-class BookCsv(DjangoCsv):
+
+class BookCsv(ProfilingMixin, BulkSaveMixin, ChunkedReadMixin, ExportCacheMixin,
+              ParallelWriteMixin, ValuesListMixin, CompiledRowMixin, CachedLayoutMixin,
+              QueryPlanMixin, StreamingMixin, DjangoCsv):
 
     class Meta:
         model = Book
         fields = '__all__'
 
 
-class BookWithPublisherCsv(DjangoCsv):
+class BookWithPublisherCsv(ProfilingMixin, ChangeDetectionMixin, ParallelReadMixin,
+                           BatchMixin, BulkSaveMixin, ChunkedReadMixin, PartCacheMixin,
+                           CompiledRowMixin, CachedLayoutMixin, QueryPlanMixin,
+                           ExportCacheMixin, ParallelWriteMixin, StreamingMixin, DjangoCsv):
     pbl = PublisherCsv.as_part(
         related_name='publisher', callback='get_publisher'
     )
@@ -74,6 +114,12 @@ class BookWithPublisherCsv(DjangoCsv):
         value_name='registered_by'
     )
 
+    # with `bulk_save(update_conflicts=True)`, re-uploaded books update the
+    # books of the same title and publisher.
+    lookup_columns = ('title', 'publisher')
+    # enable `detect_changes` to skip unchanged rows of re-uploads.
+    change_key_columns = ('title', 'pbl_name')
+
     class Meta:
         model = Book
         fields = '__all__'
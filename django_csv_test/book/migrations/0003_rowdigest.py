@@ -0,0 +1,27 @@
+# Generated by Django 4.2.16 on 2026-10-17 02:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('book', '0002_importjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RowDigest',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('csv_class', models.CharField(max_length=255)),
+                ('key', models.CharField(max_length=32)),
+                ('digest', models.CharField(max_length=32)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='rowdigest',
+            constraint=models.UniqueConstraint(fields=('csv_class', 'key'), name='unique_row_digest_key'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.2.16 on 2026-10-17 02:37
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('book', '0003_rowdigest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importjob',
+            name='resumable',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.CreateModel(
+            name='ImportCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('csv_class', models.CharField(max_length=255)),
+                ('file_hash', models.CharField(max_length=64)),
+                ('row_number', models.PositiveBigIntegerField(default=0)),
+                ('offset', models.PositiveBigIntegerField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('job', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='book.importjob')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='importcheckpoint',
+            constraint=models.UniqueConstraint(fields=('csv_class', 'file_hash'), name='unique_import_checkpoint'),
+        ),
+    ]
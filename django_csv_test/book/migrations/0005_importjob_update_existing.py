@@ -0,0 +1,18 @@
+# Generated by Django 4.2.16 on 2026-10-17 02:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('book', '0004_importcheckpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importjob',
+            name='update_existing',
+            field=models.BooleanField(default=False),
+        ),
+    ]
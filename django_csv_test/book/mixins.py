@@ -0,0 +1,1337 @@
+import collections
+import contextlib
+import csv
+import functools
+import hashlib
+import itertools
+import math
+import multiprocessing
+import operator
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, AsyncIterator, BinaryIO, Callable, Iterable, Iterator, Optional
+from urllib.parse import quote
+
+import django
+from asgiref.sync import sync_to_async
+from django.core.cache import caches
+from django.core.exceptions import EmptyResultSet, FieldDoesNotExist
+from django.db import connection, connections, models, transaction
+from django.db.models import Count, Max, Q, QuerySet
+from django.http import StreamingHttpResponse
+
+from book import changes, compiled, options, profiling
+from book.batch import BATCH, BatchResolver, Pending
+from book.compression import CONTENT_TYPES, acompress, compress, get_filename
+from book.parts import PartCache
+from book.signals import conversion_profiled
+from django_csv.model_csv import ValidationError
+from django_csv.model_csv.utils import render_row
+from django_csv.model_csv.writers import Writer
+
+
+class Echo:
+    """
+    File like object which returns the written value as it is.
+    `csv.writer` writes a row to this and the rendered line is yielded
+    immediately instead of being stored in a buffer.
+    """
+    def write(self, value: str) -> str:
+        return value
+
+
+class StreamingMixin:
+    """
+    Add a streaming export to DjangoCsv.
+    Rows are rendered lazily, so the memory usage doesn't depend on the number
+    of instances.
+    e.g.
+    class BookCsv(StreamingMixin, DjangoCsv):
+        ...
+
+    for_write = BookCsv.for_write(instances=Book.objects.all())
+    for row in for_write.iter_table():
+        ...
+    """
+    chunk_size: int = 2000
+
+    def iter_instances(self, chunk_size: Optional[int] = None) -> Iterator:
+        """
+        QuerySet is fetched by `chunk_size` through `QuerySet.iterator()`
+        and its result cache is never filled.
+        """
+        if isinstance(self.instances, QuerySet):
+            return self.instances.iterator(
+                chunk_size=chunk_size or self.chunk_size)
+
+        return iter(self.instances)
+
+    def iter_table(self, header: bool = True,
+                   chunk_size: Optional[int] = None) -> Iterator[list]:
+        """
+        Generator version of `get_table()`.
+        """
+        if header:
+            yield self._meta.get_headers(for_write=True)
+
+        for instance in self.iter_instances(chunk_size=chunk_size):
+            yield render_row(self.get_row_value(instance=instance),
+                             insert_blank_column=self._meta.insert_blank_column)
+
+    async def aiter_instances(self, chunk_size: Optional[int] = None
+                              ) -> AsyncIterator:
+        """
+        Async version of `iter_instances()` using `QuerySet.aiterator()`.
+        `aiterator()` doesn't support `prefetch_related()`, so such a
+        QuerySet is fetched chunk by chunk through `iterator()`, which
+        prefetches each chunk, in a thread.
+        """
+        chunk_size = chunk_size or self.chunk_size
+        if isinstance(self.instances, QuerySet) and self.instances._prefetch_related_lookups:
+            instances = self.instances.iterator(chunk_size=chunk_size)
+            fetch = sync_to_async(lambda: list(itertools.islice(instances, chunk_size)))
+            while chunk := await fetch():
+                for instance in chunk:
+                    yield instance
+        elif isinstance(self.instances, QuerySet):
+            async for instance in self.instances.aiterator(chunk_size=chunk_size):
+                yield instance
+        else:
+            for instance in self.instances:
+                yield instance
+
+    async def aiter_table(self, header: bool = True,
+                          chunk_size: Optional[int] = None) -> AsyncIterator[list]:
+        """
+        Async version of `iter_table()`. Rows are converted in the event loop,
+        so `column_*` methods must not query the database. Fetch relations
+        they touch with QueryPlanMixin or `uses_relations`.
+        """
+        if header:
+            yield self._meta.get_headers(for_write=True)
+
+        async for instance in self.aiter_instances(chunk_size=chunk_size):
+            yield render_row(self.get_row_value(instance=instance),
+                             insert_blank_column=self._meta.insert_blank_column)
+
+    def get_streaming_response(self, writer: Writer, header: bool = True,
+                               chunk_size: Optional[int] = None,
+                               compression: Optional[str] = None
+                               ) -> StreamingHttpResponse:
+        """
+        Streaming version of `get_response()`. Only CsvWriter and TsvWriter are
+        supported because a workbook cannot be written down row by row.
+        Set `compression` (see `book.compression`) to compress the rows as
+        they are streamed.
+        """
+        csv_writer = self._get_csv_writer(writer)
+        content = (
+            csv_writer.writerow(row).encode(writer.encoding, errors='ignore')
+            for row in self.iter_table(header=header, chunk_size=chunk_size)
+        )
+        if compression:
+            content = compress(content, compression)
+        return self._make_streaming_response(writer, content, compression)
+
+    def get_async_streaming_response(self, writer: Writer, header: bool = True,
+                                     chunk_size: Optional[int] = None,
+                                     compression: Optional[str] = None
+                                     ) -> StreamingHttpResponse:
+        """
+        `get_streaming_response()` for async views. Served under ASGI, the
+        response doesn't hold a worker thread while it is streamed.
+        """
+        csv_writer = self._get_csv_writer(writer)
+        content = (
+            csv_writer.writerow(row).encode(writer.encoding, errors='ignore')
+            async for row in self.aiter_table(header=header, chunk_size=chunk_size)
+        )
+        if compression:
+            content = acompress(content, compression)
+        return self._make_streaming_response(writer, content, compression)
+
+    def write_file(self, file: BinaryIO, writer: Writer, header: bool = True,
+                   chunk_size: Optional[int] = None,
+                   compression: Optional[str] = None) -> None:
+        """
+        Write rows of `iter_table()` to a binary file one by one, encoded and
+        compressed as `get_streaming_response()` does.
+        """
+        csv_writer = self._get_csv_writer(writer)
+        content = (
+            csv_writer.writerow(row).encode(writer.encoding, errors='ignore')
+            for row in self.iter_table(header=header, chunk_size=chunk_size)
+        )
+        if compression:
+            content = compress(content, compression)
+        for data in content:
+            file.write(data)
+
+    @staticmethod
+    def _get_csv_writer(writer: Writer):
+        delimiter = getattr(writer, 'delimiter', None)
+        if delimiter is None:
+            raise ValueError(
+                f'{writer.__class__.__name__} does not support streaming.')
+        return csv.writer(Echo(), delimiter=delimiter)
+
+    @staticmethod
+    def _make_streaming_response(writer: Writer, content,
+                                 compression: Optional[str] = None
+                                 ) -> StreamingHttpResponse:
+        if compression:
+            res = StreamingHttpResponse(
+                content, content_type=CONTENT_TYPES[compression])
+            filename = quote(get_filename(writer.filename, compression))
+        else:
+            res = StreamingHttpResponse(content, content_type=writer.content_type)
+            filename = quote(writer.filename)
+        res['Content-Disposition'] = f'attachment;filename="{filename}"'
+        return res
+
+
+class CsvClassMixin:
+    """
+    Remember the csv class in the instances of `for_read()` and
+    `for_write()`, which are made of subclasses of it. See `get_csv_class()`.
+    """
+    _csv_class: Optional[type] = None
+
+    @classmethod
+    def for_read(cls, table: list[list]):
+        mcsv = super().for_read(table=table)
+        mcsv._csv_class = cls
+        return mcsv
+
+    @classmethod
+    def for_write(cls, instances):
+        mcsv = super().for_write(instances=instances)
+        mcsv._csv_class = cls
+        return mcsv
+
+
+def get_csv_class(mcsv: CsvClassMixin) -> type:
+    """
+    The class whose `for_read()` or `for_write()` created `mcsv`.
+    """
+    return mcsv._csv_class
+
+
+# the cache alias of the export generations of models.
+EXPORT_GENERATION_CACHE = 'default'
+
+
+def get_export_generation_key(model: type[models.Model]) -> str:
+    return f'book:export:generation:{model._meta.label_lower}'
+
+
+def bump_export_generation(model: type[models.Model]) -> None:
+    """
+    Make the cached exports of `model` stale. `bulk_save()` calls this after
+    its transaction is committed. Call it after writes which don't update
+    the version fields, e.g. `QuerySet.update()` or raw SQL.
+    """
+    caches[EXPORT_GENERATION_CACHE].set(
+        get_export_generation_key(model), uuid.uuid4().hex, None)
+
+
+class ExportCacheMixin(CsvClassMixin):
+    """
+    Serve repeated exports of the same queryset from the cache framework.
+    The cache key is made of the csv class, the SQL and params of
+    `instances`, and a version token: `Max(export_version_field)`, the Max
+    of each of `export_related_version_fields` and the count of `instances`.
+    It also has the generations of the models, which `bulk_save()` and
+    `bump_export_generation()` change, because `QuerySet.update()`,
+    `bulk_update()` and raw SQL don't update auto_now fields. Generations
+    are kept in EXPORT_GENERATION_CACHE, which must be shared by the
+    processes saving rows.
+    A hit costs the one query of the token.
+    Csv classes which touch relations, e.g. by parts, are cached only if
+    every relation has a version field in `export_related_version_fields`,
+    because a renamed publisher doesn't update the books.
+    `aiter_table()` is not cached.
+    e.g.
+    class BookCsv(ExportCacheMixin, StreamingMixin, DjangoCsv):
+        export_version_field = 'updated_at'  # an auto_now field
+        export_related_version_fields = ('publisher__updated_at',)
+    """
+    # the cache is not used if None.
+    export_version_field: Optional[str] = None
+    export_related_version_fields: tuple[str, ...] = ()
+    export_cache_alias: str = 'default'
+    export_cache_timeout: Optional[int] = 300
+    # larger tables are not cached.
+    export_cache_max_rows: int = 100_000
+
+    def can_cache_export(self) -> bool:
+        """
+        False if a relation touched while writing a row has no version field.
+        """
+        get_related_lookups = getattr(self, 'get_related_lookups', None)
+        lookups = get_related_lookups() if get_related_lookups \
+            else [part.related_name for part in self._meta.parts]
+        versioned = {field.rsplit('__', 1)[0]
+                     for field in self.export_related_version_fields}
+        for lookup in lookups:
+            names = lookup.split('__')
+            if any('__'.join(names[:i]) not in versioned
+                   for i in range(1, len(names) + 1)):
+                return False
+        return True
+
+    def get_export_models(self) -> list[type[models.Model]]:
+        """
+        The model of `instances` and the models of
+        `export_related_version_fields`.
+        """
+        exported = [self.instances.model]
+        for field in self.export_related_version_fields:
+            model = self.instances.model
+            for name in field.split('__')[:-1]:
+                model = model._meta.get_field(name).related_model
+                exported.append(model)
+        return list(dict.fromkeys(exported))
+
+    def get_export_cache_key(self, header: bool) -> Optional[str]:
+        if not self.export_version_field or not isinstance(self.instances, QuerySet) \
+                or not self.can_cache_export():
+            return None
+
+        try:
+            sql, params = self.instances.query.sql_with_params()
+        except EmptyResultSet:
+            return None
+        version = self.instances.aggregate(
+            Max(self.export_version_field),
+            *[Max(field) for field in self.export_related_version_fields],
+            count=Count('pk', distinct=True),
+        )
+
+        generations = caches[EXPORT_GENERATION_CACHE].get_many([
+            get_export_generation_key(model) for model in self.get_export_models()])
+
+        csv_class = get_csv_class(self)
+        fingerprint = repr((
+            csv_class.__module__, csv_class.__qualname__, sql, params, header,
+            sorted(version.items()), sorted(generations.items()),
+        ))
+        return f'book:export:{hashlib.sha256(fingerprint.encode()).hexdigest()}'
+
+    def get_table(self, header: bool = True) -> list[list]:
+        if (key := self.get_export_cache_key(header)) is None:
+            return super().get_table(header=header)
+
+        cache = caches[self.export_cache_alias]
+        if (table := cache.get(key)) is None:
+            table = super().get_table(header=header)
+            if len(table) <= self.export_cache_max_rows:
+                cache.set(key, table, self.export_cache_timeout)
+        return table
+
+    def iter_table(self, header: bool = True,
+                   chunk_size: Optional[int] = None) -> Iterator[list]:
+        if (key := self.get_export_cache_key(header)) is None:
+            yield from super().iter_table(header=header, chunk_size=chunk_size)
+            return
+
+        cache = caches[self.export_cache_alias]
+        if (table := cache.get(key)) is not None:
+            yield from table
+            return
+
+        table = []
+        for row in super().iter_table(header=header, chunk_size=chunk_size):
+            if table is not None:
+                table.append(row)
+                if len(table) > self.export_cache_max_rows:
+                    table = None
+            yield row
+
+        if table is not None:
+            cache.set(key, table, self.export_cache_timeout)
+
+
+def uses_relations(*related_names: str) -> Callable:
+    """
+    Declare relations which a `column_*` method touches so that
+    QueryPlanMixin can fetch them together with the instances.
+    e.g.
+    @uses_relations('registered_by')
+    def column_registered_by(self, instance: Publisher, **kwargs) -> str:
+        return instance.registered_by.username
+    """
+    def wrapper(method: Callable) -> Callable:
+        method.related_names = related_names
+        return method
+
+    return wrapper
+
+
+class ProfilingMixin(CsvClassMixin):
+    """
+    Record the time of each column, `field_*` and `column_*` method, part
+    callback and batch resolve function, and the time and the number of
+    queries of each phase. See `book.profiling`. Only the compiled
+    conversion (CompiledRowMixin) records columns and methods, and rows read
+    by worker processes (ParallelReadMixin) are not recorded.
+    e.g.
+    mcsv = BookCsv.for_read(table=table)
+    mcsv.enable_profile()
+    mcsv.is_valid()
+    print(mcsv.profile_report)
+
+    `conversion_profiled` is sent after `is_valid()`, `bulk_save()`,
+    `get_table()` and the last row of `iter_table()`. Set
+    `profile_conversion = True` to profile every csv.
+    """
+    profile_conversion: bool = False
+    _profile: Optional[profiling.Profile] = None
+    _profile_depth: int = 0
+
+    def enable_profile(self) -> profiling.Profile:
+        self._profile = profiling.Profile()
+        # drop functions built by CompiledRowMixin without the profile.
+        for key in [key for key in self.__dict__ if key.startswith('_row_')]:
+            del self.__dict__[key]
+        return self._profile
+
+    @property
+    def profile(self) -> Optional[profiling.Profile]:
+        if self._profile is None and self.profile_conversion:
+            self.enable_profile()
+        return self._profile
+
+    @property
+    def profile_report(self) -> Optional[dict]:
+        return self.profile.get_report() if self.profile else None
+
+    @contextlib.contextmanager
+    def _profiling(self, phase: Optional[str] = None):
+        profile = self.profile
+        if profile is None:
+            yield
+            return
+
+        # bulk_save() calls is_valid(). The signal is sent once at the end.
+        self._profile_depth += 1
+        try:
+            with contextlib.ExitStack() as stack:
+                if self._profile_depth == 1:
+                    stack.enter_context(connection.execute_wrapper(profile))
+                # e.g. get_table() of ParallelWriteMixin calls iter_table().
+                if phase and phase != profile.current_phase:
+                    stack.enter_context(profile.phase(phase))
+                yield
+        finally:
+            self._profile_depth -= 1
+
+        if self._profile_depth == 0:
+            conversion_profiled.send(
+                sender=get_csv_class(self), csv=self, report=profile.get_report())
+
+    def is_valid(self, *args, **kwargs) -> bool:
+        with self._profiling():
+            return super().is_valid(*args, **kwargs)
+
+    def bulk_save(self, *args, **kwargs) -> list[models.Model]:
+        with self._profiling():
+            self.is_valid()
+            with profiling.phase(self.profile, profiling.SAVE):
+                return super().bulk_save(*args, **kwargs)
+
+    def get_table(self, *args, **kwargs) -> list[list]:
+        with self._profiling(profiling.WRITE):
+            return super().get_table(*args, **kwargs)
+
+    def iter_table(self, *args, **kwargs) -> Iterator[list]:
+        """
+        The phase lasts until the last row, so it includes the time the
+        caller spends between rows.
+        """
+        with self._profiling(profiling.WRITE):
+            yield from super().iter_table(*args, **kwargs)
+
+
+class CachedLayoutMixin:
+    """
+    Compute the column layout, headers and the name -> column map once per
+    class. See `book.options`.
+    """
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        meta = cls.__dict__.get('_meta')
+        # for_read() and for_write() reuse `_meta` of the csv class.
+        if meta is None or any(
+                getattr(base, '_meta', None) is meta for base in cls.__mro__[1:]):
+            return
+
+        # the new class may have assigned indexes to columns of its bases.
+        options.invalidate_shared_layouts(meta)
+        options.cache_options(meta)
+
+
+class CompiledRowMixin:
+    """
+    Convert instances to rows and rows to values by functions built once per
+    class. See `book.compiled`. Set `compile_rows = False` to use the
+    conversion of the library.
+
+    Cells of the table are parsed by chunks of `parse_chunk_size` rows, one
+    column at a time, unless `parse_by_column = False` or the conversion is
+    profiled. A cell which fails to convert raises its ValueError as the
+    library does.
+    """
+    compile_rows: bool = True
+    parse_by_column: bool = True
+    parse_chunk_size: int = 1000
+
+    def get_row_value(self, instance, is_relation: bool = False) -> dict[int, str]:
+        # a part gets the related instance in PartForWrite.get_row_value().
+        if not self.compile_rows or getattr(self._meta, 'as_part', False):
+            return super().get_row_value(instance, is_relation=is_relation)
+
+        key = f'_row_writer_{is_relation}'
+        if (writer := self.__dict__.get(key)) is None:
+            writer = self.__dict__[key] = compiled.get_row_writer(
+                self, is_relation, profile=getattr(self, 'profile', None))
+        return writer(self, instance)
+
+    def read_from_row(self, row: list[str], number: int, is_relation: bool = False):
+        if not self.compile_rows:
+            return super().read_from_row(row, number, is_relation=is_relation)
+
+        key = f'_row_reader_{is_relation}'
+        profile = getattr(self, 'profile', None)
+        if (reader := self.__dict__.get(key)) is None:
+            reader = self.__dict__[key] = compiled.get_row_reader(
+                self, is_relation, profile=profile)
+
+        parsed = None
+        if self.parse_by_column and not is_relation and profile is None:
+            parsed = self._get_parsed(row, number)
+        return reader(self, row, number, parsed)
+
+    def _get_parsed(self, row: list[str], number: int) -> Optional[tuple]:
+        """
+        The values and conversion errors of `row`, parsed with the following
+        rows of the table. None if `row` is not the row `number` of `table`.
+        """
+        start, rows, parsed = self.__dict__.get('_parsed_chunk') or (0, [], [])
+        if not (0 <= number - start < len(rows) and rows[number - start] is row):
+            table = getattr(self, 'table', None) or []
+            if not (0 <= number < len(table) and table[number] is row):
+                return None
+
+            start, rows = number, table[number:number + self.parse_chunk_size]
+            parsed = compiled.get_chunk_parser(self)(rows)
+            self.__dict__['_parsed_chunk'] = (start, rows, parsed)
+        return parsed[number - start]
+
+
+class PartCacheMixin:
+    """
+    Read the same values of a part once per csv. Rows are cached by the raw
+    cells of the part and `static` in an LRU cache of `part_cache_size`
+    rows. Errors of a cached row get the number of each row. Only the
+    compiled conversion (CompiledRowMixin) uses the cache, and each chunk of
+    ChunkedReadMixin has its own cache.
+    Set `part_cache_size = 0` if a part callback must run for every row.
+    """
+    part_cache_size: int = 1024
+    _part_cache: Optional[PartCache] = None
+
+    @property
+    def part_cache(self) -> Optional[PartCache]:
+        if self._part_cache is None and self.part_cache_size:
+            self._part_cache = PartCache(self.part_cache_size)
+        return self._part_cache
+
+
+class ValuesListMixin:
+    """
+    Export tuples of `values_list()` instead of instances if all columns are
+    AttributeColumns of concrete fields, including `publisher__name` style
+    paths of parts. Otherwise instances are exported as usual.
+    Set `use_values_list = False` to always export instances.
+
+    `get_table()` and `iter_table()` format the tuples by chunks of
+    `column_chunk_size`, one column at a time. See
+    `compiled.compile_columns_writer`. Set `format_by_column = False` to
+    format them row by row. Put ExportCacheMixin before this mixin, and
+    StreamingMixin after it for `iter_table()`.
+    """
+    use_values_list: bool = True
+    format_by_column: bool = True
+    column_chunk_size: int = 2000
+    _values_writer: Optional[Callable] = None
+    _columns_writer: Optional[Callable] = None
+
+    @classmethod
+    def for_write(cls, instances):
+        mcsv = super().for_write(instances=instances)
+        if cls.use_values_list and isinstance(mcsv.instances, QuerySet) \
+                and (values := compiled.get_values_writer(cls)):
+            paths, mcsv._values_writer = values
+            if cls.format_by_column:
+                mcsv._columns_writer = compiled.get_columns_writer(cls)[1]
+            # QueryPlanMixin may have added relations which are not needed.
+            mcsv.instances = mcsv.instances.prefetch_related(None).values_list(*paths)
+        return mcsv
+
+    def get_row_value(self, instance, is_relation: bool = False) -> dict[int, str]:
+        if self._values_writer is None or is_relation:
+            return super().get_row_value(instance, is_relation=is_relation)
+        return self._values_writer(instance)
+
+    def get_table(self, header: bool = True) -> list[list]:
+        if self._columns_writer is None:
+            return super().get_table(header=header)
+
+        table = [self._meta.get_headers(for_write=True)] if header else []
+        values = list(self.instances)
+        for start in range(0, len(values), self.column_chunk_size):
+            table += self._columns_writer(values[start:start + self.column_chunk_size])
+        return table
+
+    def iter_table(self, header: bool = True,
+                   chunk_size: Optional[int] = None) -> Iterator[list]:
+        if self._columns_writer is None:
+            yield from super().iter_table(header=header, chunk_size=chunk_size)
+            return
+
+        if header:
+            yield self._meta.get_headers(for_write=True)
+
+        instances = self.iter_instances(chunk_size=chunk_size)
+        while chunk := list(itertools.islice(instances, self.column_chunk_size)):
+            yield from self._columns_writer(chunk)
+
+
+class QueryPlanMixin:
+    """
+    Apply `select_related` and `prefetch_related` to a QuerySet passed to
+    `for_write()`. Relations are collected from parts, `__` separated
+    `attr_name` and relations declared by `uses_relations`.
+    """
+
+    @classmethod
+    def for_write(cls, instances):
+        if isinstance(instances, QuerySet):
+            instances = cls.plan_queryset(instances)
+        return super().for_write(instances=instances)
+
+    @classmethod
+    def plan_queryset(cls, queryset: QuerySet) -> QuerySet:
+        select, prefetch = [], []
+        for lookup in cls.get_related_lookups():
+            if cls._is_single_valued(queryset.model, lookup):
+                select.append(lookup)
+            else:
+                prefetch.append(lookup)
+
+        if select:
+            queryset = queryset.select_related(*select)
+        if prefetch:
+            queryset = queryset.prefetch_related(*prefetch)
+        return queryset
+
+    @classmethod
+    def get_related_lookups(cls) -> list[str]:
+        """
+        return lookups of relations which are touched while writing a row.
+        """
+        model = cls._meta.model
+        parts = {part.related_name: part for part in cls._meta.parts}
+        lookups = list(parts)
+        for col in cls._meta.get_columns(for_write=True):
+            if col.is_relation:
+                prefix, owner = col.related_name + '__', parts[col.related_name]
+            else:
+                prefix, owner = '', cls
+
+            paths = [getattr(col, 'attr_name', '')]
+            if col.has_callback:
+                method = col.callback
+            elif col.is_static:
+                method = None
+            else:
+                method = getattr(owner, 'column_' + col.method_suffix, None)
+            paths += getattr(method, 'related_names', [])
+
+            for path in paths:
+                if lookup := cls._get_relation_path(model, prefix + path):
+                    lookups.append(lookup)
+
+        # remove duplicates and lookups which are included in longer ones.
+        lookups = list(dict.fromkeys(lookups))
+        return [
+            lookup for lookup in lookups
+            if not any(other.startswith(lookup + '__') for other in lookups)
+        ]
+
+    @staticmethod
+    def _get_relation_path(model: type[models.Model], path: str) -> str:
+        """
+        return the longest part of `path` which consists of relation fields.
+        e.g. `publisher__registered_by__username` -> `publisher__registered_by`
+        """
+        relations = []
+        for name in path.split('__'):
+            if not name:
+                break
+            try:
+                field = model._meta.get_field(name)
+            except FieldDoesNotExist:
+                break
+            if not field.is_relation or field.related_model is None:
+                break
+            relations.append(name)
+            model = field.related_model
+
+        return '__'.join(relations)
+
+    @staticmethod
+    def _is_single_valued(model: type[models.Model], lookup: str) -> bool:
+        """
+        True if `select_related` can follow the lookup.
+        """
+        for name in lookup.split('__'):
+            field = model._meta.get_field(name)
+            if field.many_to_many or field.one_to_many:
+                return False
+            model = field.related_model
+        return True
+
+
+class BatchMixin:
+    """
+    Resolve values deferred by `field_*` methods and part callbacks in bulk
+    after all rows are read. BatchResolver is passed as `static[BATCH]`.
+    e.g.
+    def get_publisher(self, values: dict, static: dict, **kwargs):
+        if batch := static.get(BATCH):
+            return batch.defer(resolve_publishers, **values)
+        return Publisher.objects.get_or_create(**values)[0]
+    """
+
+    def is_valid(self) -> bool:
+        if BATCH in self._static:
+            # already checked.
+            return super().is_valid()
+
+        batch = BatchResolver()
+        self.set_static(BATCH, batch)
+        super().is_valid()
+        self.resolve_batch(batch, self.cleaned_rows)
+        return all(row.is_valid for row in self.cleaned_rows)
+
+    def resolve_batch(self, batch: BatchResolver, rows: list) -> None:
+        """
+        Resolve deferred values and replace Pending values of `rows`.
+        """
+        profile = getattr(self, 'profile', None)
+        with profiling.phase(profile, profiling.RESOLVE):
+            batch.resolve(static=self._static.copy(), profile=profile)
+
+        part_names = {part.related_name for part in self._meta.parts}
+        for row in rows:
+            if not row.is_valid:
+                continue
+
+            for name, value in list(row.values.items()):
+                if not isinstance(value, Pending):
+                    continue
+                try:
+                    row[name] = batch.get(value)
+                except ValidationError as e:
+                    error_name = f'{name}__callback' if name in part_names else name
+                    row.append_error(
+                        exception=e, name=error_name, row_number=row.number)
+
+
+class BulkSaveMixin:
+    """
+    Save cleaned rows with `bulk_create` and `bulk_update` in one transaction.
+    Values of ManyToManyFields are saved by inserting through model rows in
+    bulk.
+    Declare `lookup_columns` and call `bulk_save(update_conflicts=True)` to
+    update existing instances identified by the values of the columns.
+    Existing instances are fetched by their exact keys, and only the fields
+    whose values are changed are updated.
+    `bulk_create(update_conflicts=True)` is not used for this: it needs a
+    unique constraint on the lookup fields, which e.g. Book(title, publisher)
+    doesn't have, and Django 4.2 doesn't set the primary keys of updated
+    instances, which are needed to replace their ManyToManyField values.
+    e.g.
+    class BookCsv(BulkSaveMixin, DjangoCsv):
+        # names of columns, or related names of parts.
+        lookup_columns = ('title', 'publisher')
+
+    mcsv = BookCsv.for_read(table=table)
+    if mcsv.is_valid():
+        mcsv.bulk_save(update_conflicts=True)
+    """
+    lookup_columns: tuple[str, ...] = ()
+    # the number of keys in an OR of a lookup query.
+    # SQLite cannot parse an OR of conditions of 1000 instances.
+    lookup_chunk_size: int = 200
+
+    def bulk_save(self, batch_size: int = 1000, update_conflicts: bool = False,
+                  unique_fields: Optional[list[str]] = None,
+                  update_fields: Optional[list[str]] = None,
+                  only_valid: bool = False) -> list[models.Model]:
+        """
+        update_conflicts: if True, rows which have the same `unique_fields`
+                          values as an existing instance update the instance.
+        unique_fields: default is the fields of `lookup_columns`.
+        update_fields: fields to update. default is all fields in the row.
+        only_valid: if True, invalid rows are skipped instead of raising error.
+        """
+        if not self.is_valid() and not only_valid:
+            raise ValueError('`is_valid()` method failed')
+
+        if update_conflicts and not unique_fields:
+            unique_fields = self.get_lookup_fields()
+        if update_conflicts and not unique_fields:
+            raise ValueError('`unique_fields` is required with `update_conflicts`')
+
+        rows = (row for row in self.cleaned_rows if row.is_valid)
+        saved = []
+        with transaction.atomic():
+            while chunk := list(itertools.islice(rows, batch_size)):
+                saved += self._bulk_save_rows(
+                    chunk, update_conflicts=update_conflicts,
+                    unique_fields=unique_fields, update_fields=update_fields)
+            self.post_bulk_save(saved)
+            if saved:
+                model = self._meta.model
+                transaction.on_commit(lambda: bump_export_generation(model))
+        return saved
+
+    def post_bulk_save(self, saved: list[models.Model]) -> None:
+        """
+        Called in the transaction of `bulk_save()` with the saved instances.
+        """
+
+    def get_lookup_fields(self) -> list[str]:
+        """
+        Model field names of `lookup_columns`.
+        """
+        part_names = {part.related_name for part in self._meta.parts}
+        return [
+            name if name in part_names else self._meta.get_column(name).value_name
+            for name in self.lookup_columns
+        ]
+
+    def _bulk_save_rows(self, rows: list, update_conflicts: bool,
+                        unique_fields: Optional[list[str]],
+                        update_fields: Optional[list[str]]) -> list[models.Model]:
+        model = self._meta.model
+        m2m_fields = {f.name: f for f in model._meta.many_to_many}
+
+        instances, relations, names = [], [], set()
+        for row in rows:
+            values = self.remove_extra_values(row.values)
+            relations.append({
+                name: values.pop(name) for name in list(values)
+                if name in m2m_fields
+            })
+            names.update(values)
+            instances.append(model(**values))
+
+        existing = {}
+        if update_conflicts:
+            existing = self._find_existing(instances, unique_fields)
+            to_create = [obj for obj in instances if id(obj) not in existing]
+        else:
+            to_create = [obj for obj in instances if obj.pk is None]
+
+        if existing:
+            fields = self._get_update_fields(names, unique_fields, update_fields)
+            self._bulk_update_changed(
+                [(obj, existing[id(obj)]) for obj in instances if id(obj) in existing],
+                fields)
+        self._bulk_create(to_create)
+
+        self._bulk_set_m2m(instances, relations, m2m_fields, replace=set(existing))
+        return instances
+
+    def _bulk_create(self, instances: list[models.Model]) -> None:
+        """
+        `bulk_create` which sets primary keys even if the backend doesn't
+        return them. Such backends save the instances one by one, because
+        rows inserted by other transactions at the same time cannot be told
+        from the new ones.
+        """
+        if connection.features.can_return_rows_from_bulk_insert:
+            self._meta.model.objects.bulk_create(instances)
+            return
+
+        for obj in instances:
+            obj.save(force_insert=True)
+
+    def _find_existing(self, instances: list[models.Model],
+                       unique_fields: list[str]) -> dict[int, models.Model]:
+        """
+        Fetch existing instances by their keys and set their primary keys to
+        the instances. Return {id(instance): existing instance}.
+        Raise MultipleObjectsReturned if existing instances have the same key.
+        """
+        model = self._meta.model
+        opts = model._meta
+        attnames = [
+            opts.pk.attname if name == 'pk' else opts.get_field(name).attname
+            for name in unique_fields
+        ]
+
+        def _key(obj) -> tuple:
+            return tuple(getattr(obj, attname) for attname in attnames)
+
+        # rows without a value of a key field are new.
+        keys = list(dict.fromkeys(
+            key for obj in instances if None not in (key := _key(obj))))
+        existing = {}
+        for i in range(0, len(keys), self.lookup_chunk_size):
+            condition = functools.reduce(operator.or_, (
+                Q(**dict(zip(attnames, key)))
+                for key in keys[i:i + self.lookup_chunk_size]
+            ))
+            for old in model.objects.filter(condition):
+                if (key := _key(old)) in existing:
+                    raise model.MultipleObjectsReturned(
+                        f'{opts.verbose_name_plural} have the same '
+                        f'{", ".join(unique_fields)}: {key}')
+                existing[key] = old
+
+        found = {}
+        for obj in instances:
+            if (old := existing.get(_key(obj))) is not None:
+                obj.pk = old.pk
+                found[id(obj)] = old
+        return found
+
+    def _bulk_update_changed(self, pairs: list[tuple[models.Model, models.Model]],
+                             fields: list[str]) -> None:
+        """
+        Update only the changed fields. Instances are grouped by their
+        changed fields and each group is updated by one `bulk_update`.
+        pairs: (new instance, existing instance)
+        """
+        opts = self._meta.model._meta
+        attnames = {name: opts.get_field(name).attname for name in fields}
+        # bulk_update doesn't call `pre_save`, so update auto_now fields here.
+        auto_now = [
+            field for field in opts.concrete_fields
+            if getattr(field, 'auto_now', False) and field.name not in fields
+        ]
+
+        groups = {}
+        for obj, old in pairs:
+            changed = tuple(
+                name for name, attname in attnames.items()
+                if getattr(obj, attname) != getattr(old, attname)
+            )
+            if changed:
+                groups.setdefault(changed, []).append(obj)
+
+        for changed, objs in groups.items():
+            for obj in objs:
+                for field in auto_now:
+                    field.pre_save(obj, add=False)
+            self._meta.model.objects.bulk_update(
+                objs, fields=[*changed, *(field.name for field in auto_now)])
+
+    def _get_update_fields(self, names: Iterable[str],
+                           unique_fields: list[str],
+                           update_fields: Optional[list[str]]) -> list[str]:
+        """
+        Fields in the row except the primary key, `unique_fields` and fields
+        set by Django (auto_now and auto_now_add).
+        """
+        opts = self._meta.model._meta
+        return update_fields or [
+            field.name for field in opts.concrete_fields
+            if not field.primary_key and field.name not in unique_fields
+            and not getattr(field, 'auto_now', False)
+            and not getattr(field, 'auto_now_add', False)
+            and (field.name in names or field.attname in names)
+        ]
+
+    @staticmethod
+    def _bulk_set_m2m(instances: list[models.Model], relations: list[dict],
+                      m2m_fields: dict, replace: set) -> None:
+        """
+        Insert through model rows of all instances at once for each field.
+        Old rows of updated instances (their ids are in `replace`) are
+        replaced if they differ from the new values.
+        """
+        for name, field in m2m_fields.items():
+            through = field.remote_field.through
+            source = field.m2m_field_name() + '_id'
+            target = field.m2m_reverse_field_name() + '_id'
+
+            targets = [
+                (obj, {getattr(value, 'pk', value) for value in rels[name] or []})
+                for obj, rels in zip(instances, relations)
+                if name in rels
+            ]
+            if not targets:
+                continue
+
+            current = {}
+            updated = [obj.pk for obj, _ in targets if id(obj) in replace]
+            if updated:
+                for pk, value in through.objects.filter(
+                        **{f'{source}__in': updated}).values_list(source, target):
+                    current.setdefault(pk, set()).add(value)
+
+            changed = [
+                (obj, values) for obj, values in targets
+                if id(obj) not in replace or current.get(obj.pk, set()) != values
+            ]
+            replaced = [
+                obj.pk for obj, _ in changed if id(obj) in replace and obj.pk in current]
+            if replaced:
+                through.objects.filter(**{f'{source}__in': replaced}).delete()
+
+            if changed:
+                through.objects.bulk_create([
+                    through(**{source: obj.pk, target: value})
+                    for obj, values in changed for value in values
+                ], ignore_conflicts=True)
+
+
+def shift_row_numbers(rows: list, offset: int) -> None:
+    """
+    Convert row numbers of a chunk to row numbers of the whole table.
+    """
+    if not offset:
+        return
+
+    for row in rows:
+        row.number += offset
+        for error in row.errors:
+            error.row_number += offset
+
+
+def renumber_rows(rows: list, numbers: list[int]) -> None:
+    """
+    Convert row numbers of a part of the table to row numbers of the table.
+    `numbers[i]` is the row number of the i-th row of the part.
+    """
+    for row in rows:
+        number = numbers[row.number]
+        for error in row.errors:
+            error.row_number = number
+        row.number = number
+
+
+class ChangeDetectionMixin(CsvClassMixin):
+    """
+    Skip raw rows which are the same as the rows saved last time with the
+    same natural key. Rows are hashed before they are cleaned, so skipped
+    rows are neither validated nor saved, and `cleaned_rows` has only new
+    and changed rows. Hashes are stored in RowDigest in the transaction of
+    `bulk_save()`, so rows which are rolled back are not skipped next time.
+    Changes made outside of the csv class are not detected. Delete the
+    RowDigests of the csv class to import all rows again.
+    e.g.
+    class BookCsv(ChangeDetectionMixin, BulkSaveMixin, DjangoCsv):
+        change_key_columns = ('title', 'pbl_name')
+        detect_changes = True
+    """
+    # names of the columns identifying a row.
+    change_key_columns: tuple[str, ...] = ()
+    detect_changes: bool = False
+    # row numbers of the skipped rows.
+    unchanged_rows: Optional[list[int]] = None
+    # (key, digest) of each row of the filtered table.
+    _row_digests: Optional[list[tuple[str, str]]] = None
+
+    def is_valid(self, *args, **kwargs) -> bool:
+        if self.detect_changes and self._row_digests is None:
+            numbers = self._skip_unchanged_rows()
+            is_valid = super().is_valid(*args, **kwargs)
+            renumber_rows(self.cleaned_rows, numbers)
+            return is_valid
+        return super().is_valid(*args, **kwargs)
+
+    def post_bulk_save(self, saved: list[models.Model]) -> None:
+        super().post_bulk_save(saved)
+        if self.detect_changes:
+            changes.store_digests(self.get_change_label(), dict(
+                digest for row, digest in zip(self.cleaned_rows, self._row_digests)
+                if row.is_valid
+            ))
+
+    def get_change_label(self) -> str:
+        csv_class = get_csv_class(self)
+        return f'{csv_class.__module__}.{csv_class.__qualname__}'
+
+    def _skip_unchanged_rows(self) -> list[int]:
+        """
+        Remove unchanged rows from `table`. Return the row numbers of the
+        remaining rows.
+        """
+        if not self.change_key_columns:
+            raise ValueError('`change_key_columns` is required to detect changes')
+
+        indexes = [self._meta.get_column(name).get_r_index()
+                   for name in self.change_key_columns]
+        digests = [
+            (changes.hash_values([row[i] for i in indexes]), changes.hash_values(row))
+            for row in self.table
+        ]
+        stored = changes.fetch_digests(
+            self.get_change_label(), [key for key, _ in digests])
+
+        numbers, self.unchanged_rows = [], []
+        for number, (key, digest) in enumerate(digests):
+            if stored.get(key) == digest:
+                self.unchanged_rows.append(number)
+            else:
+                numbers.append(number)
+        self.table = [self.table[number] for number in numbers]
+        self._row_digests = [digests[number] for number in numbers]
+        return numbers
+
+
+class ChunkedReadMixin:
+    """
+    Validate a large table chunk by chunk. Only one chunk of raw rows and
+    cleaned rows is held in memory at a time.
+    e.g.
+    for mcsv in BookCsv.for_read_chunks(rows=reader, chunk_size=1000):
+        if mcsv.is_valid():
+            mcsv.bulk_save()
+        else:
+            errors += mcsv.errors
+    """
+
+    @classmethod
+    def for_read_chunks(cls, rows: Iterable[list], chunk_size: int = 1000,
+                        static: Optional[dict] = None, start: int = 0) -> Iterator:
+        """
+        Yield validated `for_read` instances. `rows` can be any iterable such
+        as a generator. Row numbers continue over the chunks from `start`.
+        """
+        rows = iter(rows)
+        offset = start
+        while table := list(itertools.islice(rows, chunk_size)):
+            mcsv = cls.for_read(table=table)
+            for key, value in (static or {}).items():
+                mcsv.set_static(key, value)
+
+            mcsv.is_valid()
+            shift_row_numbers(mcsv.cleaned_rows, offset)
+            offset += len(table)
+            yield mcsv
+
+    @property
+    def errors(self) -> list:
+        """
+        ErrorMessages of all rows.
+        """
+        return [error for row in self.cleaned_rows for error in row.errors]
+
+
+def _read_shard(csv_class, table: list[list], static: dict
+                ) -> tuple[list, BatchResolver]:
+    """
+    Read rows in a worker process. Values which need the database are only
+    deferred and resolved in the main process.
+    """
+    mcsv = csv_class.for_read(table=table)
+    for key, value in static.items():
+        mcsv.set_static(key, value)
+
+    batch = BatchResolver()
+    mcsv.set_static(BATCH, batch)
+    mcsv.is_valid(workers=0)
+    return mcsv.cleaned_rows, batch
+
+
+class ParallelReadMixin(CsvClassMixin):
+    """
+    Read rows in worker processes. Use with BatchMixin, then `field_*` methods
+    and part callbacks defer database lookups and the workers only run type
+    conversions and `field_*` methods.
+    The csv class must be importable because it is passed to the workers.
+    e.g.
+    class BookCsv(ParallelReadMixin, BatchMixin, DjangoCsv):
+        ...
+
+    mcsv = BookCsv.for_read(table=table)
+    mcsv.is_valid(workers=4)
+    """
+    read_workers: int = 0
+    _parallel_rows: Optional[list] = None
+
+    def is_valid(self, workers: Optional[int] = None,
+                 shard_size: Optional[int] = None) -> bool:
+        """
+        workers: the number of processes. Rows are read in this process if
+                 less than 2. default is `read_workers`.
+        shard_size: the number of rows sent to a worker at a time.
+        """
+        if self._parallel_rows is not None:
+            return all(row.is_valid for row in self._parallel_rows)
+
+        workers = self.read_workers if workers is None else workers
+        if workers < 2 or BATCH in self._static:
+            return super().is_valid()
+
+        csv_class = get_csv_class(self)
+        static = {k: v for k, v in self._static.items() if k != BATCH}
+        size = shard_size or max(math.ceil(len(self.table) / (workers * 4)), 1)
+        shards = [self.table[i:i + size] for i in range(0, len(self.table), size)]
+
+        rows, batch = [], BatchResolver()
+        with ProcessPoolExecutor(
+                max_workers=workers, initializer=django.setup,
+                mp_context=multiprocessing.get_context('spawn')) as executor:
+            results = executor.map(
+                _read_shard, itertools.repeat(csv_class), shards,
+                itertools.repeat(static))
+            for i, (shard_rows, shard_batch) in enumerate(results):
+                shift_row_numbers(shard_rows, i * size)
+                rows += shard_rows
+                batch.merge(shard_batch)
+
+        self.set_static(BATCH, batch)
+        self.resolve_batch(batch, rows)
+        self._parallel_rows = rows
+        return all(row.is_valid for row in rows)
+
+    @property
+    def cleaned_rows(self) -> list:
+        if self._parallel_rows is not None:
+            return self._parallel_rows
+        return super().cleaned_rows
+
+
+def _write_shard(csv_class, query, prefetch_lookups: tuple, alias: str,
+                 pk_range: tuple[Any, Any], databases: dict[str, Any]) -> list[list]:
+    """
+    Render rows of a pk range in a worker process connected to the databases
+    of the main process by their names, e.g. test databases. The QuerySet is
+    rebuilt from its unevaluated query, because a pickled QuerySet is fetched
+    before it is sent.
+    """
+    for name_alias, name in databases.items():
+        connections[name_alias].settings_dict['NAME'] = name
+
+    queryset = QuerySet(model=query.model, query=query, using=alias)
+    if prefetch_lookups:
+        queryset = queryset.prefetch_related(*prefetch_lookups)
+    first, last = pk_range
+    mcsv = csv_class.for_write(instances=queryset.filter(pk__gte=first, pk__lte=last))
+    mcsv.write_workers = 0
+    return mcsv.get_table(header=False)
+
+
+class ParallelWriteMixin(CsvClassMixin):
+    """
+    Render rows of a QuerySet in worker processes. The QuerySet is split
+    into ranges of `write_shard_size` pks and each worker renders a range
+    through `for_write()` of the same csv class with its own database
+    connection. The ranges are joined in pk order after a single header.
+    QuerySets which are sliced or ordered by other fields than pk are
+    rendered in this process. Put it after ExportCacheMixin and before
+    ValuesListMixin and StreamingMixin.
+    The csv class must be importable because it is passed to the workers.
+    e.g.
+    mcsv = BookCsv.for_write(instances=Book.objects.order_by('pk'))
+    mcsv.write_workers = 4
+    with open('book.csv', 'wb') as f:
+        mcsv.write_file(f, CsvWriter(filename='book.csv'))
+    """
+    write_workers: int = 0
+    write_shard_size: int = 10_000
+    # the QuerySet passed to `for_write()`.
+    _shard_source: Optional[QuerySet] = None
+
+    @classmethod
+    def for_write(cls, instances):
+        mcsv = super().for_write(instances=instances)
+        if isinstance(instances, QuerySet):
+            mcsv._shard_source = instances
+        return mcsv
+
+    def can_shard(self) -> bool:
+        queryset = self._shard_source
+        if self.write_workers < 2 or queryset is None \
+                or queryset.query.is_sliced or queryset.query.combinator:
+            return False
+
+        # workers cannot connect to an in-memory database of this process.
+        is_in_memory_db = getattr(connections[queryset.db], 'is_in_memory_db', None)
+        if is_in_memory_db and is_in_memory_db():
+            return False
+
+        meta = queryset.model._meta
+        order_by = queryset.query.order_by or (
+            meta.ordering if queryset.query.default_ordering else ())
+        return tuple(order_by) in ((), ('pk',), (meta.pk.name,), (meta.pk.attname,))
+
+    def get_pk_ranges(self) -> list[tuple[Any, Any]]:
+        """
+        The first and the last pk of each shard.
+        """
+        ranges = []
+        pks = self._shard_source.order_by('pk').values_list('pk', flat=True)
+        for i, pk in enumerate(pks.iterator(chunk_size=self.write_shard_size)):
+            if i % self.write_shard_size == 0:
+                ranges.append([pk, pk])
+            ranges[-1][1] = pk
+        return [tuple(pk_range) for pk_range in ranges]
+
+    def iter_shards(self) -> Iterator[list[list]]:
+        """
+        Yield rows of each shard in pk order. At most two shards per worker
+        are submitted at a time, so the rendered rows waiting to be yielded
+        are bounded.
+        """
+        queryset = self._shard_source
+        pk_ranges = self.get_pk_ranges()
+        if not pk_ranges:
+            return
+
+        csv_class = get_csv_class(self)
+        databases = {queryset.db: connections[queryset.db].settings_dict['NAME']}
+        max_workers = min(self.write_workers, len(pk_ranges))
+        pk_ranges = iter(pk_ranges)
+        with ProcessPoolExecutor(
+                max_workers=max_workers, initializer=django.setup,
+                mp_context=multiprocessing.get_context('spawn')) as executor:
+            def submit(pk_range):
+                return executor.submit(
+                    _write_shard, csv_class, queryset.query,
+                    queryset._prefetch_related_lookups, queryset.db, pk_range, databases)
+
+            pending = collections.deque(
+                submit(pk_range) for pk_range in
+                itertools.islice(pk_ranges, max_workers * 2))
+            while pending:
+                rows = pending.popleft().result()
+                if (pk_range := next(pk_ranges, None)) is not None:
+                    pending.append(submit(pk_range))
+                yield rows
+
+    def get_table(self, header: bool = True) -> list[list]:
+        if not self.can_shard():
+            return super().get_table(header=header)
+        return list(self.iter_table(header=header))
+
+    def iter_table(self, header: bool = True,
+                   chunk_size: Optional[int] = None) -> Iterator[list]:
+        if not self.can_shard():
+            yield from super().iter_table(header=header, chunk_size=chunk_size)
+            return
+
+        if header:
+            yield self._meta.get_headers(for_write=True)
+        for rows in self.iter_shards():
+            yield from rows
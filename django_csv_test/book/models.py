@@ -45,3 +45,95 @@ class Book(models.Model):
     @property
     def name(self) -> str:
         return f'{self.title}  ({self.publisher.name})'
+
+
+class ImportJob(models.Model):
+    """
+    An upload which is imported outside of the request.
+    See `book.jobs`.
+    """
+    class Status(models.TextChoices):
+        PENDING = 'pending'
+        RUNNING = 'running'
+        SUCCEEDED = 'succeeded'
+        FAILED = 'failed'
+
+    file = models.FileField(upload_to='import_jobs/')
+    # dotted paths to the DjangoCsv class and the Reader class.
+    csv_class = models.CharField(max_length=255)
+    reader_class = models.CharField(max_length=255)
+    static = models.JSONField(default=dict, blank=True)
+    # commit chunk by chunk and resume from ImportCheckpoint.
+    resumable = models.BooleanField(default=False)
+    # update instances of the same `lookup_columns` instead of creating them.
+    update_existing = models.BooleanField(default=False)
+
+    status = models.CharField(
+        max_length=20, choices=Status.choices, default=Status.PENDING)
+    processed_rows = models.PositiveIntegerField(default=0)
+    errors = models.JSONField(default=list, blank=True)
+    message = models.TextField(blank=True)
+    # set when the job is claimed and whenever a resumable job commits a chunk.
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+
+    created_by = models.ForeignKey(
+        User, null=True, blank=True, on_delete=models.SET_NULL)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.file.name} ({self.status})'
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in (self.Status.SUCCEEDED, self.Status.FAILED)
+
+
+class RowDigest(models.Model):
+    """
+    Content hash of the last saved row of a natural key.
+    See `book.mixins.ChangeDetectionMixin`.
+    """
+    # dotted path to the DjangoCsv class.
+    csv_class = models.CharField(max_length=255)
+    # hashes of the natural key values and of the whole raw row.
+    key = models.CharField(max_length=32)
+    digest = models.CharField(max_length=32)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['csv_class', 'key'], name='unique_row_digest_key'),
+        ]
+
+    def __str__(self):
+        return f'{self.csv_class} {self.key}'
+
+
+class ImportCheckpoint(models.Model):
+    """
+    The rows of a file saved by resumable import jobs.
+    See `book.jobs.import_file_resumable()`.
+    """
+    # dotted path to the DjangoCsv class.
+    csv_class = models.CharField(max_length=255)
+    # sha256 of the uploaded bytes.
+    file_hash = models.CharField(max_length=64)
+    # the number of saved rows after the header, and the byte offset of the
+    # decompressed file after them. `offset` is null if the reader cannot
+    # tell it.
+    row_number = models.PositiveBigIntegerField(default=0)
+    offset = models.PositiveBigIntegerField(null=True, blank=True)
+    job = models.ForeignKey(
+        ImportJob, null=True, blank=True, on_delete=models.SET_NULL)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['csv_class', 'file_hash'], name='unique_import_checkpoint'),
+        ]
+
+    def __str__(self):
+        return f'{self.csv_class} {self.file_hash[:12]} ({self.row_number})'
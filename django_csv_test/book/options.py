@@ -0,0 +1,111 @@
+"""
+Cache of the column layout of csv classes.
+
+`_meta` filters `columns` for every `get_columns()`, `get_column()` and
+`get_headers()` call. CachedOptionsMixin keeps the results per `_meta`.
+
+A subclass of a csv class shares the column objects with its base class and
+may assign new indexes to them, so the caches of the `_meta`s sharing columns
+with a new csv class using CachedLayoutMixin are dropped by
+`invalidate_shared_layouts()`. Call `invalidate_layouts()` after changing
+indexes of columns by hand.
+"""
+import weakref
+from typing import Any, Callable
+
+_cached_metas = weakref.WeakSet()
+
+
+def invalidate_layout(meta) -> None:
+    meta.__dict__.pop('_layout_cache', None)
+
+
+def invalidate_layouts() -> None:
+    for meta in list(_cached_metas):
+        invalidate_layout(meta)
+
+
+def invalidate_shared_layouts(meta) -> None:
+    """
+    Drop the caches of the `_meta`s having any column of `meta`.
+    """
+    columns = {id(col) for col in meta.columns}
+    for cached in list(_cached_metas):
+        if any(id(col) in columns for col in cached.columns):
+            invalidate_layout(cached)
+
+
+class CachedOptionsMixin:
+    """
+    Mixed into the class of `_meta`. Cached lists are stored as tuples and
+    copied on return, so callers cannot change them.
+    """
+
+    def _get_cached(self, key: tuple, compute: Callable) -> Any:
+        version = len(self.columns)
+        cache = self.__dict__.get('_layout_cache')
+        if cache is None or cache['version'] != version:
+            cache = self.__dict__['_layout_cache'] = {'version': version}
+
+        if key not in cache:
+            cache[key] = compute()
+        return cache[key]
+
+    def get_columns(self, **kwargs) -> list:
+        return list(self._get_cached(
+            ('columns', tuple(sorted(kwargs.items()))),
+            lambda: tuple(super(CachedOptionsMixin, self).get_columns(**kwargs))
+        ))
+
+    def get_column(self, name: str):
+        columns = self._get_cached(
+            ('column_map',), lambda: {col.name: col for col in self.columns})
+        if name not in columns:
+            raise self.UnknownColumn(f'UnknownColumn `{name}`')
+        return columns[name]
+
+    def get_headers(self, for_read: bool = False, for_write: bool = False
+                    ) -> list[str]:
+        return list(self._get_cached(
+            ('headers', for_read, for_write),
+            lambda: tuple(super(CachedOptionsMixin, self).get_headers(
+                for_read=for_read, for_write=for_write))
+        ))
+
+    def get_r_indexes(self, original: bool = False) -> list:
+        return list(self._get_cached(
+            ('r_indexes', original),
+            lambda: tuple(super(CachedOptionsMixin, self).get_r_indexes(original))
+        ))
+
+    def get_w_indexes(self, original: bool = False) -> list:
+        return list(self._get_cached(
+            ('w_indexes', original),
+            lambda: tuple(super(CachedOptionsMixin, self).get_w_indexes(original))
+        ))
+
+    def __getstate__(self) -> dict:
+        # `as_part()` deep-copies `_meta`. The copy must not keep columns of
+        # the original in its cache.
+        state = self.__dict__.copy()
+        state.pop('_layout_cache', None)
+        return state
+
+
+_cached_classes: dict[type, type] = {}
+
+
+def cache_options(meta) -> None:
+    """
+    Make `meta` cache its column layout.
+    """
+    options_class = type(meta)
+    if issubclass(options_class, CachedOptionsMixin):
+        return
+
+    if options_class not in _cached_classes:
+        _cached_classes[options_class] = type(
+            f'Cached{options_class.__name__}',
+            (CachedOptionsMixin, options_class), {})
+    meta.__class__ = _cached_classes[options_class]
+    _cached_metas.add(meta)
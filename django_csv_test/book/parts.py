@@ -0,0 +1,60 @@
+"""
+LRU cache of rows read by parts. See `book.mixins.PartCacheMixin`.
+
+Rows of an import often repeat the same values of a part, e.g. the same
+publisher. The part reads the values once, and the other rows get a copy of
+the cached row whose errors have their own row number.
+"""
+import dataclasses
+from collections import OrderedDict
+from typing import Callable
+
+from django_csv.model_csv.csv.base import Row
+
+
+def freeze_static(static: dict) -> tuple:
+    """
+    Hashable key of `static`. Unhashable values are compared by identity.
+    """
+    items = []
+    for key, value in sorted(static.items()):
+        try:
+            hash(value)
+        except TypeError:
+            value = id(value)
+        items.append((key, value))
+    return tuple(items)
+
+
+class PartCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.rows: OrderedDict[tuple, Row] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple, number: int, read: Callable[[], Row]) -> Row:
+        """
+        Return a copy of the cached row for `number`, or call `read()` and
+        cache the result.
+        """
+        if (cached := self.rows.get(key)) is not None:
+            self.rows.move_to_end(key)
+            self.hits += 1
+            return self._copy(cached, number)
+
+        self.misses += 1
+        row = read()
+        self.rows[key] = self._copy(row, row.number)
+        if len(self.rows) > self.maxsize:
+            self.rows.popitem(last=False)
+        return row
+
+    @staticmethod
+    def _copy(row: Row, number: int) -> Row:
+        return Row(
+            number=number,
+            errors=[dataclasses.replace(error, row_number=number)
+                    for error in row.errors],
+            values=row._values.copy(),
+        )
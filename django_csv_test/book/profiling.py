@@ -0,0 +1,100 @@
+"""
+Opt-in instrumentation of row conversion. See `book.mixins.ProfilingMixin`.
+
+Profile records the time and the number of calls per column, `field_*` and
+`column_*` method, part callback and batch resolve function, and the time
+and the number of queries per phase.
+"""
+import contextlib
+import dataclasses
+import time
+from typing import Callable, Optional
+
+PARSE = 'parse'  # read cells and convert them from str.
+CLEAN = 'clean'  # `field_*` methods.
+RESOLVE = 'resolve'  # part callbacks and batch resolve functions.
+SAVE = 'save'  # bulk_save().
+WRITE = 'write'  # get_table() and iter_table().
+PHASES = (PARSE, CLEAN, RESOLVE, SAVE, WRITE)
+
+COLUMN = 'column'
+HOOK = 'hook'
+CALLBACK = 'callback'
+
+
+@dataclasses.dataclass
+class Stat:
+    calls: int = 0
+    seconds: float = 0.0
+
+
+class Profile:
+    def __init__(self):
+        self.stats: dict[tuple[str, str], Stat] = {}
+        self.phases = {phase: Stat() for phase in PHASES}
+        self.queries = dict.fromkeys(PHASES + ('other',), 0)
+        self.current_phase: Optional[str] = None
+
+    def get_stat(self, kind: str, name: str) -> Stat:
+        if (kind, name) not in self.stats:
+            self.stats[(kind, name)] = Stat()
+        return self.stats[(kind, name)]
+
+    def wrap(self, kind: str, name: str, func: Callable) -> Callable:
+        """
+        Return `func` recording its time to the stat of `kind` and `name`.
+        """
+        stat = self.get_stat(kind, name)
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stat.calls += 1
+                stat.seconds += time.perf_counter() - start
+
+        return timed
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        previous, self.current_phase = self.current_phase, name
+        stat = self.phases[name]
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stat.calls += 1
+            stat.seconds += time.perf_counter() - start
+            self.current_phase = previous
+
+    def __call__(self, execute, sql, params, many, context):
+        """
+        Used as `connection.execute_wrapper()` to count queries per phase.
+        """
+        self.queries[self.current_phase or 'other'] += 1
+        return execute(sql, params, many, context)
+
+    def get_report(self) -> dict:
+        """
+        JSON serializable report. Stats are sorted by time.
+        """
+        stats = sorted(self.stats.items(), key=lambda item: -item[1].seconds)
+        return {
+            'stats': [
+                {'kind': kind, 'name': name, **dataclasses.asdict(stat)}
+                for (kind, name), stat in stats
+            ],
+            'phases': {
+                phase: {**dataclasses.asdict(stat), 'queries': self.queries[phase]}
+                for phase, stat in self.phases.items()
+            },
+            'other_queries': self.queries['other'],
+        }
+
+
+def phase(profile: Optional[Profile], name: str):
+    """
+    `profile.phase(name)` or a context manager doing nothing.
+    """
+    return profile.phase(name) if profile else contextlib.nullcontext()
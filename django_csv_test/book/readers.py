@@ -0,0 +1,126 @@
+"""
+CSV and TSV readers which decode an upload incrementally.
+
+The readers of the library read the whole file into memory and decode it at
+once. These readers wrap the binary file with TextIOWrapper and yield rows
+one by one. They parse the same dialect as the library, which only sets the
+delimiter. Set `sniff_dialect` to sniff the quote character from the first
+`sniff_size` characters instead.
+"""
+import codecs
+import collections
+import csv
+import io
+import itertools
+from typing import Iterator, Optional
+
+from django_csv.model_csv.readers import Reader
+
+
+class StreamingCsvBase(Reader):
+    delimiter = None
+    # sniff `quotechar` and `skipinitialspace`, which the library does not.
+    sniff_dialect = False
+    # the number of characters passed to csv.Sniffer.
+    sniff_size = 16 * 1024
+    # the number of bytes read at a time to skip rows.
+    skip_size = 1024 * 1024
+
+    def get_dialect(self, sample: str) -> type[csv.Dialect]:
+        if not self.sniff_dialect:
+            class Dialect(csv.excel):
+                delimiter = self.delimiter
+
+            return Dialect
+        return self.sniff(sample)
+
+    def sniff(self, sample: str) -> type[csv.Dialect]:
+        try:
+            sniffed = csv.Sniffer().sniff(sample, delimiters=self.delimiter)
+        except csv.Error:
+            sniffed = csv.excel
+
+        class Dialect(csv.excel):
+            delimiter = self.delimiter
+            # Sniffer says `doublequote` is False if the sample has no
+            # escaped quotes, so only the following are taken.
+            quotechar = sniffed.quotechar
+            skipinitialspace = sniffed.skipinitialspace
+
+        return Dialect
+
+    def iter_table(self, table_starts_from: Optional[int] = None) -> Iterator[list]:
+        """
+        Yield rows one by one. The file is not closed.
+        """
+        table_starts_from = self.table_starts_from \
+            if table_starts_from is None else table_starts_from
+        text = io.TextIOWrapper(self.file, encoding=self.encoding, newline='')
+
+        try:
+            # read whole lines so that the sample can be passed to csv.reader.
+            sample, size = [], 0
+            for line in text if self.sniff_dialect else ():
+                sample.append(line)
+                size += len(line)
+                if size >= self.sniff_size:
+                    break
+
+            rows = csv.reader(itertools.chain(sample, text),
+                              dialect=self.get_dialect(''.join(sample)))
+            yield from itertools.islice(rows, table_starts_from, None)
+        finally:
+            text.detach()
+
+    def iter_table_with_offsets(self, resume_from: int = 0
+                                ) -> Iterator[tuple[int, list]]:
+        """
+        Yield (offset, row) where `offset` is the byte offset of the file
+        after the row. The first row (the headers) is always yielded, and
+        the rows after it start from `resume_from`, which must be 0 or an
+        offset yielded before. The file is only read forward from its
+        current position, so it may be a decompressing file which cannot
+        seek. The file is split into lines before it is decoded, so the
+        encoding must be ASCII compatible.
+        """
+        sample, size = collections.deque(), 0
+        for line in iter(self.file.readline, b'') if self.sniff_dialect else ():
+            sample.append(line)
+            size += len(line)
+            if size >= self.sniff_size:
+                break
+        dialect = self.get_dialect(b''.join(sample).decode(self.encoding))
+        decoder = codecs.getincrementaldecoder(self.encoding)()
+        offset = 0
+
+        def readline() -> bytes:
+            return sample.popleft() if sample else self.file.readline()
+
+        def iter_lines() -> Iterator[str]:
+            nonlocal offset
+            for line in iter(readline, b''):
+                offset += len(line)
+                yield decoder.decode(line)
+
+        # csv.reader takes lines only until a row ends.
+        for row in csv.reader(iter_lines(), dialect=dialect):
+            yield offset, row
+            # skip the rows before `resume_from` by reading them.
+            while offset < resume_from and sample:
+                offset += len(sample.popleft())
+            while offset < resume_from:
+                data = self.file.read(min(resume_from - offset, self.skip_size))
+                if not data:
+                    raise ValueError(f'{resume_from} is beyond the end of the file.')
+                offset += len(data)
+
+    def get_table(self, table_starts_from: Optional[int] = None) -> list:
+        return list(self.iter_table(table_starts_from))
+
+
+class StreamingCsvReader(StreamingCsvBase):
+    delimiter = ','
+
+
+class StreamingTsvReader(StreamingCsvBase):
+    delimiter = '\t'
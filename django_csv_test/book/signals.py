@@ -0,0 +1,6 @@
+from django.dispatch import Signal
+
+# sent when a profiled csv finishes `is_valid()`, `bulk_save()` or
+# `get_table()`. kwargs: `csv` and `report` (see `Profile.get_report()`).
+# `sender` is the csv class.
+conversion_profiled = Signal()
@@ -1,29 +1,76 @@
+import bz2
+import contextlib
+import csv
+import gzip
+import hashlib
+import io
+import lzma
 import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
 from pathlib import Path
+from unittest import mock
 
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.test import TestCase, Client
+from django.contrib.auth.models import Permission
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, Client, override_settings
 from django.urls import reverse
 
-from book.models import Book, Publisher
+from book import compression
+from book.excel import ReadOnlyXlsxReader
+from book.jobs import beat, claim_job, run_job
+from book.mcsv import BookWithPublisherCsv
+from book.models import Book, ImportCheckpoint, ImportJob, Publisher
+from book.readers import StreamingCsvReader, StreamingTsvReader
+from book.tests.factories import BookFactory
+from django_csv.model_csv.readers import CsvReader, TsvReader, XlsxReader
 
 User = get_user_model()
 
 TEST_DATA_DIR = Path(os.path.dirname(__file__)) / 'test_data'
 
 
+MEDIA_ROOT = tempfile.mkdtemp()
+
+
+def shared_caches(location: str) -> dict:
+    return {'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': location,
+    }}
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT,
+                   CSV_IMPORT_EXECUTOR='book.jobs.ImmediateJobExecutor')
 class ViewTest(TestCase):
     url = reverse('admin:book_book_upload_csv')
-    redirect_to = reverse('admin:book_book_changelist')
 
     @classmethod
     def setUpTestData(cls) -> None:
         cls.user = User.objects.create_superuser(username='admin')
 
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+        super().tearDownClass()
+
     def setUp(self) -> None:
         self.client = Client()
         self.client.force_login(user=self.user)
 
+    @property
+    def redirect_to(self) -> str:
+        job = ImportJob.objects.latest('pk')
+        return reverse('admin:book_book_import_job', args=[job.pk])
+
     def test_upload_csv(self):
         self.assertEqual(Book.objects.count(), 0)
         self.assertEqual(Publisher.objects.count(), 0)
@@ -67,3 +114,507 @@ class ViewTest(TestCase):
 
         self.assertEqual(Book.objects.count(), 50)
         self.assertGreater(Publisher.objects.count(), 0)
+
+    def test_upload_compressed(self):
+        with open(TEST_DATA_DIR / 'book.csv', 'br') as f:
+            content = f.read()
+
+        for name, compress in [('book.csv.gz', gzip.compress),
+                               ('book.csv.bz2', bz2.compress),
+                               ('book.csv.xz', lzma.compress),
+                               # detected by the magic bytes.
+                               ('book.csv', gzip.compress)]:
+            with self.subTest(name):
+                Book.objects.all().delete()
+                file = SimpleUploadedFile(name, compress(content))
+                resp = self.client.post(self.url, {'file': file, 'only_exists': False})
+                self.assertRedirects(resp, expected_url=self.redirect_to)
+
+                job = ImportJob.objects.latest('pk')
+                self.assertEqual(job.status, ImportJob.Status.SUCCEEDED, job.message)
+                self.assertEqual(Book.objects.count(), 50)
+
+        resp = self.client.post(self.url, {
+            'file': SimpleUploadedFile('book.gz', gzip.compress(content))})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(ImportJob.objects.count(), 4)
+
+    def test_import_job_errors(self):
+        with open(TEST_DATA_DIR / 'book.csv', 'br') as f:
+            resp = self.client.post(self.url, {'file': f, 'only_exists': True})
+        self.assertRedirects(resp, expected_url=self.redirect_to)
+
+        job = ImportJob.objects.get()
+        self.assertEqual(job.status, ImportJob.Status.FAILED)
+        self.assertEqual(job.processed_rows, 50)
+        self.assertEqual(len(job.errors), 50)
+        self.assertEqual(Book.objects.count(), 0)
+        self.assertEqual(Publisher.objects.count(), 0)
+
+        resp = self.client.get(self.redirect_to)
+        self.assertContains(resp, 'Failed')
+        self.assertContains(resp, 'publisher__callback', count=50)
+
+    def test_import_job_permission(self):
+        with open(TEST_DATA_DIR / 'book.csv', 'br') as f:
+            self.client.post(self.url, {'file': f, 'only_exists': False})
+        job = ImportJob.objects.get()
+
+        # a job of books is not shown by the admin of publishers.
+        resp = self.client.get(reverse('admin:book_publisher_import_job', args=[job.pk]))
+        self.assertEqual(resp.status_code, 404)
+
+        staff = User.objects.create_user(username='staff', is_staff=True)
+        self.client.force_login(user=staff)
+        self.assertEqual(self.client.get(self.redirect_to).status_code, 403)
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+
+        staff.user_permissions.add(Permission.objects.get(codename='view_book'))
+        self.assertEqual(self.client.get(self.redirect_to).status_code, 200)
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+
+    def test_interrupted_import_job(self):
+        with self.settings(CSV_IMPORT_EXECUTOR='book.jobs.DatabaseJobExecutor'):
+            with open(TEST_DATA_DIR / 'book.csv', 'br') as f:
+                self.client.post(self.url, {'file': f, 'only_exists': False})
+        job = ImportJob.objects.get()
+
+        with mock.patch('book.jobs.import_file', side_effect=SystemExit):
+            with self.assertRaises(SystemExit):
+                run_job(job.pk)
+        job.refresh_from_db()
+        self.assertEqual(job.status, ImportJob.Status.FAILED)
+        self.assertEqual(job.message, 'The import is interrupted.')
+
+    def test_pending_import_job(self):
+        with self.settings(CSV_IMPORT_EXECUTOR='book.jobs.DatabaseJobExecutor'):
+            with open(TEST_DATA_DIR / 'book.csv', 'br') as f:
+                resp = self.client.post(self.url, {'file': f, 'only_exists': False})
+        self.assertRedirects(resp, expected_url=self.redirect_to)
+
+        job = ImportJob.objects.get()
+        self.assertEqual(job.status, ImportJob.Status.PENDING)
+        self.assertEqual(Book.objects.count(), 0)
+        self.assertContains(self.client.get(self.redirect_to), 'Pending')
+
+        # the progress would not reach the web process.
+        with self.assertRaises(CommandError):
+            call_command('run_import_jobs', once=True, stdout=io.StringIO())
+
+        with tempfile.TemporaryDirectory() as tmp, self.settings(CACHES=shared_caches(tmp)):
+            call_command('run_import_jobs', once=True, stdout=io.StringIO())
+        job.refresh_from_db()
+        self.assertEqual(job.status, ImportJob.Status.SUCCEEDED)
+        self.assertEqual(Book.objects.count(), 50)
+
+    def test_stale_import_job(self):
+        with self.settings(CSV_IMPORT_EXECUTOR='book.jobs.DatabaseJobExecutor'):
+            with open(TEST_DATA_DIR / 'book.csv', 'br') as f:
+                self.client.post(self.url, {'file': f, 'only_exists': False})
+        job = ImportJob.objects.get()
+        # the worker is killed after claiming the job.
+        self.assertTrue(claim_job(job.pk))
+
+        with tempfile.TemporaryDirectory() as tmp, self.settings(CACHES=shared_caches(tmp)):
+            call_command('run_import_jobs', once=True, stdout=io.StringIO())
+            job.refresh_from_db()
+            self.assertEqual(job.status, ImportJob.Status.RUNNING)
+
+            with self.settings(CSV_IMPORT_JOB_TIMEOUT=0):
+                call_command('run_import_jobs', once=True, stdout=io.StringIO())
+        job.refresh_from_db()
+        self.assertEqual(job.status, ImportJob.Status.FAILED)
+        self.assertEqual(job.message, 'The worker of the import stopped responding.')
+
+        # a reaped job stops at the next chunk.
+        with self.assertRaisesMessage(RuntimeError, 'stopped responding'):
+            beat(job)
+
+
+class DownloadTest(TestCase):
+    url = reverse('admin:book_book_changelist')
+
+    @classmethod
+    def setUpTestData(cls) -> None:
+        cls.user = User.objects.create_superuser(username='admin')
+        BookFactory.create_batch(10, publisher__registered_by_id=cls.user.pk)
+
+    def setUp(self) -> None:
+        self.client = Client()
+        self.client.force_login(user=self.user)
+
+    def test_download_csv(self):
+        queryset = Book.objects.order_by('id')
+        for action, delimiter in [('download_csv', ','), ('download_tsv', '\t')]:
+            with self.subTest(action):
+                resp = self.client.post(self.url, {
+                    'action': action,
+                    '_selected_action': [book.pk for book in queryset],
+                })
+                self.assertTrue(resp.streaming)
+                content = b''.join(resp.streaming_content).decode('utf-8')
+                table = list(csv.reader(io.StringIO(content), delimiter=delimiter))
+                self.assertListEqual(
+                    sorted(table[1:]),
+                    sorted(BookWithPublisherCsv.for_write(
+                        instances=queryset).get_table(header=False))
+                )
+
+    def test_download_csv_gz(self):
+        queryset = Book.objects.order_by('id')
+        resp = self.client.post(self.url, {
+            'action': 'download_csv_gz',
+            '_selected_action': [book.pk for book in queryset],
+        })
+        self.assertTrue(resp.streaming)
+        self.assertEqual(resp['Content-Type'], 'application/gzip')
+        self.assertIn('book.csv.gz', resp['Content-Disposition'])
+        content = gzip.decompress(b''.join(resp.streaming_content)).decode('utf-8')
+        self.assertListEqual(
+            sorted(list(csv.reader(io.StringIO(content)))[1:]),
+            sorted(BookWithPublisherCsv.for_write(
+                instances=queryset).get_table(header=False))
+        )
+
+    def test_compression(self):
+        content = b'a,b\n' * 10_000
+        for method, decompress in [(compression.GZIP, gzip.decompress),
+                                   (compression.BZIP2, bz2.decompress),
+                                   (compression.XZ, lzma.decompress)]:
+            with self.subTest(method):
+                compressed = b''.join(compression.compress(
+                    (content[i:i + 1000] for i in range(0, len(content), 1000)),
+                    method))
+                self.assertEqual(decompress(compressed), content)
+
+                file = io.BytesIO(compressed)
+                self.assertEqual(compression.detect(file), method)
+                self.assertEqual(file.tell(), 0)
+                with compression.open_decompressed(file) as f:
+                    self.assertEqual(f.read(), content)
+                self.assertFalse(file.closed)
+
+        file = io.BytesIO(content)
+        self.assertIsNone(compression.detect(file))
+        self.assertIs(compression.open_decompressed(file), file)
+
+    def test_download_xlsx(self):
+        queryset = Book.objects.order_by('id')
+        resp = self.client.post(self.url, {
+            'action': 'download_xlsx',
+            '_selected_action': [book.pk for book in queryset],
+        })
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.streaming)
+        self.assertIn('attachment', resp['Content-Disposition'])
+
+        reader = ReadOnlyXlsxReader(file=io.BytesIO(b''.join(resp.streaming_content)))
+        self.assertListEqual(
+            sorted(reader.get_table()[1:]),
+            sorted(BookWithPublisherCsv.for_write(
+                instances=queryset).get_table(header=False))
+        )
+
+    def test_read_only_xlsx_reader(self):
+        with open(TEST_DATA_DIR / 'book.xlsx', 'br') as f:
+            table = XlsxReader(file=f).get_table()
+        with open(TEST_DATA_DIR / 'book.xlsx', 'br') as f:
+            rows = ReadOnlyXlsxReader(file=f).iter_table()
+            self.assertNotIsInstance(rows, list)
+            self.assertListEqual(list(rows), table)
+
+    def test_streaming_csv_reader(self):
+        for name, library_class, reader_class in [
+                ('book.csv', CsvReader, StreamingCsvReader),
+                ('book.tsv', TsvReader, StreamingTsvReader)]:
+            with self.subTest(name):
+                with open(TEST_DATA_DIR / name, 'br') as f:
+                    table = library_class(file=io.BytesIO(f.read())).get_table()
+                with open(TEST_DATA_DIR / name, 'br') as f:
+                    rows = reader_class(file=f).iter_table()
+                    self.assertNotIsInstance(rows, list)
+                    self.assertListEqual(list(rows), table)
+                    self.assertFalse(f.closed)
+
+                # resume from every row reading the file only forward.
+                with open(TEST_DATA_DIR / name, 'br') as f:
+                    content = f.read()
+                offsets = list(reader_class(file=io.BytesIO(content)).iter_table_with_offsets())
+                self.assertListEqual([row for _, row in offsets], table)
+                for i, (offset, _) in enumerate(offsets):
+                    for sniff_dialect in (False, True):
+                        reader = reader_class(file=ForwardOnlyFile(content))
+                        # sniff only the first lines.
+                        reader.sniff_dialect, reader.sniff_size = sniff_dialect, 300
+                        self.assertListEqual(
+                            [row for _, row in reader.iter_table_with_offsets(offset)],
+                            table[:1] + table[i + 1:]
+                        )
+
+    def test_streaming_csv_reader_dialect(self):
+        readers = {'.csv': (CsvReader, StreamingCsvReader),
+                   '.tsv': (TsvReader, StreamingTsvReader)}
+        files = [(path.name, path.read_bytes()) for path in sorted(TEST_DATA_DIR.iterdir())
+                 if path.suffix in readers]
+        self.assertTrue(files)
+        # quotes which csv.Sniffer would take for the quote character.
+        files.append(('quotes.csv', b"title,price\n'a,b',1\n'c',2\n"))
+
+        for name, content in files:
+            library_class, reader_class = readers[os.path.splitext(name)[1]]
+            with self.subTest(name):
+                table = library_class(file=io.BytesIO(content)).get_table()
+                self.assertListEqual(
+                    reader_class(file=io.BytesIO(content)).get_table(), table)
+                self.assertListEqual(
+                    [row for _, row in reader_class(
+                        file=io.BytesIO(content)).iter_table_with_offsets()],
+                    table
+                )
+
+        # sniffing is opt-in.
+        reader = StreamingCsvReader(file=io.BytesIO(files[-1][1]))
+        reader.sniff_dialect = True
+        self.assertListEqual(reader.get_table(), [['title', 'price'], ['a,b', '1'], ['c', '2']])
+
+
+class ForwardOnlyFile(io.BytesIO):
+    """
+    A file which cannot seek, e.g. a decompressing zstd file.
+    """
+    def seekable(self) -> bool:
+        return False
+
+    def seek(self, *args, **kwargs):
+        raise io.UnsupportedOperation('seek')
+
+
+class AsyncExportTest(TestCase):
+    url = reverse('book:export')
+
+    @classmethod
+    def setUpTestData(cls) -> None:
+        cls.user = User.objects.create_superuser(username='admin')
+        BookFactory.create_batch(10, publisher__registered_by_id=cls.user.pk)
+
+    async def test_export(self):
+        await sync_to_async(self.async_client.force_login)(user=self.user)
+        table = await sync_to_async(
+            lambda: BookWithPublisherCsv.for_write(
+                instances=Book.objects.order_by('id')).get_table())()
+
+        for extension, delimiter in [('csv', ','), ('tsv', '\t')]:
+            with self.subTest(extension):
+                resp = await self.async_client.get(self.url, {'format': extension})
+                self.assertTrue(resp.streaming)
+                self.assertTrue(resp.is_async)
+                self.assertIn(f'books.{extension}', resp['Content-Disposition'])
+                content = b''.join([chunk async for chunk in resp.streaming_content])
+                self.assertListEqual(
+                    list(csv.reader(io.StringIO(content.decode('utf-8')),
+                                    delimiter=delimiter)),
+                    table
+                )
+
+        resp = await self.async_client.get(self.url, {'compression': 'xz'})
+        self.assertIn('books.csv.xz', resp['Content-Disposition'])
+        content = b''.join([chunk async for chunk in resp.streaming_content])
+        self.assertListEqual(
+            list(csv.reader(io.StringIO(lzma.decompress(content).decode('utf-8')))),
+            table
+        )
+
+    async def test_aiter_table_prefetch_related(self):
+        instances = Book.objects.prefetch_related('authors').order_by('id')
+        table = await sync_to_async(
+            lambda: BookWithPublisherCsv.for_write(instances=instances).get_table())()
+
+        mcsv = BookWithPublisherCsv.for_write(instances=instances)
+        self.assertListEqual(
+            [row async for row in mcsv.aiter_table(chunk_size=3)],
+            table
+        )
+
+    async def test_permission(self):
+        resp = await self.async_client.get(self.url)
+        self.assertEqual(resp.status_code, 302)
+
+        await sync_to_async(self.async_client.force_login)(user=self.user)
+        resp = await self.async_client.get(self.url, {'format': 'xlsx'})
+        self.assertEqual(resp.status_code, 404)
+        resp = await self.async_client.get(self.url, {'compression': 'zip'})
+        self.assertEqual(resp.status_code, 404)
+
+
+# imports a job in a subprocess and waits to be killed after 20 rows are committed.
+IMPORT_SCRIPT = """
+import sys
+import time
+
+import django
+from django.conf import settings
+
+settings.DATABASES['default']['NAME'] = sys.argv[1]
+settings.MEDIA_ROOT = sys.argv[2]
+settings.CSV_IMPORT_CHUNK_SIZE = 10
+django.setup()
+
+from django.db import transaction
+from django.db.models.signals import post_save
+
+from book.jobs import beat, claim_job, run_job
+from book.models import ImportCheckpoint
+
+
+def wait():
+    print('committed', flush=True)
+    time.sleep(60)
+
+
+def on_checkpoint(instance, **kwargs):
+    if instance.row_number == 20:
+        transaction.on_commit(wait)
+
+
+post_save.connect(on_checkpoint, sender=ImportCheckpoint)
+run_job(int(sys.argv[3]))
+"""
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, CSV_IMPORT_CHUNK_SIZE=10,
+                   CSV_IMPORT_EXECUTOR='book.jobs.ImmediateJobExecutor')
+class ResumableImportTest(TransactionTestCase):
+    url = reverse('admin:book_book_upload_csv')
+
+    def setUp(self) -> None:
+        self.user = User.objects.create_superuser(username='admin')
+        self.client.force_login(user=self.user)
+        with open(TEST_DATA_DIR / 'book.csv', 'br') as f:
+            self.content = f.read()
+        self.table = CsvReader(file=io.BytesIO(self.content)).get_table()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+        super().tearDownClass()
+
+    def upload(self, content: bytes, name: str = 'book.csv') -> ImportJob:
+        self.client.post(self.url, {
+            'file': SimpleUploadedFile(name, content),
+            'only_exists': False, 'resumable': True,
+        })
+        return ImportJob.objects.latest('pk')
+
+    @contextlib.contextmanager
+    def database_file(self):
+        """
+        Copy an in-memory test database to a file for a subprocess, and copy
+        it back when the subprocess ends.
+        """
+        if not connection.is_in_memory_db():
+            yield connection.settings_dict['NAME']
+            return
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'db.sqlite3')
+            connection.ensure_connection()
+            with contextlib.closing(sqlite3.connect(path)) as target:
+                connection.connection.backup(target)
+            yield path
+            with contextlib.closing(sqlite3.connect(path)) as source:
+                source.backup(connection.connection)
+
+    def test_resume_killed_import(self):
+        with self.settings(CSV_IMPORT_EXECUTOR='book.jobs.DatabaseJobExecutor'):
+            job = self.upload(self.content)
+        self.assertTrue(job.resumable)
+
+        with self.database_file() as path:
+            process = subprocess.Popen(
+                [sys.executable, '-c', IMPORT_SCRIPT, path, MEDIA_ROOT, str(job.pk)],
+                stdout=subprocess.PIPE, cwd=settings.BASE_DIR,
+                env={**os.environ, 'PYTHONPATH': os.pathsep.join(sys.path)},
+            )
+            try:
+                self.assertEqual(process.stdout.readline().strip(), b'committed')
+            finally:
+                process.kill()
+                process.wait()
+                process.stdout.close()
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, ImportJob.Status.RUNNING)
+        # the progress of a resumable job is saved with the chunks.
+        self.assertEqual(job.processed_rows, 20)
+        self.assertEqual(Book.objects.count(), 20)
+        checkpoint = ImportCheckpoint.objects.get()
+        self.assertEqual(checkpoint.row_number, 20)
+        self.assertEqual(checkpoint.job, job)
+        # the offset is after the 20th row.
+        reader = StreamingCsvReader(file=io.BytesIO(self.content))
+        self.assertListEqual(
+            [row for _, row in reader.iter_table_with_offsets(checkpoint.offset)],
+            self.table[:1] + self.table[21:]
+        )
+
+        # the killed job could still be running.
+        refused = self.upload(self.content)
+        self.assertEqual(refused.status, ImportJob.Status.FAILED)
+        self.assertEqual(refused.message, 'The same file is being imported by another job.')
+        self.assertEqual(ImportCheckpoint.objects.get().job, job)
+        self.assertEqual(Book.objects.count(), 20)
+
+        with self.settings(CSV_IMPORT_CHECKPOINT_TIMEOUT=0):
+            resumed = self.upload(self.content)
+        self.assertEqual(resumed.status, ImportJob.Status.SUCCEEDED, resumed.message)
+        self.assertEqual(resumed.message, '50 rows are saved. Resumed after row 20.')
+        self.assertFalse(ImportCheckpoint.objects.exists())
+        job.refresh_from_db()
+        self.assertEqual(job.status, ImportJob.Status.FAILED)
+        self.assertEqual(job.message, f'The import is taken over by job {resumed.pk}.')
+        self.assertListEqual(
+            sorted(Book.objects.values_list('title', flat=True)),
+            sorted(row[0] for row in self.table[1:])
+        )
+
+    def test_resume_compressed(self):
+        # the offset of the decompressed file after the 20th row.
+        offset = list(StreamingCsvReader(
+            file=io.BytesIO(self.content)).iter_table_with_offsets())[20][0]
+
+        for name, compress in [('book.csv.gz', gzip.compress),
+                               ('book.csv.bz2', bz2.compress),
+                               ('book.csv.xz', lzma.compress)]:
+            with self.subTest(name):
+                Book.objects.all().delete()
+                content = compress(self.content)
+                ImportCheckpoint.objects.create(
+                    csv_class='book.mcsv.BookWithPublisherCsv',
+                    file_hash=hashlib.sha256(content).hexdigest(),
+                    row_number=20, offset=offset)
+
+                job = self.upload(content, name=name)
+                self.assertEqual(job.status, ImportJob.Status.SUCCEEDED, job.message)
+                self.assertEqual(job.message, '50 rows are saved. Resumed after row 20.')
+                self.assertListEqual(
+                    sorted(Book.objects.values_list('title', flat=True)),
+                    sorted(row[0] for row in self.table[21:])
+                )
+
+    def test_invalid_chunk(self):
+        self.table[25][8] = ''  # City
+        f = io.StringIO()
+        csv.writer(f).writerows(self.table)
+        content = f.getvalue().encode()
+
+        job = self.upload(content)
+        self.assertEqual(job.status, ImportJob.Status.FAILED)
+        self.assertEqual(job.message, '1 errors are found. 20 rows before them are saved.')
+        self.assertEqual(job.errors[0]['row_number'], 24)
+        self.assertEqual(Book.objects.count(), 20)
+
+        job = self.upload(content)
+        self.assertEqual(job.status, ImportJob.Status.FAILED)
+        self.assertIn('Resumed after row 20.', job.message)
+        self.assertEqual(ImportCheckpoint.objects.get().row_number, 20)
+        self.assertEqual(Book.objects.count(), 20)
@@ -1,16 +1,35 @@
+import contextlib
+import io
+import os
 import random
+import sqlite3
+import tempfile
 from datetime import datetime, timezone, timedelta
+from unittest import mock
 
 from django.conf import settings
+from django.core.cache import caches
+from django.db import DatabaseError, connection
+from django.db.models import QuerySet
 from django.contrib.auth import get_user_model
-from django.test import TestCase
-
-from book.models import Book, Author, Publisher
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+
+from book import changes, compiled, profiling
+from book.mcsv import BookCsv, BookWithPublisherCsv, PublisherCsv
+from book.mixins import (
+    BatchMixin, BulkSaveMixin, CachedLayoutMixin, CompiledRowMixin, ValuesListMixin,
+    bump_export_generation
+)
+from book.models import Book, Author, Publisher, RowDigest
+from book.signals import conversion_profiled
 from book.tests.factories import AuthorFactory, BookFactory
 from django_csv.model_csv import ValidationError
 from django_csv.model_csv import columns
 from django_csv.model_csv.columns import ColumnValidationError
 from django_csv.model_csv.csv.django import DjangoCsv
+from django_csv.model_csv.csv.django.metaclasses import DjangoOptions
+from django_csv.model_csv.writers import CsvWriter
 
 User = get_user_model()
 
@@ -68,6 +87,670 @@ class DjangoCsvForWriteTest(TestCase):
 
                 self.assertEqual(val, row[x])
 
+    def test_iter_table(self):
+        for_write = BookWithPublisherCsv.for_write(instances=self.all_queryset)
+        table = for_write.get_table()
+        self.assertListEqual(list(for_write.iter_table(chunk_size=7)), table)
+        self.assertListEqual(
+            list(for_write.iter_table(header=False)), table[1:])
+
+        # a list of instances is also available.
+        for_write = BookWithPublisherCsv.for_write(
+            instances=list(self.all_queryset))
+        self.assertListEqual(list(for_write.iter_table()), table)
+
+    def test_query_plan(self):
+        self.assertListEqual(
+            BookWithPublisherCsv.get_related_lookups(),
+            ['publisher__registered_by']
+        )
+
+        # the number of queries doesn't depend on the number of rows.
+        for size in (1, 10, 50):
+            with self.subTest(size), self.assertNumQueries(1):
+                for_write = BookWithPublisherCsv.for_write(
+                    instances=self.all_queryset[:size])
+                self.assertEqual(len(for_write.get_table(header=False)), size)
+
+            with self.subTest(size), self.assertNumQueries(1):
+                for_write = BookWithPublisherCsv.for_write(
+                    instances=self.all_queryset[:size])
+                self.assertEqual(
+                    len(list(for_write.iter_table(header=False))), size)
+
+    def test_batch_part_callback(self):
+        table = BookWithPublisherCsv.for_write(
+            instances=self.all_queryset).get_table(header=False)
+
+        # users and publishers are fetched once each.
+        with self.assertNumQueries(2):
+            for_read = BookWithPublisherCsv.for_read(table=table)
+            self.assertTrue(for_read.is_valid())
+        for obj, row in zip(self.all_queryset, for_read.cleaned_rows):
+            self.assertEqual(obj.publisher, row['publisher'])
+
+        new_table = [
+            row[:6] + [f'new publisher {i % 2}', 'Japan', 'Tokyo', 'new user']
+            for i, row in enumerate(table)
+        ]
+        pbl_cnt, user_cnt = Publisher.objects.count(), User.objects.count()
+        for_read = BookWithPublisherCsv.for_read(table=new_table)
+        for_read.set_static('only_exists', True)
+        self.assertFalse(for_read.is_valid())
+        for row in for_read.cleaned_rows:
+            self.assertEqual(len(row.errors), 1)
+            self.assertEqual(row.errors[0].name, 'publisher__callback')
+            self.assertEqual(row.errors[0].label, 'Publisher')
+
+        self.assertEqual(Publisher.objects.count(), pbl_cnt)
+
+        for_read = BookWithPublisherCsv.for_read(table=new_table)
+        for_read.set_static('only_exists', False)
+        self.assertTrue(for_read.is_valid())
+        self.assertEqual(Publisher.objects.count(), pbl_cnt + 2)
+        self.assertEqual(User.objects.count(), user_cnt + 1)
+        for i, row in enumerate(for_read.cleaned_rows):
+            self.assertEqual(row['publisher'].name, f'new publisher {i % 2}')
+            self.assertEqual(row['publisher'].headquarter, 'Tokyo, Japan')
+            self.assertEqual(row['publisher'].registered_by.username, 'new user')
+
+    def test_bulk_save(self):
+        # `auto_assign` of a subclass of BookWithPublisherCsv would renumber the
+        # part columns of BookWithPublisherCsv itself, which worker processes
+        # of later tests don't see.
+        class BookWithAuthorsCsv(BatchMixin, BulkSaveMixin, DjangoCsv):
+            pbl = PublisherCsv.as_part(related_name='publisher', callback='get_publisher')
+            pbl_name = pbl.AttributeColumn(header='Publisher', attr_name='name')
+            pbl_country = pbl.MethodColumn(
+                header='Country', method_suffix='country', value_name='country')
+            pbl_city = pbl.MethodColumn(header='City', method_suffix='city', value_name='city')
+            pbl_registered_by = pbl.MethodColumn(
+                header='Registered By', method_suffix='registered_by',
+                value_name='registered_by'
+            )
+            authors = columns.MethodColumn(header='Authors')
+
+            class Meta:
+                model = Book
+                fields = '__all__'
+                auto_assign = True
+
+            def column_authors(self, instance: Book, **kwargs) -> str:
+                return '|'.join(str(author.pk) for author in instance.authors.all())
+
+            def field_authors(self, values: dict, **kwargs) -> list[int]:
+                return [int(pk) for pk in values['authors'].split('|')]
+
+        def get_snapshot():
+            return {
+                book.title: (book.price, book.publisher_id,
+                             set(book.authors.values_list('pk', flat=True)))
+                for book in Book.objects.all()
+            }
+
+        snapshot = get_snapshot()
+        table = BookWithAuthorsCsv.for_write(
+            instances=self.all_queryset).get_table(header=False)
+        Book.objects.all().delete()
+
+        for_read = BookWithAuthorsCsv.for_read(table=table)
+        self.assertTrue(for_read.is_valid())
+        for_read.bulk_save(batch_size=7)
+        self.assertDictEqual(get_snapshot(), snapshot)
+
+        # backends which don't return primary keys from bulk inserts.
+        Book.objects.all().delete()
+        with mock.patch.object(type(connection.features),
+                               'can_return_rows_from_bulk_insert', False), \
+                CaptureQueriesContext(connection) as queries:
+            BookWithAuthorsCsv.for_read(table=table).bulk_save(batch_size=7)
+        self.assertDictEqual(get_snapshot(), snapshot)
+        # books are inserted one by one.
+        self.assertEqual(
+            len([query for query in queries
+                 if query['sql'].startswith('INSERT INTO "book_book"')]),
+            len(table))
+
+        # update existing books which have the same title.
+        price_index = BookWithAuthorsCsv._meta.get_column('price').get_w_index()
+        for row in table:
+            row[price_index] = '100'
+        first_author = Author.objects.order_by('pk').first()
+        authors_index = BookWithAuthorsCsv._meta.get_column('authors').get_w_index()
+        table[0][authors_index] = str(first_author.pk)
+        for_read = BookWithAuthorsCsv.for_read(table=table)
+        self.assertTrue(for_read.is_valid())
+        # savepoint, select books, update, select, delete and insert authors
+        # of the first book, release.
+        with self.assertNumQueries(7):
+            for_read.bulk_save(update_conflicts=True, unique_fields=['title'])
+
+        self.assertEqual(Book.objects.count(), 50)
+        self.assertFalse(Book.objects.exclude(price=100).exists())
+        book = Book.objects.get(title=table[0][0])
+        self.assertListEqual(list(book.authors.all()), [first_author])
+
+    def test_lookup_columns(self):
+        table = BookWithPublisherCsv.for_write(
+            instances=self.all_queryset).get_table(header=False)
+        price_index = BookWithPublisherCsv._meta.get_column('price').get_r_index()
+        table[5][price_index] = '100'
+        table.append(table[0][:])
+        table[-1][0] = 'new title'
+        updated_at = dict(Book.objects.values_list('title', 'updated_at'))
+
+        for_read = BookWithPublisherCsv.for_read(table=table)
+        for_read.set_static('only_exists', True)
+        self.assertTrue(for_read.is_valid())
+        # savepoint, select, update of the changed book, insert, release.
+        with self.assertNumQueries(5):
+            for_read.bulk_save(update_conflicts=True)
+
+        self.assertEqual(Book.objects.count(), 51)
+        self.assertEqual(Book.objects.get(title=table[5][0]).price, 100)
+        self.assertListEqual(
+            [title for title, value in Book.objects.values_list('title', 'updated_at')
+             if value != updated_at.get(title)],
+            [table[5][0], 'new title']
+        )
+
+        # existing books of the same key are not merged silently.
+        book = Book.objects.get(title=table[5][0])
+        book.pk = None
+        book.save()
+        for_read = BookWithPublisherCsv.for_read(table=table)
+        for_read.set_static('only_exists', True)
+        with self.assertRaises(Book.MultipleObjectsReturned):
+            for_read.bulk_save(update_conflicts=True)
+
+    def test_detect_changes(self):
+        table = BookWithPublisherCsv.for_write(
+            instances=self.all_queryset).get_table(header=False)
+        Book.objects.all().delete()
+
+        def read(table):
+            for_read = BookWithPublisherCsv.for_read(table=table)
+            for_read.detect_changes = True
+            for_read.set_static('only_exists', True)
+            return for_read
+
+        for_read = read(table)
+        self.assertTrue(for_read.is_valid())
+        self.assertListEqual(for_read.unchanged_rows, [])
+        # books and digests are saved together.
+        with mock.patch.object(changes, 'store_digests', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                for_read.bulk_save()
+        self.assertEqual(Book.objects.count(), 0)
+        for_read.bulk_save()
+        self.assertEqual(Book.objects.count(), 50)
+        self.assertEqual(RowDigest.objects.count(), 50)
+
+        price_index = BookWithPublisherCsv._meta.get_column('price').get_r_index()
+        city_index = BookWithPublisherCsv._meta.get_column('pbl_city').get_r_index()
+        city = table[10][city_index]
+        table[3][price_index] = '100'
+        table[10][city_index] = ''
+        for_read = read(table)
+        self.assertFalse(for_read.is_valid())
+        self.assertEqual(len(for_read.unchanged_rows), 48)
+        self.assertListEqual([row.number for row in for_read.cleaned_rows], [3, 10])
+        self.assertListEqual(
+            [error.row_number for error in for_read.errors], [10])
+
+        # only the changed rows are saved.
+        table[10][city_index] = city
+        for_read = read(table)
+        with self.assertNumQueries(8):
+            # digests, publishers, users, then savepoint, select, update and
+            # release of bulk_save(), and digests.
+            for_read.bulk_save(update_conflicts=True, unique_fields=['title'])
+        self.assertEqual(Book.objects.get(title=table[3][0]).price, 100)
+
+        for_read = read(table)
+        self.assertTrue(for_read.is_valid())
+        self.assertListEqual(for_read.cleaned_rows, [])
+        self.assertListEqual(for_read.unchanged_rows, list(range(50)))
+
+    def test_for_read_chunks(self):
+        table = BookWithPublisherCsv.for_write(
+            instances=self.all_queryset).get_table(header=False)
+        city_index = BookWithPublisherCsv._meta.get_column('pbl_city').get_r_index()
+        for i in (3, 17, 18, 49):
+            table[i][city_index] = ''
+
+        for_read = BookWithPublisherCsv.for_read(table=table)
+        self.assertFalse(for_read.is_valid())
+
+        chunks = list(BookWithPublisherCsv.for_read_chunks(
+            rows=iter(table), chunk_size=8, static={'only_exists': True}))
+        self.assertListEqual([len(chunk.cleaned_rows) for chunk in chunks],
+                             [8, 8, 8, 8, 8, 8, 2])
+        self.assertListEqual(
+            [row.number for chunk in chunks for row in chunk.cleaned_rows],
+            list(range(50))
+        )
+        self.assertListEqual(
+            [error.row_number for chunk in chunks for error in chunk.errors],
+            [3, 17, 18, 49]
+        )
+        self.assertListEqual(
+            [error for chunk in chunks for error in chunk.errors],
+            for_read.errors
+        )
+        for chunk in chunks:
+            if chunk.is_valid():
+                chunk.bulk_save()
+        self.assertEqual(Book.objects.count(), 50 + 8 * 4)
+
+    def test_parallel_is_valid(self):
+        table = BookWithPublisherCsv.for_write(
+            instances=self.all_queryset).get_table(header=False)
+        city_index = BookWithPublisherCsv._meta.get_column('pbl_city').get_r_index()
+        for i in (3, 17, 18, 49):
+            table[i][city_index] = ''
+
+        serial = BookWithPublisherCsv.for_read(table=table)
+        serial.set_static('only_exists', True)
+        self.assertFalse(serial.is_valid())
+
+        parallel = BookWithPublisherCsv.for_read(table=table)
+        parallel.set_static('only_exists', True)
+        self.assertFalse(parallel.is_valid(workers=2, shard_size=8))
+
+        self.assertListEqual(
+            [row.number for row in parallel.cleaned_rows], list(range(50)))
+        self.assertListEqual(parallel.errors, serial.errors)
+        self.assertListEqual(
+            [row.values for row in parallel.cleaned_rows],
+            [row.values for row in serial.cleaned_rows]
+        )
+
+    def test_compiled_rows(self):
+        for_write = BookWithPublisherCsv.for_write(instances=self.all_queryset)
+        table = for_write.get_table()
+        for_write.compile_rows = False
+        self.assertListEqual(table, for_write.get_table())
+
+        table = table[1:]
+        table[5][BookWithPublisherCsv._meta.get_column('price').get_r_index()] = '100'
+        table[8][BookWithPublisherCsv._meta.get_column('pbl_city').get_r_index()] = ''
+        compiled = BookWithPublisherCsv.for_read(table=table)
+        library = BookWithPublisherCsv.for_read(table=table)
+        library.compile_rows = False
+        self.assertEqual(compiled.is_valid(), library.is_valid())
+        self.assertListEqual(compiled.errors, library.errors)
+        self.assertListEqual(
+            [row.values for row in compiled.cleaned_rows],
+            [row.values for row in library.cleaned_rows]
+        )
+
+        # a cell which fails to convert raises its ValueError as the library does.
+        meta = BookWithPublisherCsv._meta
+        for name, value in [('price', 'abc'), ('is_on_sale', 'maybe'),
+                            ('created_at', '2022-02-30 00:00:00')]:
+            failing = [row[:] for row in table]
+            failing[3][meta.get_column(name).get_r_index()] = value
+            library = BookWithPublisherCsv.for_read(table=failing)
+            library.compile_rows = False
+            with self.assertRaises(ValueError) as expected:
+                library.is_valid()
+
+            for label, compile_rows, parse_by_column, profile in [
+                    ('by row', True, False, False), ('by column', True, True, False),
+                    ('profiled', True, True, True)]:
+                with self.subTest(name=name, path=label):
+                    compiled = BookWithPublisherCsv.for_read(table=failing)
+                    compiled.parse_by_column = parse_by_column
+                    if profile:
+                        compiled.enable_profile()
+                    with self.assertRaisesMessage(ValueError, str(expected.exception)):
+                        compiled.is_valid()
+
+    def test_parse_by_column(self):
+        meta = BookWithPublisherCsv._meta
+        table = BookWithPublisherCsv.for_write(
+            instances=self.all_queryset).get_table(header=False)
+        for i in (3, 4, 7):
+            table[i][meta.get_column('pbl_city').get_r_index()] = ''
+        table[9][meta.get_column('updated_at').get_r_index()] = '2022-1-5  3:04:05'
+
+        by_column = BookWithPublisherCsv.for_read(table=table)
+        by_column.parse_chunk_size = 3
+        by_row = BookWithPublisherCsv.for_read(table=table)
+        by_row.parse_by_column = False
+        for mcsv in (by_column, by_row):
+            mcsv.set_static('only_exists', True)
+        self.assertFalse(by_column.is_valid())
+        self.assertFalse(by_row.is_valid())
+        self.assertListEqual(by_column.errors, by_row.errors)
+        self.assertListEqual(
+            sorted({error.row_number for error in by_column.errors}), [3, 4, 7])
+        self.assertListEqual(
+            [row.values for row in by_column.cleaned_rows],
+            [row.values for row in by_row.cleaned_rows]
+        )
+        self.assertEqual(by_column.cleaned_rows[9]['updated_at'],
+                         datetime(2022, 1, 4, 18, 4, 5, tzinfo=timezone.utc))
+
+        # row numbers continue over chunks.
+        self.assertListEqual(
+            [error.row_number for mcsv in BookWithPublisherCsv.for_read_chunks(
+                table, chunk_size=5, static={'only_exists': True})
+             for error in mcsv.errors],
+            [error.row_number for error in by_row.errors]
+        )
+
+        # the fast path of `datetime_format` returns what the library does.
+        parse = compiled._compile_parser(meta, datetime, 0)
+        for value in ('2022-10-01 00:00:00', '2022-1-5 3:4:5', '2022-01-05\t00:00:00',
+                      '2022-01-05', '2024-02-29 23:59:59'):
+            with self.subTest(value=value):
+                self.assertEqual(parse(value), meta.convert_from_str(value, datetime, 0))
+        for value in ('2022-10-01T00:00:00', '2022-10-01 00:00:00 ', '2022-13-01',
+                      '2022-02-29 00:00:00'):
+            with self.subTest(value=value):
+                with self.assertRaises(ValueError):
+                    parse(value)
+
+    def test_profile(self):
+        table = BookWithPublisherCsv.for_write(
+            instances=self.all_queryset).get_table(header=False)
+        for row in table:
+            row[0] = ''  # create new books.
+
+        reports = []
+
+        def receiver(sender, csv, report, **kwargs):
+            reports.append((sender, csv, report))
+
+        conversion_profiled.connect(receiver)
+        self.addCleanup(conversion_profiled.disconnect, receiver)
+
+        for_read = BookWithPublisherCsv.for_read(table=table)
+        profile = for_read.enable_profile()
+        for_read.bulk_save()
+
+        self.assertEqual(len(reports), 1)
+        self.assertIs(reports[0][0], BookWithPublisherCsv)
+        self.assertIs(reports[0][1], for_read)
+        report = reports[0][2]
+
+        stats = {(stat['kind'], stat['name']): stat for stat in report['stats']}
+        self.assertEqual(stats[(profiling.COLUMN, 'title')]['calls'], 50)
+        self.assertEqual(
+            stats[(profiling.HOOK, 'PublisherCsv.field_headquarter')]['calls'], 50)
+        self.assertEqual(stats[(profiling.CALLBACK, 'publisher')]['calls'], 50)
+        self.assertEqual(
+            [stat['calls'] for (kind, _), stat in stats.items() if kind == 'resolve'],
+            [1, 1])
+
+        # users and publishers are fetched once each.
+        self.assertEqual(report['phases'][profiling.RESOLVE]['queries'], 2)
+        self.assertEqual(report['phases'][profiling.PARSE]['queries'], 0)
+        self.assertGreater(report['phases'][profiling.SAVE]['queries'], 0)
+        # the book and the publisher part of each row.
+        self.assertEqual(report['phases'][profiling.PARSE]['calls'], 100)
+        self.assertDictEqual(for_read.profile_report['phases'], report['phases'])
+        self.assertIsNot(profile, BookWithPublisherCsv.for_read(table=table).profile)
+        self.assertEqual(Book.objects.count(), 100)
+
+        for_write = BookWithPublisherCsv.for_write(instances=self.all_queryset)
+        for_write.enable_profile()
+        rows = for_write.iter_table(header=False)
+        next(rows)
+        # sent after the last row.
+        self.assertEqual(len(reports), 1)
+        self.assertEqual(len(list(rows)), Book.objects.count() - 1)
+        self.assertEqual(len(reports), 2)
+        self.assertEqual(reports[1][2]['phases'][profiling.WRITE]['calls'], 1)
+        self.assertGreater(reports[1][2]['phases'][profiling.WRITE]['queries'], 0)
+
+    def test_part_cache(self):
+        rows = BookWithPublisherCsv.for_write(
+            instances=self.all_queryset[:5]).get_table(header=False)
+        city_index = BookWithPublisherCsv._meta.get_column('pbl_city').get_r_index()
+        rows[0][city_index] = ''
+        table = [row[:] for _ in range(10) for row in rows]
+
+        cached = BookWithPublisherCsv.for_read(table=table)
+        cached.set_static('only_exists', True)
+        uncached = BookWithPublisherCsv.for_read(table=table)
+        uncached.set_static('only_exists', True)
+        uncached.part_cache_size = 0
+
+        self.assertFalse(cached.is_valid())
+        self.assertFalse(uncached.is_valid())
+        self.assertEqual((cached.part_cache.hits, cached.part_cache.misses), (45, 5))
+        self.assertIsNone(uncached.part_cache)
+        self.assertListEqual(
+            [error.row_number for error in cached.errors], list(range(0, 50, 5)))
+        self.assertListEqual(cached.errors, uncached.errors)
+        self.assertListEqual(
+            [row.values for row in cached.cleaned_rows],
+            [row.values for row in uncached.cleaned_rows]
+        )
+
+        # the least recently used part is evicted.
+        small = BookWithPublisherCsv.for_read(table=table)
+        small.part_cache_size = 4
+        small.is_valid()
+        self.assertEqual(small.part_cache.hits, 0)
+        self.assertEqual(len(small.part_cache.rows), 4)
+
+    def test_export_cache(self):
+        caches['default'].clear()
+        self.addCleanup(caches['default'].clear)
+
+        def export(queryset, stream: bool = False):
+            for_write = BookCsv.for_write(instances=queryset)
+            for_write.export_version_field = 'updated_at'
+            if stream:
+                return list(for_write.iter_table())
+            return for_write.get_table()
+
+        queryset = self.all_queryset.filter(price__gte=1000)
+        # version token, books.
+        with self.assertNumQueries(2):
+            table = export(queryset)
+        # only the version token.
+        with self.assertNumQueries(1):
+            self.assertListEqual(export(queryset), table)
+        with self.assertNumQueries(1):
+            self.assertListEqual(export(queryset, stream=True), table)
+
+        # another filter.
+        with self.assertNumQueries(2):
+            self.assertEqual(len(export(self.all_queryset)), 51)
+
+        book = queryset.first()
+        book.price = 5000
+        book.save()
+        # the stream fills the cache for get_table().
+        with self.assertNumQueries(3):
+            self.assertListEqual(export(queryset, stream=True), export(queryset))
+        self.assertIn('5000', export(queryset)[1])
+
+        # a renamed publisher doesn't update the books.
+        for_write = BookWithPublisherCsv.for_write(instances=queryset)
+        for_write.export_version_field = 'updated_at'
+        self.assertFalse(for_write.can_cache_export())
+        self.assertIsNone(for_write.get_export_cache_key(header=True))
+        for_write.export_related_version_fields = ('publisher__registered_by__last_login',)
+        self.assertFalse(for_write.can_cache_export())
+        for_write.export_related_version_fields += ('publisher__name',)
+        self.assertTrue(for_write.can_cache_export())
+        key = for_write.get_export_cache_key(header=True)
+        User.objects.update(last_login=datetime.now(tz=timezone.utc))
+        self.assertNotEqual(for_write.get_export_cache_key(header=True), key)
+
+        # `bulk_save()` updating books doesn't change Max(created_at) nor the count.
+        def export_created(queryset):
+            for_write = BookCsv.for_write(instances=queryset)
+            for_write.export_version_field = 'created_at'
+            return for_write.get_table()
+
+        table = export_created(queryset)
+        price_index = BookWithPublisherCsv._meta.get_column('price').get_r_index()
+        rows = BookWithPublisherCsv.for_write(instances=queryset).get_table(header=False)
+        for row in rows:
+            row[price_index] = '9999'
+        for_read = BookWithPublisherCsv.for_read(table=rows)
+        for_read.set_static('only_exists', True)
+        with self.captureOnCommitCallbacks(execute=True):
+            for_read.bulk_save(update_conflicts=True)
+        self.assertNotEqual(export_created(queryset), table)
+        self.assertTrue(all('9999' in row for row in export_created(queryset)[1:]))
+
+        # writes which don't update the version fields.
+        table = export_created(queryset)
+        queryset.update(price=1234)
+        self.assertListEqual(export_created(queryset), table)
+        bump_export_generation(Book)
+        self.assertTrue(all('1234' in row for row in export_created(queryset)[1:]))
+
+    def test_cached_layout(self):
+        class OnlyTitleBookCsv(CachedLayoutMixin, DjangoCsv):
+            title = columns.AttributeColumn(header='custom title')
+
+            class Meta:
+                model = Book
+                auto_assign = True
+
+        meta = OnlyTitleBookCsv._meta
+        headers = meta.get_headers(for_write=True)
+        self.assertListEqual(headers, ['custom title'])
+        headers.append('changed')
+        self.assertListEqual(meta.get_headers(for_write=True), ['custom title'])
+        self.assertIs(meta.get_column('title'), meta.get_column('title'))
+        with self.assertRaises(meta.UnknownColumn):
+            meta.get_column('price')
+
+        # the subclass assigns a new index to `title` shared with the base class.
+        class TitleAndPriceBookCsv(OnlyTitleBookCsv):
+            price = columns.AttributeColumn(index=0)
+
+            class Meta:
+                model = Book
+                auto_assign = True
+
+        for mcsv_class in (OnlyTitleBookCsv, TitleAndPriceBookCsv):
+            meta = mcsv_class._meta
+            for kwargs in ({'for_write': True}, {'for_read': True}):
+                self.assertListEqual(
+                    meta.get_headers(**kwargs),
+                    DjangoOptions.get_headers(meta, **kwargs)
+                )
+                self.assertListEqual(
+                    meta.get_columns(**kwargs),
+                    DjangoOptions.get_columns(meta, **kwargs)
+                )
+        self.assertListEqual(TitleAndPriceBookCsv._meta.get_headers(for_write=True),
+                             ['price', 'custom title'])
+
+        for_write = TitleAndPriceBookCsv.for_write(instances=self.all_queryset)
+        for row, obj in zip(for_write.get_table(header=False), self.all_queryset):
+            self.assertListEqual(row, [str(obj.price), obj.title])
+
+        # neither for_write() nor new classes not sharing columns drop the cache.
+        meta = TitleAndPriceBookCsv._meta
+        meta.get_headers(for_write=True)
+        with mock.patch.object(DjangoOptions, 'get_headers', autospec=True,
+                               side_effect=DjangoOptions.get_headers) as get_headers:
+            for _ in range(2):
+                OnlyTitleBookCsv.for_write(instances=self.all_queryset).get_table()
+
+            class OnlyPriceBookCsv(CachedLayoutMixin, DjangoCsv):
+                price = columns.AttributeColumn()
+
+                class Meta:
+                    model = Book
+                    auto_assign = True
+
+            OnlyPriceBookCsv.for_write(instances=self.all_queryset).get_table()
+            self.assertListEqual(meta.get_headers(for_write=True),
+                                 ['price', 'custom title'])
+        self.assertNotIn(meta, [call.args[0] for call in get_headers.call_args_list])
+        self.assertIn(OnlyPriceBookCsv._meta,
+                      [call.args[0] for call in get_headers.call_args_list])
+
+    def test_values_list(self):
+        class BookWithPublisherNameCsv(ValuesListMixin, CompiledRowMixin, DjangoCsv):
+            pbl = PublisherCsv.as_part(related_name='publisher', callback='get_publisher')
+            pbl_name = pbl.AttributeColumn(header='Publisher', attr_name='name')
+
+            class Meta:
+                model = Book
+                fields = '__all__'
+                auto_assign = True
+
+        for mcsv_class, paths in (
+                (BookCsv, ['title', 'price', 'is_on_sale', 'description',
+                           'created_at', 'updated_at']),
+                (BookWithPublisherNameCsv, ['title', 'price', 'is_on_sale', 'description',
+                                            'created_at', 'updated_at', 'publisher__name'])):
+            for_write = mcsv_class.for_write(instances=self.all_queryset)
+            self.assertListEqual(sorted(for_write.instances.query.values_select),
+                                 sorted(paths))
+            with self.assertNumQueries(1):
+                table = for_write.get_table()
+
+            library = mcsv_class.for_write(instances=list(self.all_queryset))
+            self.assertIsNone(library._values_writer)
+            self.assertListEqual(table, library.get_table())
+
+        # `column_*` methods need instances.
+        self.assertIsNone(compiled.get_values_writer(BookWithPublisherCsv))
+
+        class PriceBookCsv(BookCsv):
+            class Meta:
+                model = Book
+                fields = '__all__'
+
+            def column_price(self, instance: Book, **kwargs) -> str:
+                return f'{instance.price} yen'
+
+        for_write = PriceBookCsv.for_write(instances=self.all_queryset)
+        self.assertIsNone(for_write._values_writer)
+        for obj, row in zip(self.all_queryset, for_write.get_table(header=False)):
+            self.assertIn(f'{obj.price} yen', row)
+
+    def test_format_by_column(self):
+        # None, False and datetimes in the same second or not.
+        now = datetime(2024, 3, 31, 14, 59, 59, 999_999, tzinfo=timezone.utc)
+        books = list(self.all_queryset[:10])
+        for i, book in enumerate(books):
+            book.price = None if i % 3 == 0 else book.price
+            book.is_on_sale = i % 2 == 0
+            book.created_at = now + timedelta(microseconds=i % 4)
+            book.updated_at = now + timedelta(seconds=i // 3, microseconds=-i)
+        Book.objects.bulk_update(
+            books, ['price', 'is_on_sale', 'created_at', 'updated_at'])
+
+        class GapBookCsv(ValuesListMixin, CompiledRowMixin, DjangoCsv):
+            title = columns.AttributeColumn(index=3)
+            created_at = columns.AttributeColumn(index=0, to=datetime)
+
+            class Meta:
+                model = Book
+                insert_blank_column = True
+                datetime_format = '%m/%d/%Y %I:%M:%S %p'
+                tzinfo = timezone(timedelta(hours=-5))
+
+        for mcsv_class in (BookCsv, GapBookCsv):
+            for_write = mcsv_class.for_write(instances=self.all_queryset)
+            for_write.column_chunk_size = 7
+            self.assertIsNotNone(for_write._columns_writer)
+            with self.assertNumQueries(1):
+                table = for_write.get_table()
+
+            library = mcsv_class.for_write(instances=list(self.all_queryset))
+            self.assertListEqual(table, library.get_table())
+            if mcsv_class is BookCsv:
+                self.assertListEqual(list(mcsv_class.for_write(
+                    instances=self.all_queryset).iter_table(chunk_size=4)), table)
+        self.assertListEqual(table[1][1:3], ['', ''])
+
     def test_headers(self):
         class BookCsv(DjangoCsv):
             class Meta:
@@ -480,3 +1163,74 @@ class DjangoCsvForWriteTest(TestCase):
             self.assertEqual(row.errors[0].name, 'publisher__headquarter')
             self.assertEqual(
                 row.errors[0].message, 'osaka, Japan is not in choices.')
+
+
+class ParallelWriteTest(TransactionTestCase):
+    def setUp(self) -> None:
+        user = User.objects.create_user(username='admin', password='password')
+        AuthorFactory.create_batch(5)
+        author_list = list(Author.objects.all())
+        for _ in range(30):
+            BookFactory(authors=random.sample(author_list, random.randrange(1, 3)),
+                        publisher__registered_by_id=user.pk)
+        # gaps of pks.
+        Book.objects.filter(pk__in=Book.objects.order_by('pk').values('pk')[5:9]).delete()
+
+    @contextlib.contextmanager
+    def database_file(self):
+        """
+        Copy an in-memory test database to a file the workers connect to.
+        """
+        if not connection.is_in_memory_db():
+            yield
+            return
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'db.sqlite3')
+            connection.ensure_connection()
+            with contextlib.closing(sqlite3.connect(path)) as target:
+                connection.connection.backup(target)
+
+            name = connection.settings_dict['NAME']
+            connection.settings_dict['NAME'] = path
+            try:
+                yield
+            finally:
+                connection.settings_dict['NAME'] = name
+
+    def test_parallel_get_table(self):
+        queryset = Book.objects.order_by('pk').filter(price__gte=0)
+        parallel = BookCsv.for_write(instances=queryset)
+        parallel.write_workers = 2
+        self.assertEqual(parallel.can_shard(), not connection.is_in_memory_db())
+
+        with self.database_file():
+            self._test_parallel_get_table(queryset)
+
+    def _test_parallel_get_table(self, queryset):
+        for mcsv_class in (BookCsv, BookWithPublisherCsv):
+            with self.subTest(mcsv_class.__name__):
+                serial = mcsv_class.for_write(instances=queryset).get_table()
+                self.assertEqual(len(serial), 27)
+
+                parallel = mcsv_class.for_write(instances=queryset)
+                parallel.write_workers = 2
+                parallel.write_shard_size = 7
+                self.assertTrue(parallel.can_shard())
+                self.assertEqual(len(parallel.get_pk_ranges()), 4)
+                # a pickled QuerySet would be fetched in this process.
+                with mock.patch.object(QuerySet, '__getstate__',
+                                       side_effect=AssertionError('QuerySet is pickled')):
+                    self.assertListEqual(parallel.get_table(), serial)
+
+        f = io.BytesIO()
+        parallel.write_file(f, CsvWriter(filename='book.csv'))
+        self.assertEqual(f.getvalue(), b''.join(
+            parallel.get_streaming_response(CsvWriter(filename='book.csv'))))
+
+        # the order of other fields cannot be kept by pk ranges.
+        parallel = BookCsv.for_write(instances=queryset.order_by('title'))
+        parallel.write_workers = 2
+        self.assertFalse(parallel.can_shard())
+        self.assertListEqual(parallel.get_table(),
+                             BookCsv.for_write(instances=queryset.order_by('title')).get_table())
@@ -0,0 +1,9 @@
+from django.urls import path
+
+from book import views
+
+app_name = 'book'
+
+urlpatterns = [
+    path('export/', views.BookExportView.as_view(), name='export'),
+]
@@ -0,0 +1,55 @@
+from asgiref.sync import sync_to_async
+from django.contrib.auth.views import redirect_to_login
+from django.db.models import QuerySet
+from django.http import Http404
+from django.urls import reverse
+from django.views import View
+
+from book import compression
+from book.mcsv import BookWithPublisherCsv
+from book.models import Book
+from django_csv.model_csv.writers import CsvWriter, TsvWriter
+
+
+class AsyncCsvExportView(View):
+    """
+    Stream rows of `csv_class` from an async view. `?format=tsv` returns TSV.
+    `?compression=gzip` compresses it, see `book.compression`.
+    Only staff users can export.
+    `csv_class` must inherit `book.mixins.StreamingMixin`.
+    """
+    csv_class = None
+    file_name: str = 'CsvFile'
+    writers = {'csv': CsvWriter, 'tsv': TsvWriter}
+
+    def get_queryset(self) -> QuerySet:
+        raise NotImplementedError
+
+    @staticmethod
+    def has_permission(request) -> bool:
+        return request.user.is_active and request.user.is_staff
+
+    async def get(self, request, *args, **kwargs):
+        if not await sync_to_async(self.has_permission)(request):
+            return redirect_to_login(request.get_full_path(), reverse('admin:login'))
+
+        extension = request.GET.get('format', 'csv')
+        if extension not in self.writers:
+            raise Http404(f'`{extension}` is not supported')
+
+        method = request.GET.get('compression') or None
+        if method is not None and method not in compression.get_methods():
+            raise Http404(f'`{method}` is not supported')
+
+        mcsv = self.csv_class.for_write(instances=self.get_queryset())
+        return mcsv.get_async_streaming_response(
+            self.writers[extension](filename=f'{self.file_name}.{extension}'),
+            compression=method)
+
+
+class BookExportView(AsyncCsvExportView):
+    csv_class = BookWithPublisherCsv
+    file_name = 'books'
+
+    def get_queryset(self) -> QuerySet:
+        return Book.objects.order_by('id')
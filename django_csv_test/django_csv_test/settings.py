@@ -107,7 +107,24 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 
+MEDIA_ROOT = BASE_DIR / 'media'
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.0/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# django-csv import jobs
+# `book.jobs.ThreadPoolJobExecutor` imports uploads in this process.
+# `book.jobs.DatabaseJobExecutor` leaves them to `manage.py run_import_jobs`.
+CSV_IMPORT_EXECUTOR = 'book.jobs.ThreadPoolJobExecutor'
+CSV_IMPORT_WORKERS = 2
+CSV_IMPORT_CHUNK_SIZE = 1000
+# seconds after which a checkpoint of a running resumable job can be taken
+# over by another job of the same file, e.g. after the worker was killed.
+CSV_IMPORT_CHECKPOINT_TIMEOUT = 600
+# seconds without a heartbeat after which `manage.py run_import_jobs` fails a
+# running job, e.g. after its worker was killed. A job importing in one
+# transaction beats only when it starts, so this must exceed its whole import.
+CSV_IMPORT_JOB_TIMEOUT = 3600